@@ -0,0 +1,146 @@
+"""
+Render load of the chat page on a running instance of the app.
+
+Opens browser sessions over the websocket of the app, logs each in and sends
+patient messages as the browser does. For every turn it records the time from
+the message sent to the end of the rerun it started, and the number of
+elements the server sent for it. With the history drawn once per message,
+both stay flat as the conversation grows:
+
+    streamlit run "webapp/Chat_with_AI_Therapist.py" --server.port 8501 --server.headless true
+    python benchmarks/chat_render_load.py --password <web_login_password> [--sessions 5] [--turns 10]
+
+The therapist replies come from the model the app is configured with, point it
+at a stub server, e.g. with OPENAI_BASE_URL, to measure the rendering alone.
+"""
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from websockets.asyncio.client import connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+# Widgets whose value the page reads, by the field of their element
+WIDGETS = ("text_input", "button", "chat_input")
+# Slopes over the turns above which the rendering grows with the conversation
+FLAT_BUDGET_MS_PER_TURN = 5.0
+FLAT_BUDGET_ELEMENTS_PER_TURN = 1.0
+
+
+class Session:
+    """A browser session of the app, driven over its websocket."""
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.page_script_hash = ""
+        # Widget id and fragment by label, from the elements of the last reruns
+        self.widgets = {}
+
+    async def rerun(self, widget_states=(), fragment_id=""):
+        """Send a rerun and wait for it to finish, returns its duration in ms and the elements sent."""
+        message = BackMsg()
+        message.rerun_script.page_script_hash = self.page_script_hash
+        message.rerun_script.fragment_id = fragment_id
+        for widget_id, field, value in widget_states:
+            state = message.rerun_script.widget_states.widgets.add()
+            state.id = widget_id
+            if field == "chat_input_value":
+                state.chat_input_value.data = value
+            else:
+                setattr(state, field, value)
+        start = time.perf_counter()
+        await self.websocket.send(message.SerializeToString())
+
+        elements = 0
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(await self.websocket.recv())
+            kind = forward.WhichOneof("type")
+            if kind == "new_session":
+                self.page_script_hash = forward.new_session.page_script_hash
+            elif kind == "delta":
+                elements += 1
+                self.track_widget(forward.delta)
+            elif kind == "script_finished" and forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                return (time.perf_counter() - start) * 1000, elements
+
+    def track_widget(self, delta):
+        if delta.WhichOneof("type") != "new_element":
+            return
+        element = delta.new_element
+        kind = element.WhichOneof("type")
+        if kind in WIDGETS:
+            widget = getattr(element, kind)
+            label = widget.placeholder if kind == "chat_input" else widget.label
+            self.widgets[label] = (widget.id, delta.fragment_id)
+
+    def widget(self, label_prefix):
+        for label, widget in self.widgets.items():
+            if label.startswith(label_prefix):
+                return widget
+        raise LookupError(f"No widget {label_prefix!r} on the page, found {sorted(self.widgets)}")
+
+    async def log_in(self, prolific_id, password):
+        await self.rerun()
+        await self.rerun([
+            (self.widget("Your Prolific ID")[0], "string_value", prolific_id),
+            (self.widget("Chat Password")[0], "string_value", password),
+            (self.widget("Enter")[0], "trigger_value", True),
+        ])
+
+    async def send(self, text):
+        message_id, fragment_id = self.widget("You:")
+        return await self.rerun([(message_id, "chat_input_value", text)], fragment_id)
+
+
+async def run_session(url, index, password, turns):
+    """Turn times and elements of one session."""
+    async with connect(f"{url}/_stcore/stream", subprotocols=["streamlit"], max_size=None) as websocket:
+        session = Session(websocket)
+        await session.log_in(f"load_test_{index}", password)
+        return [await session.send(f"Message {turn} of load test session {index}") for turn in range(turns)]
+
+
+def slope(points):
+    """Least squares slope of y over x."""
+    mean_x = statistics.fmean(x for x, _ in points)
+    mean_y = statistics.fmean(y for _, y in points)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in points)
+            / sum((x - mean_x) ** 2 for x, _ in points))
+
+
+async def run(args):
+    results = await asyncio.gather(*(run_session(args.url, index, args.password, args.turns)
+                                     for index in range(args.sessions)))
+    print(f"{'turn':>4} {'median ms':>10} {'max ms':>8} {'elements':>9}")
+    for turn in range(args.turns):
+        timings = [result[turn][0] for result in results]
+        elements = [result[turn][1] for result in results]
+        print(f"{turn:>4} {statistics.median(timings):>10.1f} {max(timings):>8.1f} {statistics.median(elements):>9.0f}")
+
+    ms_per_turn = slope([(turn, result[turn][0]) for result in results for turn in range(args.turns)])
+    elements_per_turn = slope([(turn, result[turn][1]) for result in results for turn in range(args.turns)])
+    print(f"{ms_per_turn:+.2f}ms and {elements_per_turn:+.2f} elements per turn")
+    return ms_per_turn, elements_per_turn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the render time of the chat turns under load.")
+    parser.add_argument("--url", default="ws://127.0.0.1:8501", help="Websocket URL of the app")
+    parser.add_argument("--password", required=True, help="web_login_password of the app")
+    parser.add_argument("--sessions", type=int, default=5, help="Concurrent sessions")
+    parser.add_argument("--turns", type=int, default=10, help="Patient messages per session")
+    args = parser.parse_args()
+    if args.turns < 2:
+        parser.error("--turns must be at least 2")
+
+    ms_per_turn, elements_per_turn = asyncio.run(run(args))
+    if ms_per_turn > FLAT_BUDGET_MS_PER_TURN or elements_per_turn > FLAT_BUDGET_ELEMENTS_PER_TURN:
+        print(f"The turns grow by more than {FLAT_BUDGET_MS_PER_TURN}ms or "
+              f"{FLAT_BUDGET_ELEMENTS_PER_TURN} elements per turn")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
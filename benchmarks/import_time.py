@@ -0,0 +1,85 @@
+"""
+Import-time budget of the therapy_system package and the webapp modules.
+
+Each target is imported in a fresh interpreter with `-X importtime`. The
+cumulative time of the target is compared with its budget and the heavy
+SDKs that must stay deferred until first use are checked not to be loaded.
+
+    python benchmarks/import_time.py [--repeat 5]
+
+Exits with a non-zero status when a budget is exceeded or a deferred module
+is imported, so it can run as a check before deploying the app or a simulator.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time budget in milliseconds
+BUDGETS_MS = {
+    "therapy_system": 25,
+    "therapy_system.envs.transcript": 25,
+    "therapy_system.storage": 25,
+    "therapy_system.agents": 40,
+    "therapy_system.action": 40,
+}
+
+# Modules whose import must not pull in these packages
+DEFERRED = ["gymnasium", "openai", "boto3", "firebase_admin"]
+DEFERRED_CHECKS = list(BUDGETS_MS) + ["therapy_utils", "feedback_utils"]
+
+
+def run_python(code, *flags):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_ROOT, os.path.join(REPO_ROOT, "webapp")]))
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=REPO_ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def import_time_ms(module):
+    """Cumulative import time of the module and its parent packages in a fresh interpreter."""
+    root = module.split(".")[0]
+    stderr = run_python(f"import {module}", "-X", "importtime").stderr
+    total_us = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Top-level entries only, nested imports are already in their cumulative time
+        if not name.startswith("  ") and name.strip().split(".")[0] == root:
+            total_us += int(cumulative)
+    return total_us / 1000
+
+
+def deferred_modules_loaded(module):
+    code = f"import sys, json, {module}; print(json.dumps([m for m in {DEFERRED!r} if m in sys.modules]))"
+    return json.loads(run_python(code).stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time budget.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module, the fastest one counts")
+    args = parser.parse_args()
+
+    failures = []
+    for module, budget_ms in BUDGETS_MS.items():
+        elapsed_ms = min(import_time_ms(module) for _ in range(args.repeat))
+        status = "ok" if elapsed_ms <= budget_ms else "OVER BUDGET"
+        print(f"{module:<35} {elapsed_ms:8.1f}ms  budget {budget_ms:>4}ms  {status}")
+        if elapsed_ms > budget_ms:
+            failures.append(module)
+
+    for module in DEFERRED_CHECKS:
+        loaded = deferred_modules_loaded(module)
+        if loaded:
+            print(f"{module} imports {', '.join(loaded)} at import time")
+            failures.append(module)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Overhead of the structured logging on the request threads.
+
+Times one call of each kind with the logging configured as in the app, the records
+written to /dev/null by the listener thread:
+
+- a DEBUG record at the default INFO level, which is only a level check
+- an INFO record with the session context, which is put on the queue
+- the print it replaces
+
+    python benchmarks/log_overhead.py [--calls 100000]
+
+Exits with a non-zero status when a record below the level costs more than its budget.
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from therapy_system.log import configure_logging, bind_log_context, get_logger
+
+# Budget of a record below the level in microseconds
+DISABLED_BUDGET_US = 1.0
+
+
+def per_call_us(fn, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the overhead of the logging calls.")
+    parser.add_argument("--calls", type=int, default=100000, help="Calls timed per kind")
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, "w")
+    configure_logging(level="INFO", fmt="json", stream=devnull)
+    bind_log_context(session_id="benchmark", prolific_id="benchmark", page="benchmark")
+    logger = get_logger("benchmarks.log_overhead")
+
+    # Fewer INFO records, so the queue does not fill up and drop them
+    info_calls = min(args.calls, 5000)
+    timings = {
+        "debug (disabled)": per_call_us(lambda i: logger.debug("Turn %d of %s", i, "benchmark"), args.calls),
+        "info (queued)": per_call_us(lambda i: logger.info("Turn %d of %s", i, "benchmark"), info_calls),
+    }
+    with contextlib.redirect_stdout(devnull):
+        timings["print"] = per_call_us(lambda i: print("Turn %d of %s" % (i, "benchmark")), args.calls)
+
+    for kind, us in timings.items():
+        print(f"{kind:<20} {us:8.3f}us per call")
+
+    if timings["debug (disabled)"] > DISABLED_BUDGET_US:
+        print(f"A record below the level costs more than {DISABLED_BUDGET_US}us")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Agreement of the lexical pre-filter of the survey detection with the LLM-only detection.
+
+For each exported chat, the patient messages are checked against the posthoc
+survey phrases twice: by the LLM alone and with the pre-filter settling the
+phrases it can. The report gives how many phrases the pre-filter kept out of
+the prompt, how often its present/absent decisions agree with the LLM-only
+path, and the detection latency of both paths. The absent rule is off in the
+app, it is evaluated here to decide whether it can be turned on.
+
+    python benchmarks/prefilter_agreement.py [--export retrieve_data/data] [--limit 20]
+
+Needs OPENAI_API_KEY, the chats are exported with retrieve_data/study_2_data.py.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, "webapp")]
+
+import pandas as pd
+from feedback_utils import (POSTHOC_SURVEY_FILENAME, PRESENT, ABSENT, detect_disclosures,
+                            prefilter_phrases, read_posthoc_survey_info_csv)
+
+
+def iter_conversations(export_directory, limit=None):
+    """Patient messages of each exported chat, one message per line."""
+    names = sorted(name for name in os.listdir(export_directory)
+                   if name.startswith("chat_history_") and name.endswith(".json"))
+    for name in names[:limit]:
+        with open(os.path.join(export_directory, name)) as f:
+            doc = json.load(f)
+        messages = [turn["text"] for turn in doc["data"]["turns"] if turn["player"] == "user"]
+        if messages:
+            yield doc["doc_id"], "\n".join(message.replace("\n", " ") for message in messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the pre-filter with the LLM-only detection.")
+    parser.add_argument("--export", default=os.path.join(REPO_ROOT, "retrieve_data", "data"),
+                        help="Directory of the exported chats")
+    parser.add_argument("--limit", type=int, default=None, help="Number of chats to compare")
+    args = parser.parse_args()
+
+    survey_info = read_posthoc_survey_info_csv(os.path.join(REPO_ROOT, POSTHOC_SURVEY_FILENAME))
+    rows, latencies = [], []
+    for doc_id, conversation in iter_conversations(args.export, args.limit):
+        start = time.perf_counter()
+        llm_only, _ = detect_disclosures(survey_info, conversation, prefilter=False)
+        llm_only_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        statuses = prefilter_phrases(survey_info, conversation, absent=True)
+        prefilter_ms = (time.perf_counter() - start) * 1000
+        filtered, _ = detect_disclosures(survey_info, conversation, prefilter=True)
+        filtered_ms = (time.perf_counter() - start) * 1000
+
+        latencies.append({"llm_only_ms": llm_only_ms, "prefilter_ms": prefilter_ms, "with_prefilter_ms": filtered_ms})
+        for kn, status in statuses["status"].items():
+            rows.append({
+                "doc_id": doc_id,
+                "phrase_index": kn,
+                "status": status,
+                "llm_present": str(kn) in llm_only,
+                "filtered_present": str(kn) in filtered,
+            })
+
+    if not rows:
+        print(f"No exported chats found in {args.export}")
+        return
+
+    results = pd.DataFrame(rows)
+    decided = results[results["status"].isin([PRESENT, ABSENT])]
+    agrees = (decided["status"] == PRESENT) == decided["llm_present"]
+    print(f"Chats compared: {results['doc_id'].nunique()}")
+    print(f"Phrases settled by the pre-filter: {len(decided)} of {len(results)} ({len(decided) / len(results):.1%})")
+    for status in (PRESENT, ABSENT):
+        settled = decided["status"] == status
+        if settled.any():
+            print(f"Agreement of the {status} phrases with the LLM-only detection: {agrees[settled].mean():.1%}")
+    print(pd.crosstab(results["status"], results["llm_present"].rename("LLM-only present")))
+    print(f"End-to-end agreement of the detections: {(results['llm_present'] == results['filtered_present']).mean():.1%}")
+    print(pd.DataFrame(latencies).describe().loc[["mean", "50%", "max"]].round(1))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
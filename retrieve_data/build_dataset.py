@@ -0,0 +1,205 @@
+"""
+Build one columnar dataset of the study from the exported files.
+
+The export directory is read one file at a time and turned into three tables:
+- turns: one row per conversation turn
+- disclosures: one row per detected disclosure, with whether it was shown in
+  survey part 2, whether the participant selected it as necessary, and the reasoning
+- participants: one row per participant, joining the survey part 1 Likert scores,
+  the disclosure and technique metrics and the survey part 3 demographics
+
+Each table is written as a Parquet dataset partitioned by `session_date`, so
+the whole study loads with `load_study` in a single read per table.
+"""
+import os
+import json
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+EXPORT_DIRECTORY = "retrieve_data/data"
+DATASET_DIRECTORY = "retrieve_data/dataset"
+TABLES = ["participants", "turns", "disclosures"]
+
+# Survey part 1 answer scales, see webapp/post_survey_1.survey_questions_options
+LIKERT_SCALE = {
+    "disagree": 1, "slightly disagree": 2, "neutral": 3, "slightly agree": 4, "agree": 5,
+    "completely untrue": 1, "mostly untrue": 2, "mostly true": 4, "completely true": 5,
+}
+
+
+def iter_exports(export_directory, prefix):
+    """Yield the exported documents with the given prefix, one file at a time."""
+    with os.scandir(export_directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(f"{prefix}_") and entry.name.endswith(".json"):
+                with open(entry.path) as f:
+                    yield json.load(f)
+
+
+def latest_per_participant(df: pd.DataFrame) -> pd.DataFrame:
+    """Keep the most recent document of each participant, those exported without a timestamp are the oldest."""
+    if df.empty:
+        return df
+    return df.sort_values("timestamp", na_position="first").drop_duplicates("prolific_id", keep="last")
+
+
+def read_turns(export_directory) -> pd.DataFrame:
+    rows = []
+    for doc in iter_exports(export_directory, "chat_history"):
+        for turn in doc["data"]["turns"]:
+            rows.append({"prolific_id": doc["prolific_id"], "doc_id": doc["doc_id"],
+                         "timestamp": doc["timestamp"], **turn})
+    turns = pd.DataFrame(rows)
+    if turns.empty:
+        return turns
+    turns["timestamp"] = pd.to_datetime(turns["timestamp"], utc=True)
+    numeric = ["started_at", "ended_at", "prompt_tokens", "completion_tokens", "latency_ms"]
+    turns[numeric] = turns[numeric].apply(pd.to_numeric, errors="coerce")
+    # Only the latest chat of each participant is analysed
+    latest_docs = latest_per_participant(turns[["prolific_id", "doc_id", "timestamp"]].drop_duplicates())
+    turns = turns[turns["doc_id"].isin(latest_docs["doc_id"])].sort_values(["prolific_id", "iteration"])
+    turns["technique"] = turns["technique"].replace({"None": None})
+    return turns.reset_index(drop=True)
+
+
+def read_likert(export_directory) -> pd.DataFrame:
+    rows = [
+        {"prolific_id": doc["prolific_id"], "doc_id": doc["doc_id"], "timestamp": doc["timestamp"], **answer}
+        for doc in iter_exports(export_directory, "survey_one_response")
+        for answer in doc["data"]
+    ]
+    likert = pd.DataFrame(rows, columns=["prolific_id", "doc_id", "timestamp", "question_id", "statement", "response"])
+    latest_docs = latest_per_participant(likert[["prolific_id", "doc_id", "timestamp"]].drop_duplicates())
+    likert = likert[likert["doc_id"].isin(latest_docs["doc_id"])]
+    likert = likert.assign(score=likert["response"].map(LIKERT_SCALE))
+    if likert.empty:
+        return pd.DataFrame(index=pd.Index([], name="prolific_id"))
+    return likert.pivot_table(index="prolific_id", columns="question_id", values="score")
+
+
+def read_disclosures(export_directory) -> pd.DataFrame:
+    rows = []
+    for doc in iter_exports(export_directory, "survey_two_response"):
+        survey = doc["data"]
+        selected = set(survey.get("necessary_options") or [])
+        shown = survey.get("reasons") or {}
+        for key, detection in (survey.get("all_detections") or {}).items():
+            rows.append({
+                "prolific_id": doc["prolific_id"],
+                "doc_id": doc["doc_id"],
+                "timestamp": doc["timestamp"],
+                "phrase_index": int(key),
+                "category": detection["category"],
+                "priority": int(detection["priority"]),
+                "survey_display": detection["survey_display"],
+                "evidence": detection["revealation"],
+                "turn_index": detection.get("turn_index"),
+                "shown": key in shown,
+                "selected_necessary": key in selected,
+                "reasoning": shown.get(key, {}).get("reasoning"),
+            })
+    columns = ["prolific_id", "doc_id", "timestamp", "phrase_index", "category", "priority", "survey_display",
+               "evidence", "turn_index", "shown", "selected_necessary", "reasoning"]
+    disclosures = pd.DataFrame(rows, columns=columns)
+    latest_docs = latest_per_participant(disclosures[["prolific_id", "doc_id", "timestamp"]].drop_duplicates())
+    return disclosures[disclosures["doc_id"].isin(latest_docs["doc_id"])].reset_index(drop=True)
+
+
+def read_demographics(export_directory) -> pd.DataFrame:
+    rows = [
+        {"prolific_id": doc["prolific_id"], "timestamp": doc["timestamp"], **doc["data"]}
+        for doc in iter_exports(export_directory, "survey_three_response")
+    ]
+    demographics = pd.DataFrame(rows, columns=["prolific_id", "timestamp", "age_range", "gender_identity",
+                                               "highest_education", "prior_experience"])
+    demographics = latest_per_participant(demographics).drop(columns="timestamp")
+    demographics["prior_experience"] = demographics["prior_experience"].str.join("; ")
+    return demographics.set_index("prolific_id")
+
+
+def participant_metrics(turns: pd.DataFrame, disclosures: pd.DataFrame) -> pd.DataFrame:
+    """Per participant conversation, usage, disclosure and technique metrics."""
+    by_participant = turns.groupby("prolific_id")
+    is_patient = (turns["player"] == "user").to_numpy()
+    words = turns["text"].str.split().str.len().to_numpy()
+    metrics = pd.DataFrame({
+        "session_start": by_participant["started_at"].min(),
+        "session_end": by_participant["ended_at"].max(),
+        "n_turns": by_participant.size(),
+        "n_patient_turns": pd.Series(is_patient, index=turns.index).groupby(turns["prolific_id"]).sum(),
+        "patient_words": pd.Series(np.where(is_patient, words, 0), index=turns.index).groupby(turns["prolific_id"]).sum(),
+        "prompt_tokens": by_participant["prompt_tokens"].sum(min_count=1),
+        "completion_tokens": by_participant["completion_tokens"].sum(min_count=1),
+        "therapist_latency_ms": by_participant["latency_ms"].mean(),
+    })
+    metrics["session_minutes"] = (metrics["session_end"] - metrics["session_start"]) / 60
+
+    # Technique usage of the therapist
+    techniques = pd.crosstab(turns["prolific_id"], turns["technique"]).add_prefix("technique_")
+
+    # Detected disclosures per category and the participant's own judgement
+    per_category = pd.crosstab(disclosures["prolific_id"], disclosures["category"]).add_prefix("disclosed_")
+    judgements = disclosures.groupby("prolific_id").agg(
+        n_disclosures=("phrase_index", "size"),
+        n_shown=("shown", "sum"),
+        n_selected_necessary=("selected_necessary", "sum"),
+    )
+    return metrics.join([techniques, per_category, judgements], how="left")
+
+
+def session_dates(turns: pd.DataFrame) -> pd.Series:
+    """Partition key of each participant: the day the chat was saved."""
+    return turns.groupby("prolific_id")["timestamp"].max().dt.strftime("%Y-%m-%d").rename("session_date")
+
+
+def build_dataset(export_directory=EXPORT_DIRECTORY):
+    """Returns the participants, turns and disclosures tables."""
+    turns = read_turns(export_directory)
+    disclosures = read_disclosures(export_directory)
+    participants = (
+        participant_metrics(turns, disclosures)
+        .join(read_likert(export_directory), how="left")
+        .join(read_demographics(export_directory), how="left")
+    )
+
+    dates = session_dates(turns)
+    participants = participants.join(dates).reset_index()
+    turns = turns.join(dates, on="prolific_id")
+    disclosures = disclosures.join(dates, on="prolific_id")
+
+    # Participants without any disclosure have a count of zero rather than missing
+    count_columns = [c for c in participants.columns if c.startswith(("disclosed_", "technique_", "n_"))]
+    participants[count_columns] = participants[count_columns].fillna(0).astype(int)
+    return {"participants": participants, "turns": turns, "disclosures": disclosures}
+
+
+def write_dataset(tables, dataset_directory=DATASET_DIRECTORY):
+    for name, table in tables.items():
+        path = os.path.join(dataset_directory, name)
+        table.to_parquet(path, partition_cols=["session_date"], index=False,
+                         existing_data_behavior="delete_matching")
+        logging.info("Wrote %d rows to %s", len(table), path)
+
+
+def load_study(dataset_directory=DATASET_DIRECTORY, tables=TABLES):
+    """Load the dataset tables, each in a single columnar read."""
+    return {name: pd.read_parquet(os.path.join(dataset_directory, name)) for name in tables}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the study dataset from the exported files.")
+    parser.add_argument("--export", default=EXPORT_DIRECTORY, help="Directory of the exported files")
+    parser.add_argument("--output", default=DATASET_DIRECTORY, help="Directory of the Parquet dataset")
+    args = parser.parse_args()
+
+    tables = build_dataset(args.export)
+    write_dataset(tables, args.output)
+    for name, table in tables.items():
+        print(f"{name}: {len(table)} rows")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
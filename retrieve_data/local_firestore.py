@@ -0,0 +1,176 @@
+"""
+In-memory stand-in for the subset of the Firestore client used by the export.
+
+It supports `collection().where().order_by().start_after().limit().select().stream()`,
+with `__name__` for the document id, sub-collections and batches, so `FirestoreStorage` and the export can be exercised
+offline. To run against the real API surface without credentials, start the
+Firestore emulator and set FIRESTORE_EMULATOR_HOST instead; firebase_admin picks
+it up automatically.
+"""
+import copy
+import json
+import operator
+from datetime import datetime, timezone
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    ">=": operator.ge,
+    ">": operator.gt,
+}
+
+
+class LocalDocumentSnapshot:
+    def __init__(self, doc_id, data, fields=None):
+        self.id = doc_id
+        self._data = data
+        self._fields = fields
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def get(self, field):
+        return self._data.get(field)
+
+    def to_dict(self):
+        if self._fields is None:
+            return copy.deepcopy(self._data)
+        return {k: copy.deepcopy(v) for k, v in self._data.items() if k in self._fields}
+
+
+# Replaced by the write time, like firestore.SERVER_TIMESTAMP
+SERVER_TIMESTAMP = object()
+
+
+class LocalDocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def set(self, data):
+        data = {
+            key: datetime.now(timezone.utc) if value is SERVER_TIMESTAMP else copy.deepcopy(value)
+            for key, value in data.items()
+        }
+        self._collection._docs[self.id] = data
+
+    def collection(self, name):
+        return self._collection._db.collection(f"{self._collection.name}/{self.id}/{name}")
+
+    def get(self):
+        return LocalDocumentSnapshot(self.id, self._collection._docs.get(self.id))
+
+
+def _field_value(doc_id, data, field):
+    return doc_id if field == "__name__" else data.get(field)
+
+
+class LocalQuery:
+    def __init__(self, collection, filters=(), order=(), cursor=None, count=None, fields=None):
+        self._collection = collection
+        self._filters = filters
+        self._order = order
+        self._cursor = cursor
+        self._count = count
+        self._fields = fields
+
+    def _copy(self, **kwargs):
+        state = dict(filters=self._filters, order=self._order, cursor=self._cursor,
+                     count=self._count, fields=self._fields)
+        state.update(kwargs)
+        return LocalQuery(self._collection, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, _OPERATORS[op], value),))
+
+    def order_by(self, field):
+        return self._copy(order=self._order + (field,))
+
+    def start_after(self, cursor):
+        return self._copy(cursor=cursor)
+
+    def limit(self, count):
+        return self._copy(count=count)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def stream(self):
+        docs = [
+            (doc_id, data) for doc_id, data in self._collection._docs.items()
+            if all(field in data and op(data[field], value) for field, op, value in self._filters)
+        ]
+        # Firestore drops the documents without an ordered field and orders ties
+        # by document id, which is what makes cursors stable
+        order = [field for field in self._order if field != "__name__"]
+        docs = [d for d in docs if all(field in d[1] for field in order)]
+        docs.sort(key=lambda d: tuple(d[1][field] for field in order) + (d[0],))
+        if self._cursor is not None:
+            if isinstance(self._cursor, dict):
+                # A cursor given by values covers the ordered fields it names
+                fields = [field for field in self._order if field in self._cursor]
+                cursor = tuple(self._cursor[field] for field in fields)
+            else:
+                fields = order + ["__name__"]
+                cursor = tuple(_field_value(self._cursor.id, self._cursor._data, field) for field in fields)
+            docs = [d for d in docs if tuple(_field_value(*d, field) for field in fields) > cursor]
+        if self._count is not None:
+            docs = docs[:self._count]
+        for doc_id, data in docs:
+            yield LocalDocumentSnapshot(doc_id, data, self._fields)
+
+
+class LocalCollection(LocalQuery):
+    def __init__(self, db, name):
+        self._db = db
+        self.name = name
+        self._docs = {}
+        super().__init__(self)
+
+    def document(self, doc_id):
+        return LocalDocumentReference(self, doc_id)
+
+
+class LocalWriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference, data):
+        self._writes.append((reference, data))
+
+    def commit(self):
+        for reference, data in self._writes:
+            reference.set(data)
+
+
+class LocalFirestore:
+    SERVER_TIMESTAMP = SERVER_TIMESTAMP
+
+    def __init__(self):
+        self._collections = {}
+
+    def collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = LocalCollection(self, name)
+        return self._collections[name]
+
+    def batch(self):
+        return LocalWriteBatch()
+
+    @classmethod
+    def from_json(cls, path):
+        """
+        Load a dump of the form {collection: {doc_id: document}}.
+        `timestamp` values are ISO strings and are parsed into datetimes.
+        """
+        with open(path) as f:
+            dump = json.load(f)
+        db = cls()
+        for name, docs in dump.items():
+            for doc_id, data in docs.items():
+                if isinstance(data.get("timestamp"), str):
+                    data["timestamp"] = datetime.fromisoformat(data["timestamp"])
+                db.collection(name).document(doc_id).set(data)
+        return db
@@ -1,163 +1,95 @@
 import os
+import sys
 import json
 import logging
-import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-# Load credentials from secrets.toml file in .streamlit
-firebase_credentials_dict = dict(st.secrets["firebase_service_account"])
-credentials = credentials.Certificate(firebase_credentials_dict)
-
-# Initialize the Firebase Admin app with credentials
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(credentials)
-
-# Initialize Firestore client
-db = firestore.client()
-
-def retrive_all_survey_one():
-    try:
-        # Reference the collection
-        survey_collection = db.collection("group_two_survey_one_responses")
-        docs = survey_collection.stream()
-        
-        # Retrieve all survey responses and save each to a separate file
-        for doc in docs:
-            survey_data = doc.to_dict()
-            survey_response = survey_data["survey_data"]
-            prolific_id = survey_data["prolific_id"]
-            
-            # Store each survey response in a separate JSON file
-            output_directory = "retrieve_data/data"
-            os.makedirs(output_directory, exist_ok=True)
-            with open(os.path.join(output_directory, f"survey_one_response_{prolific_id}.json"), "w") as outfile:
-                json.dump(survey_response, outfile)
-                
-        logging.info("All survey responses successfully retrieved and stored locally in separate files.")
-        return True
-
-    except Exception as e:
-        logging.error(f"Failed to retrieve survey responses from Firebase Firestore: {e}")
-        return None
-
-
-def retrive_all_survey_two():
+import argparse
+
+sys.path.append("./")
+from therapy_system.envs.transcript import transcript_from_log_str, transcript_to_dict
+from therapy_system.storage import (
+    get_storage, CHAT_HISTORIES, SURVEY_ONE_RESPONSES, SURVEY_TWO_RESPONSES, SURVEY_THREE_RESPONSES
+)
+from study_export import CollectionSpec, atomic_write, export_all
+
+OUTPUT_DIRECTORY = "retrieve_data/data"
+
+
+def get_firestore_storage():
+    """Firestore backend with the credentials in the .streamlit secrets."""
+    import streamlit as st
+
+    # Load credentials from secrets.toml file in .streamlit
+    firebase_credentials_dict = dict(st.secrets["firebase_service_account"])
+    return get_storage({"name": "firestore", "credentials": firebase_credentials_dict})
+
+
+def chat_transcript(chat_data):
     """
-    Retrieve all survey two responses from Firestore and save each to a separate file.
+    Structured transcript of the chat. Sessions recorded before the
+    structured transcript existed are backfilled from the log.
     """
-    try:
-        # Reference the collection
-        survey_collection = db.collection("group_two_survey_two_responses")
-        docs = survey_collection.stream()
-
-        # Store each survey response in a separate JSON file
-        output_directory = "retrieve_data/data"
-        os.makedirs(output_directory, exist_ok=True)
-
-        # Retrieve all survey responses and save each to a separate file
-        for doc in docs:
-            survey_data = doc.to_dict()
-            prolific_id = survey_data["prolific_id"]
-            survey_response = {}
-            survey_response['all_detections'] = survey_data["complete_detections"]
-            survey_response['necessary_options'] = survey_data["user_selections"]
-            survey_response['reasons'] = survey_data['survey_info']
-
-            # Store each survey response in a separate JSON file
-            with open(os.path.join(output_directory, f"survey_two_response_{prolific_id}.json"), "w") as outfile:
-                json.dump(survey_response, outfile)
-
-        logging.info("All survey responses successfully retrieved and stored locally in separate files.")
-        return True
-
-    except Exception as e:
-        logging.error(f"Failed to retrieve survey responses from Firebase Firestore: {e}")
-        return None
-
-
-def retrive_all_survey_three():
-    try:
-        # Reference the collection
-        survey_collection = db.collection("group_two_survey_three_responses")
-        docs = survey_collection.stream()
-        
-        # Retrieve all survey responses and save each to a separate file
-        for doc in docs:
-            survey_data = doc.to_dict()
-            survey_response = survey_data["survey_data"]
-            prolific_id = survey_data["prolific_id"]
-            
-            # Store each survey response in a separate JSON file
-            output_directory = "retrieve_data/data"
-            os.makedirs(output_directory, exist_ok=True)
-            with open(os.path.join(output_directory, f"survey_three_response_{prolific_id}.json"), "w") as outfile:
-                json.dump(survey_response, outfile)
-                
-        logging.info("All survey responses successfully retrieved and stored locally in separate files.")
-        return True
-
-    except Exception as e:
-        logging.error(f"Failed to retrieve survey responses from Firebase Firestore: {e}")
-        return None
-
-
-# Define the function to retrieve all chat histories from Firestore
-def retrieve_all_chat_histories():
-    try:
-        # Reference the collection
-        chat_collection = db.collection("group_two_chat_histories")
-        docs = chat_collection.stream()
-        
-        # Retrieve all chat histories and save each to a separate file
-        for doc in docs:
-            chat_data = doc.to_dict()
-            chat_history = chat_data["chat_history"]
-            prolific_id = chat_data["prolific_id"]
-            # print(chat_data["chat_history"])
-            # print(chat_data["prolific_id"])
-            
-            # Store each chat history in a separate JSON file
-            output_directory = "retrieve_data/data"
-            os.makedirs(output_directory, exist_ok=True)
-            # Store each chat history in a separate JSON file
-            with open(os.path.join(output_directory, f"chat_history_{prolific_id}.json"), "w") as outfile:
-                json.dump(chat_history, outfile)
-            # Store each chat history in a separate text file
-            with open(os.path.join(output_directory, f"chat_history_{prolific_id}.txt"), "w") as outfile:
-                outfile.write(chat_history)
-                
-        logging.info("All chat histories successfully retrieved and stored locally in separate files.")
-        return True
-
-    except Exception as e:
-        logging.error(f"Failed to retrieve chat histories from Firebase Firestore: {e}")
-        return None
+    transcript = chat_data.get("transcript")
+    if not transcript:
+        transcript = transcript_to_dict(transcript_from_log_str(chat_data["chat_history"]))
+    return transcript
+
+
+def write_chat_history_text(output_directory, doc_id, chat_data):
+    """Store each chat history in a separate text file for reading."""
+    atomic_write(os.path.join(output_directory, f"chat_history_{doc_id}.txt"), chat_data["chat_history"])
+
+
+def survey_two_response(survey_data):
+    return {
+        'all_detections': survey_data["complete_detections"],
+        'necessary_options': survey_data["user_selections"],
+        'reasons': survey_data['survey_info'],
+    }
+
+
+COLLECTION_SPECS = [
+    CollectionSpec(CHAT_HISTORIES, "chat_history",
+                   fields=["chat_history", "transcript"],
+                   transform=chat_transcript,
+                   on_export=write_chat_history_text),
+    CollectionSpec(SURVEY_ONE_RESPONSES, "survey_one_response",
+                   fields=["survey_data"],
+                   transform=lambda survey_data: survey_data["survey_data"]),
+    CollectionSpec(SURVEY_TWO_RESPONSES, "survey_two_response",
+                   fields=["complete_detections", "user_selections", "survey_info"],
+                   transform=survey_two_response),
+    CollectionSpec(SURVEY_THREE_RESPONSES, "survey_three_response",
+                   fields=["survey_data"],
+                   transform=lambda survey_data: survey_data["survey_data"]),
+]
 
-def main():
-    # Retrieve all chat histories and survey responses
-    if retrieve_all_chat_histories():
-        print("All chat histories retrieved and saved locally.")
-    else:
-        print("No chat history found or an error occurred.")
-    
-    # Retrieve all survey one responses
-    if retrive_all_survey_one():
-        print("All survey one responses retrieved and saved locally.")
-    else:
-        print("No survey response found or an error occurred.")
 
-    # Retrieve all survey two responses
-    if retrive_all_survey_two():
-        print("All survey two responses retrieved and saved locally.")
+def main():
+    parser = argparse.ArgumentParser(description="Export the study chats and survey responses.")
+    parser.add_argument("--output", default=OUTPUT_DIRECTORY, help="Directory of the exported files")
+    parser.add_argument("--page-size", type=int, default=200, help="Documents fetched per query page")
+    parser.add_argument("--full", action="store_true", help="Ignore the checkpoint and export everything again")
+    parser.add_argument("--local", default=None,
+                        help="Export from a JSON dump with the in-memory Firestore stand-in instead of Firebase")
+    parser.add_argument("--sqlite", default=None, help="Export from the SQLite database of a local run")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        storage = get_storage({"name": "sqlite", "path": args.sqlite})
+    elif args.local:
+        from local_firestore import LocalFirestore
+        storage = get_storage({"name": "firestore", "client": LocalFirestore.from_json(args.local)})
     else:
-        print("No survey response found or an error occurred.")
+        storage = get_firestore_storage()
 
-    # Retrieve all survey three responses
-    if retrive_all_survey_three():
-        print("All survey three responses retrieved and saved locally.")
-    else:
-        print("No survey response found or an error occurred.")
+    # Retrieve all chat histories and survey responses
+    results = export_all(storage, COLLECTION_SPECS, args.output, page_size=args.page_size, full=args.full)
+    for collection, exported in results.items():
+        if exported is None:
+            print(f"An error occurred while exporting {collection}.")
+        else:
+            print(f"{exported} new documents exported from {collection}.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    main()
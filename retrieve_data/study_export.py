@@ -0,0 +1,155 @@
+"""
+Incremental export of the study collections from any `therapy_system.storage` backend.
+
+Collections are exported concurrently. Each one is read in pages ordered by
+`timestamp` and document ID (query cursors on Firestore, a single SQL query on
+SQLite), with only the fields the export needs. The `timestamp` and ID of the
+last exported document per collection are kept in a checkpoint file so that a
+rerun, or a run resuming after a crash, only fetches the documents after it.
+Documents written before the backend set `timestamp` are read in a separate
+read-only pass on the first export of their collection, and exported with a
+null `timestamp`. Every document is written atomically to its own file named after the
+document ID, so participants with several documents no longer overwrite each other.
+"""
+import os
+import json
+import logging
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+CHECKPOINT_FNAME = ".export_checkpoint.json"
+
+
+class CollectionSpec:
+    def __init__(self,
+                 collection: str,
+                 prefix: str,
+                 fields: List[str],
+                 transform: Callable[[dict], object],
+                 on_export: Callable[[str, str, dict], None] = None):
+        '''
+        collection: collection name in the storage backend
+        prefix: file name prefix of the exported documents
+        fields: projected fields, `prolific_id` and `timestamp` are always included
+        transform: maps the raw document to the exported payload
+        on_export: optional hook called with (output_directory, doc_id, document) after each write
+        '''
+        self.collection = collection
+        self.prefix = prefix
+        self.fields = sorted(set(fields) | {"prolific_id", "timestamp"})
+        self.transform = transform
+        self.on_export = on_export
+
+
+def atomic_write(path: str, content: str):
+    """Write the file next to its destination and rename it into place."""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Checkpoint:
+    """High-watermark on (`timestamp`, doc_id) per collection, shared by the export workers."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+
+    def watermark(self, collection: str) -> Tuple[Optional[datetime], Optional[str]]:
+        entry = self._state.get(collection)
+        if not entry:
+            return None, None
+        return datetime.fromisoformat(entry["timestamp"]), entry["doc_id"]
+
+    def advance(self, collection: str, timestamp: datetime, doc_id: str):
+        with self._lock:
+            self._state[collection] = {"timestamp": timestamp.isoformat(), "doc_id": doc_id}
+            atomic_write(self.path, json.dumps(self._state, indent=2))
+
+
+def write_document(spec: CollectionSpec, output_directory: str, doc_id: str, document: dict):
+    payload = {
+        "doc_id": doc_id,
+        "prolific_id": document["prolific_id"],
+        "timestamp": document["timestamp"].isoformat() if document["timestamp"] is not None else None,
+        "data": spec.transform(document),
+    }
+    atomic_write(os.path.join(output_directory, f"{spec.prefix}_{doc_id}.json"), json.dumps(payload))
+    if spec.on_export is not None:
+        spec.on_export(output_directory, doc_id, document)
+
+
+def export_collection(storage, spec: CollectionSpec, output_directory: str,
+                      checkpoint: Checkpoint, page_size: int = 200) -> int:
+    """
+    Export the documents of one collection after its watermark. The first export
+    of the collection also exports the documents written without `timestamp`.
+    Returns the number of documents written.
+    """
+    since, since_doc_id = checkpoint.watermark(spec.collection)
+    exported = 0
+    if since is None:
+        # No document is written without a timestamp anymore, they are read once
+        for doc_id, document in storage.query_unstamped(spec.collection, fields=spec.fields, page_size=page_size):
+            write_document(spec, output_directory, doc_id, document)
+            exported += 1
+        if exported:
+            logging.info("Exported %d documents without a timestamp from %s", exported, spec.collection)
+
+    documents = storage.query(spec.collection, since=since, since_doc_id=since_doc_id,
+                              fields=spec.fields, page_size=page_size)
+    last_doc = None
+    for doc_id, document in documents:
+        write_document(spec, output_directory, doc_id, document)
+        exported += 1
+        last_doc = (doc_id, document["timestamp"])
+
+        # Documents arrive in (timestamp, doc_id) order, so everything up to the last one is on disk
+        if exported % page_size == 0:
+            checkpoint.advance(spec.collection, last_doc[1], last_doc[0])
+
+    if last_doc is not None:
+        checkpoint.advance(spec.collection, last_doc[1], last_doc[0])
+    logging.info("Exported %d new documents from %s", exported, spec.collection)
+    return exported
+
+
+def export_all(storage, specs: List[CollectionSpec], output_directory: str,
+               page_size: int = 200, full: bool = False) -> Dict[str, int]:
+    """
+    Export all collections concurrently. With `full`, the checkpoint is ignored
+    and every document is fetched again.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    checkpoint_path = os.path.join(output_directory, CHECKPOINT_FNAME)
+    if full and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    with ThreadPoolExecutor(max_workers=len(specs)) as executor:
+        futures = {
+            spec.collection: executor.submit(export_collection, storage, spec, output_directory, checkpoint, page_size)
+            for spec in specs
+        }
+
+    results = {}
+    for collection, future in futures.items():
+        try:
+            results[collection] = future.result()
+        except Exception:
+            logging.exception("Failed to export %s", collection)
+            results[collection] = None
+    return results
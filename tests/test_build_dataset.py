@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "retrieve_data"))
+from build_dataset import build_dataset, load_study, write_dataset
+
+
+def turn(player, text, iteration, technique="None"):
+    return {"player": player, "text": text, "iteration": iteration, "technique": technique,
+            "started_at": 100.0 + iteration, "ended_at": 101.0 + iteration,
+            "prompt_tokens": 10, "completion_tokens": 5, "latency_ms": 200.0}
+
+
+def write_export(directory, prefix, doc_id, prolific_id, timestamp, data):
+    payload = {"doc_id": doc_id, "prolific_id": prolific_id, "timestamp": timestamp, "data": data}
+    with open(os.path.join(directory, f"{prefix}_{doc_id}.json"), "w") as f:
+        json.dump(payload, f)
+
+
+def survey_two(category):
+    return {"all_detections": {"0": {"category": category, "priority": 1, "survey_display": category,
+                                     "revealation": "evidence", "turn_index": 1}},
+            "necessary_options": ["0"], "reasons": {}}
+
+
+def export_directory(tmp_path):
+    export = tmp_path / "export"
+    export.mkdir()
+    # p1 chatted twice, the first chat was abandoned
+    write_export(export, "chat_history", "old", "p1", "2025-01-01T10:00:00+00:00",
+                 {"turns": [turn("assistant", "Hello", 0, "Reflection")]})
+    write_export(export, "chat_history", "new", "p1", "2025-01-02T10:00:00+00:00",
+                 {"turns": [turn("assistant", "Hi there", 0), turn("user", "I feel tired today", 1),
+                            turn("assistant", "Tell me more", 2, "Reflection")]})
+    write_export(export, "survey_one_response", "s1", "p1", "2025-01-02T10:30:00+00:00",
+                 [{"question_id": "q1", "statement": "The therapist understood me", "response": "agree"}])
+    # A survey part 2 answer written before documents were stamped loses to the newer one
+    write_export(export, "survey_two_response", "legacy", "p1", None, survey_two("health"))
+    write_export(export, "survey_two_response", "s2", "p1", "2025-01-02T10:40:00+00:00", survey_two("work"))
+    write_export(export, "survey_three_response", "s3", "p1", "2025-01-02T10:50:00+00:00",
+                 {"age_range": "25-34", "gender_identity": "Woman", "highest_education": "Bachelor",
+                  "prior_experience": ["Therapy", "Chatbots"]})
+    # p2 left before the surveys
+    write_export(export, "chat_history", "only", "p2", "2025-01-03T09:00:00+00:00",
+                 {"turns": [turn("assistant", "Hello", 0), turn("user", "Hi", 1)]})
+    return export
+
+
+def test_build_dataset(tmp_path):
+    tables = build_dataset(export_directory(tmp_path))
+    turns, disclosures = tables["turns"], tables["disclosures"]
+    participants = tables["participants"].set_index("prolific_id")
+
+    assert turns.loc[turns["prolific_id"] == "p1", "doc_id"].unique().tolist() == ["new"]
+    assert turns["technique"].tolist() == [None, None, "Reflection", None, None]
+    assert disclosures["doc_id"].tolist() == ["s2"]
+    assert disclosures["category"].tolist() == ["work"]
+
+    assert participants.loc["p1", "n_turns"] == 3
+    assert participants.loc["p1", "patient_words"] == 4
+    assert participants.loc["p1", "q1"] == 5
+    assert participants.loc["p1", "prior_experience"] == "Therapy; Chatbots"
+    assert participants.loc["p1", "session_date"] == "2025-01-02"
+    assert participants.loc["p2", "n_turns"] == 2
+    assert participants.loc["p2", "n_disclosures"] == 0
+    assert pd.isna(participants.loc["p2", "q1"])
+    assert pd.isna(participants.loc["p2", "age_range"])
+
+
+def comparable(table, columns):
+    table = table[columns].sort_values(columns[:2]).reset_index(drop=True).astype(object)
+    # Missing strings are read back as NaN rather than None
+    return table.where(table.notna(), None)
+
+
+def test_load_study_reproduces_the_tables(tmp_path):
+    tables = build_dataset(export_directory(tmp_path))
+    dataset = tmp_path / "dataset"
+    write_dataset(tables, dataset)
+    loaded = load_study(dataset)
+
+    for name, table in tables.items():
+        # The partition column is read back last, as a category
+        columns = list(table.columns)
+        result = loaded[name].astype({"session_date": str})
+        pd.testing.assert_frame_equal(comparable(result, columns), comparable(table, columns))
@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "webapp"))
+from chat_state import AWAITING_PATIENT, GENERATING_THERAPIST, STREAMING, ChatTurnState
+
+
+def test_reply_cut_off_while_streaming_is_kept_for_the_resume():
+    turn = ChatTurnState(state=AWAITING_PATIENT)
+    turn.send("I live in Berlin")
+    turn.patient_played()
+    turn.reply_generated("Logical Appeal", "Tell me more about Berlin.")
+    turn.move(STREAMING)
+
+    turn.resume()
+    assert turn.state == GENERATING_THERAPIST
+    assert turn.pending_reply == ("Logical Appeal", "Tell me more about Berlin.")
+
+    turn.reply_played()
+    assert turn.pending_reply is None
@@ -0,0 +1,37 @@
+from therapy_system.agents.llm.cutoff import WordCutoff, count_words
+
+# Short sentence first, then sentences of ten words
+REPLY = "I hear you. " + " ".join(
+    f"Sentence {index} has exactly ten words in it right here now." for index in range(15))
+
+
+def cut(chunks, words_limit=100):
+    cutoff = WordCutoff(words_limit)
+    return "".join(cutoff.cut(iter(chunks))), cutoff
+
+
+def test_single_chunk_is_cut_after_the_limit():
+    text, cutoff = cut([REPLY])
+    assert cutoff.fired
+    assert count_words(text) >= 100
+    assert text.endswith(".")
+    assert count_words(text) == cutoff.words
+
+
+def test_streamed_and_single_chunk_cut_alike():
+    words = REPLY.split(" ")
+    streamed, _ = cut([word + " " for word in words[:-1]] + [words[-1]])
+    single, _ = cut([REPLY])
+    assert streamed.strip() == single.strip()
+
+
+def test_reply_within_the_limit_is_kept():
+    text, cutoff = cut(["I hear you. Tell me more."])
+    assert not cutoff.fired
+    assert text == "I hear you. Tell me more."
+
+
+def test_technique_tag_is_not_counted():
+    text, cutoff = cut(["<technique>" + "word " * 200 + "</technique><response>" + REPLY])
+    assert cutoff.fired
+    assert count_words(text) >= 100
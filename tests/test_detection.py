@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import functools
+import threading
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "webapp"))
+import feedback_utils
+from therapy_system.cancellation import CancellationToken
+
+
+def stream_of(*responses):
+    """stream_response stand-in that answers each attempt with the next response."""
+    responses = iter(responses)
+    return lambda **kwargs: iter([next(responses)])
+
+
+def test_unknown_phrase_index_is_skipped(monkeypatch):
+    monkeypatch.setattr(feedback_utils, "stream_response", stream_of(
+        '{"7": {"present": "yes", "evidence": "other shard"}, "1": {"present": "yes", "evidence": "I am 28"}}'))
+    detections = list(feedback_utils.iter_shard_detections({1: "Age", 2: "Job"}, "conversation", retries=0))
+    assert detections == [(1, "I am 28")]
+
+
+def test_phrase_answered_twice_keeps_the_first_answer(monkeypatch):
+    monkeypatch.setattr(feedback_utils, "stream_response", stream_of(
+        '{"1": {"present": "no"}, "1": {"present": "yes", "evidence": "I am 28"}}'))
+    assert list(feedback_utils.iter_shard_detections({1: "Age"}, "conversation", retries=0)) == []
+
+
+SURVEY_INFO = pd.DataFrame({
+    "category": ["age", "job", "city"],
+    "category priority": [1, 2, 3],
+    "user_mentioned": ["User is 28.", "User is a marketer.", "User lives in Berlin."],
+    "survey_display": ["Age: 28", "Job: marketer", "City: Berlin"],
+})
+
+
+def all_uncertain(survey_info, conversation, indices=None):
+    indices = survey_info.index if indices is None else indices
+    return pd.DataFrame({"status": feedback_utils.UNCERTAIN, "evidence": None}, index=indices)
+
+
+def detect_in_turns(phrases, message, cancellation=None, **kwargs):
+    """Detects the age in "28", stops at a "slow" message until cancelled."""
+    if message == "slow":
+        cancellation.wait(5)
+        cancellation.raise_if_cancelled()
+    if message == "28" and 0 in phrases:
+        yield 0, "I am 28"
+
+
+@pytest.fixture
+def turn_detection(monkeypatch):
+    monkeypatch.setattr(feedback_utils, "prefilter_phrases", all_uncertain)
+    monkeypatch.setattr(feedback_utils, "iter_shard_detections", detect_in_turns)
+    monkeypatch.setattr(feedback_utils, "get_script_run_ctx", lambda: None)
+
+
+def test_turns_not_checked_in_time_are_failed(turn_detection):
+    detector = feedback_utils.IncrementalDetector(SURVEY_INFO)
+    for turn_index, message in enumerate(["28", "slow", "queued"]):
+        detector.submit(turn_index, message)
+    detections, failed_turns = detector.finish(timeout=0.2)
+    assert list(detections) == ["0"]
+    assert failed_turns == {1: "slow", 2: "queued"}
+
+
+def test_failed_turns_are_detected_again(turn_detection, monkeypatch):
+    calls = []
+
+    def detect_disclosures(survey_info, conversation, **kwargs):
+        calls.append((list(survey_info.index), conversation))
+        return {"2": feedback_utils.detection_record(survey_info, 2, "Berlin")}, []
+
+    monkeypatch.setattr(feedback_utils, "detect_disclosures", detect_disclosures)
+    detector = feedback_utils.IncrementalDetector(SURVEY_INFO)
+    for turn_index, message in enumerate(["28", "slow"]):
+        detector.submit(turn_index, message)
+    detector.finish = functools.partial(detector.finish, timeout=0.2)
+    values = feedback_utils.prepare_detections(detector, SURVEY_INFO, "28\nslow")
+    assert calls == [([1, 2], "slow")]
+    assert list(values["complete_detections"]) == ["0", "2"]
+    assert values["detection_failed_turns"] == [1]
+
+
+def test_finish_stops_once_cancelled(turn_detection):
+    detector = feedback_utils.IncrementalDetector(SURVEY_INFO)
+    for turn_index, message in enumerate(["28", "slow", "queued"]):
+        detector.submit(turn_index, message)
+    job = CancellationToken()
+    threading.Timer(0.2, job.cancel).start()
+    started = time.monotonic()
+    detections, failed_turns = detector.finish(cancellation=job)
+    assert time.monotonic() - started < 2
+    assert list(detections) == ["0"]
+    assert failed_turns == {1: "slow", 2: "queued"}
+
+
+def test_prefilter_leaves_paraphrases_to_the_llm():
+    statuses = feedback_utils.prefilter_phrases(SURVEY_INFO, "I'm in my late 20s and I'm a marketer")
+    assert set(statuses["status"]) == {feedback_utils.UNCERTAIN}
@@ -0,0 +1,29 @@
+import os
+import sys
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "webapp"))
+import perf
+import webapp.perf
+from therapy_system.metrics import REGISTRY, SESSION_PHASES
+
+
+def set_phase(module, session_id, phase):
+    ctx = mock.Mock(session_id=session_id)
+    with mock.patch.object(module, "get_script_run_ctx", return_value=ctx), \
+            mock.patch.object(module.st, "session_state", {"phase": phase}):
+        module.track_session_phase()
+
+
+def test_active_sessions_are_counted_from_every_import_name():
+    set_phase(perf, "chat_session", "chat")
+    set_phase(webapp.perf, "survey_session", "post_survey")
+    rendered = REGISTRY.render()
+    assert 'therapy_active_sessions{phase="chat"} 1' in rendered
+    assert 'therapy_active_sessions{phase="post_survey"} 1' in rendered
+
+
+def test_closed_sessions_are_not_counted():
+    set_phase(perf, "closed_session", "initial")
+    with mock.patch.object(SESSION_PHASES, "is_open", lambda session_id: session_id != "closed_session"):
+        assert SESSION_PHASES.counts()[("initial",)] == 0
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+from datetime import datetime, timezone
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "retrieve_data"))
+from local_firestore import LocalFirestore
+from study_export import CHECKPOINT_FNAME, CollectionSpec, export_all
+from therapy_system.storage.firestore import FirestoreStorage
+from therapy_system.storage.sqlite import SQLiteStorage
+
+SPEC = CollectionSpec("responses", "response", fields=["answer"], transform=lambda document: document["answer"])
+TIME = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def exported(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("response_"))
+
+
+def firestore_with(documents):
+    db = LocalFirestore()
+    for doc_id, document in documents.items():
+        db.collection("responses").document(doc_id).set(document)
+    return FirestoreStorage(client=db)
+
+
+def test_documents_without_timestamp_are_exported(tmp_path):
+    storage = firestore_with({
+        "legacy": {"prolific_id": "p1", "answer": 1},
+        "stamped": {"prolific_id": "p2", "answer": 2, "timestamp": TIME},
+    })
+    assert export_all(storage, [SPEC], tmp_path, page_size=1) == {"responses": 2}
+    assert exported(tmp_path) == ["response_legacy.json", "response_stamped.json"]
+    with open(tmp_path / "response_legacy.json") as f:
+        assert json.load(f)["timestamp"] is None
+    # The export only reads
+    assert "timestamp" not in storage.db.collection("responses").document("legacy").get().to_dict()
+    # Later exports start from the checkpoint and do not read them again
+    assert export_all(storage, [SPEC], tmp_path) == {"responses": 0}
+
+
+def test_resume_exports_documents_sharing_the_checkpoint_timestamp(tmp_path):
+    storage = firestore_with({
+        f"doc{index}": {"prolific_id": "p", "answer": index, "timestamp": TIME} for index in range(5)
+    })
+    # A crash after the checkpoint of the first page, in the middle of the tied documents
+    with open(tmp_path / CHECKPOINT_FNAME, "w") as f:
+        json.dump({"responses": {"timestamp": TIME.isoformat(), "doc_id": "doc1"}}, f)
+    assert export_all(storage, [SPEC], tmp_path, page_size=2) == {"responses": 3}
+    assert exported(tmp_path) == ["response_doc2.json", "response_doc3.json", "response_doc4.json"]
+
+
+def test_sqlite_resumes_after_the_checkpoint_doc_id(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "study.db"))
+    storage._now = lambda: SQLiteStorage._format(TIME)
+    storage.batch_write([("responses", f"doc{index}", {"prolific_id": "p", "answer": index}) for index in range(4)])
+    resumed = [doc_id for doc_id, _ in storage.query("responses", since=TIME, since_doc_id="doc1")]
+    assert resumed == ["doc2", "doc3"]
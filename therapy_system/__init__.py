@@ -1,4 +1,27 @@
-from therapy_system.envs import make
-from therapy_system.utils import escape_special_characters, unescape_special_characters
+import importlib
 
-__all__ = ["make"]
\ No newline at end of file
+# Loaded on first access (PEP 562), so `import therapy_system` stays cheap and
+# gymnasium, the taxonomy and the LLM SDKs are only imported when used
+_LAZY_ATTRIBUTES = {
+    "make": "therapy_system.envs",
+    "escape_special_characters": "therapy_system.utils",
+    "unescape_special_characters": "therapy_system.utils",
+}
+_SUBMODULES = {"action", "agents", "envs", "storage", "utils"}
+
+__all__ = ["make"]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f"{__name__}.{name}")
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | _SUBMODULES)
@@ -1 +1,9 @@
-from .therapy import *
\ No newline at end of file
+from .therapy import *
+from .therapy import load_taxonomy
+
+
+def __getattr__(name):
+    # The taxonomy is loaded on first access, see therapy.load_taxonomy
+    if name == "TAXONOMY":
+        return load_taxonomy()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
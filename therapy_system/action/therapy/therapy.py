@@ -2,18 +2,37 @@ import json
 import os
 from therapy_system.action import Action, ActionSpace
 import random
+from functools import lru_cache
+from therapy_system.log import get_logger
 
-TAXONOMY = []
-with open(os.path.join(os.path.dirname(__file__), "persuasion_taxonomy.jsonl")) as f:
-    for line in f:
-        technique = json.loads(line)
-        # remove the ss_ prefix for the key
-        technique = {k.replace("ss_", ""): v for k, v in technique.items()}
+logger = get_logger(__name__)
+
+TAXONOMY_PATH = os.path.join(os.path.dirname(__file__), "persuasion_taxonomy.jsonl")
+
+
+@lru_cache(maxsize=None)
+def load_taxonomy():
+    """Persuasion taxonomy, read from disk on first use and shared afterwards."""
+    taxonomy = []
+    with open(TAXONOMY_PATH) as f:
+        for line in f:
+            technique = json.loads(line)
+            # remove the ss_ prefix for the key
+            technique = {k.replace("ss_", ""): v for k, v in technique.items()}
+
+            taxonomy.append(technique)
+    return taxonomy
+
+
+def __getattr__(name):
+    # `TAXONOMY` stays importable as a lazily loaded module attribute
+    if name == "TAXONOMY":
+        return load_taxonomy()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-        TAXONOMY.append(technique)
 
 def therapy_prompt(user_input, persuasion_techniques, persuasion_flag, words_limit=100):
-    print(f"Persuasion prompt {'enabled' if persuasion_flag else 'disabled'}")
+    logger.debug("Persuasion prompt %s", "enabled" if persuasion_flag else "disabled")
     # print(persuasion_techniques)
     # print(user_input)
     # print(words_limit)
@@ -85,7 +104,7 @@ class TherapyActionSpace(ActionSpace):
         elif self.strategy_idx < 0:
             return "None"
         else:
-            return TAXONOMY[self.strategy_idx]['technique']
+            return load_taxonomy()[self.strategy_idx]['technique']
         
 
 class TherapyAction(Action):
@@ -93,8 +112,8 @@ class TherapyAction(Action):
                  persuasion_technique=None
     ):
         if persuasion_technique is None:
-            persuasion_technique = random.randint(0, len(TAXONOMY) - 1)
-        self.strategy = TAXONOMY[persuasion_technique] if persuasion_technique >= 0 else None
+            persuasion_technique = random.randint(0, len(load_taxonomy()) - 1)
+        self.strategy = load_taxonomy()[persuasion_technique] if persuasion_technique >= 0 else None
 
     def __call__(self, 
                message: str, 
@@ -104,4 +123,4 @@ class TherapyAction(Action):
                words_limit: int) -> str:
         # if not self.strategy:
         #     return message
-        return therapy_prompt(message, TAXONOMY, persuasion_flag, words_limit)
\ No newline at end of file
+        return therapy_prompt(message, load_taxonomy(), persuasion_flag, words_limit)
\ No newline at end of file
@@ -1,8 +1,9 @@
 from abc import ABC, abstractmethod
 import copy
-from therapy_system.agents.llm import load_llm_agent
+from therapy_system.agents.llm import load_llm_agent, LM_Agent
 from therapy_system.action import ActionSpace
 from typing import Union, Generator
+from therapy_system.tracing import traced
 
 class Agent:
     """
@@ -41,11 +42,38 @@ class Agent:
     def update_conversation_tracking(self, entity, message):
         self.conversation.append({"role": entity, "content": message})
 
+    @traced("agent.chat")
     def chat(self, message) -> Union[str, Generator[str, None, None]]:
         self.update_conversation_tracking("user", message)
         response = self.chat_model.chat(self.conversation)
         return response
     
+    def set_ledger(self, ledger, call_site: str = None):
+        """Record the model calls of the agent in the session budget ledger, see therapy_system.budget."""
+        # Human players have no model calls
+        if isinstance(self.chat_model, LM_Agent):
+            self.chat_model.set_ledger(ledger, call_site or f"agent:{self.name}")
+
+    def set_words_limit(self, words_limit: int = None):
+        """Cut the replies of the agent after words_limit words, see therapy_system.agents.llm.cutoff."""
+        if isinstance(self.chat_model, LM_Agent):
+            self.chat_model.set_words_limit(words_limit)
+
+    def set_cancellation(self, cancellation):
+        """Skip or stop the model calls of the agent once the token is cancelled, see therapy_system.cancellation."""
+        if isinstance(self.chat_model, LM_Agent):
+            self.chat_model.set_cancellation(cancellation)
+
+    def pop_last_call(self) -> Union[dict, None]:
+        """
+        Returns the timing and usage of the last model call and clears it,
+        so a later human turn does not pick up stale usage.
+        """
+        last_call = getattr(self.chat_model, "last_call", None)
+        if last_call is not None:
+            self.chat_model.last_call = None
+        return last_call
+
     def get_persona(self):
         return self.persona
 
@@ -1,4 +1,5 @@
 from .lm_model import LM_Agent
+from .models import AWS_MODELS_MAPPING, GPT_MODELS_MAPPING
 
 def load_llm_agent(model_name, args):
     if "human" in model_name.lower():
@@ -8,8 +9,9 @@ def load_llm_agent(model_name, args):
         from therapy_system.agents.llm.openai import OpenAIAgent
         return OpenAIAgent(model_name, **args)
     else:
-        from therapy_system.agents.llm.aws import AwsAgent, AWS_MODELS_MAPPING
         if model_name in AWS_MODELS_MAPPING:
+            # boto3 is only imported when an AWS model is used
+            from therapy_system.agents.llm.aws import AwsAgent
             return AwsAgent(AWS_MODELS_MAPPING[model_name], **args)
         else:
             raise ValueError(f"Unsupported engine: {model_name}")
\ No newline at end of file
@@ -1,26 +1,10 @@
 import os
+import json
 import boto3
 from therapy_system.agents.llm import LM_Agent
 from typing import Generator
+from therapy_system.agents.llm.models import AWS_MODELS_MAPPING
 
-AWS_MODELS_MAPPING = {
-    # Claude models
-    "Claude 3 Sonnet": "anthropic.claude-3-sonnet-20240229-v1:0",
-    "Claude 3 Haiku": "anthropic.claude-3-haiku-20240307-v1:0",
-    "Claude 3.5 Sonnet": "anthropic.claude-3-5-sonnet-20240620-v1:0",
-    
-    # Cohere models
-    "Command-R": "cohere.command-r-v1:0",
-    "Command-R Plus": "cohere.command-r-plus-v1:0",
-    
-    # HuggingFace models
-    "LLaMA-3-8B-Instruct": "meta.llama3-8b-instruct-v1:0",
-    "LLaMA-3-70B-Instruct": "meta.llama3-70b-instruct-v1:0",
-    "Mistral-7B-Instruct": "mistral.mistral-7b-instruct-v0:2",
-    "Mixtral-8x7B-Instruct": "mistral.mixtral-8x7b-instruct-v0:1",
-    "Mistral Large": "mistral.mistral-large-2402-v1:0",
-    "Mistral Small": "mistral.mistral-small-2402-v1:0"
-}
 
 class AwsAgent(LM_Agent):
     def __init__(
@@ -66,8 +50,36 @@ class AwsAgent(LM_Agent):
             system=system_prompts,
             inferenceConfig=inference_config
         )
+        usage = response.get('usage', {})
+        self.record_usage(usage.get('inputTokens'), usage.get('outputTokens'))
         return response['output']['message']
     
+    def _chat_structured(self, messages, schema: dict, name: str) -> str:
+        # Bedrock enforces the schema as the input of a tool the model has to call
+        assert len(messages) > 0
+        messages, system_prompts = self.prepare_messages(messages)
+        inference_config = self.prepare_inference_config()
+        tool_config = {
+            "tools": [{"toolSpec": {"name": name, "description": f"Record the {name}",
+                                    "inputSchema": {"json": schema}}}],
+            "toolChoice": {"tool": {"name": name}},
+        }
+
+        response = self.client.converse(
+            modelId=self.engine,
+            messages=messages,
+            system=system_prompts,
+            inferenceConfig=inference_config,
+            toolConfig=tool_config,
+        )
+        usage = response.get('usage', {})
+        self.record_usage(usage.get('inputTokens'), usage.get('outputTokens'))
+        for block in response['output']['message']['content']:
+            if 'toolUse' in block:
+                return json.dumps(block['toolUse']['input'])
+        # No tool call, the text is parsed as is
+        return "".join(block.get('text', '') for block in response['output']['message']['content'])
+
     def _chat_with_stream(self, messages) -> Generator[str, None, None]:
         assert len(messages) > 0
         messages, system_prompts = self.prepare_messages(messages)
@@ -82,9 +94,14 @@ class AwsAgent(LM_Agent):
         
         stream = response.get('stream')
         if stream:
-            for event in stream:
-                if 'contentBlockDelta' in event:
-                    yield event['contentBlockDelta']['delta']['text']
-                if 'messageStop' in event:
-                    if 'stop_reason' in event['messageStop']:
-                        break
\ No newline at end of file
+            try:
+                for event in stream:
+                    if 'contentBlockDelta' in event:
+                        yield event['contentBlockDelta']['delta']['text']
+                    # The usage arrives in the metadata event after messageStop
+                    if 'metadata' in event:
+                        usage = event['metadata'].get('usage', {})
+                        self.record_usage(usage.get('inputTokens'), usage.get('outputTokens'))
+            finally:
+                # Closed early, e.g. on a word-budget cutoff, the connection is released
+                stream.close()
\ No newline at end of file
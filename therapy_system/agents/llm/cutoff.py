@@ -0,0 +1,101 @@
+"""
+Word-budget cutoff of the replies.
+
+The prompt asks for at most words_limit words, which the models often overshoot.
+The reply is counted as its chunks arrive. Once the limit is reached it is closed at
+the next sentence boundary, so neither the participant nor the budget waits on the
+extra tokens. A reply without a sentence boundary is cut at the hard limit.
+
+The text of the <technique> tag of a persuasion reply and the tags themselves are
+not counted, only the words the participant reads.
+"""
+import math
+import re
+from typing import Generator, Iterable
+
+WORD = re.compile(r"\S+")
+# Text the participant does not read, the closing tag may not have arrived yet
+UNCOUNTED = re.compile(r"<technique>.*?(?:</technique>|$)|</?\w+>", re.DOTALL)
+# End of a sentence, followed by a space or a closing tag so that 3.5 or a cut chunk does not match
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*(?=\s|<)")
+# Words past the limit before a reply without a sentence boundary is cut
+HARD_LIMIT_MARGIN = 1.25
+
+
+def count_words(text: str) -> int:
+    return len(WORD.findall(UNCOUNTED.sub(" ", text)))
+
+
+def word_start(text: str, n: int) -> int:
+    """Offset of the n-th counted word of the text, the end of the text when it has fewer words."""
+    # The uncounted text is blanked out rather than removed, so the offsets stay those of the text
+    counted = UNCOUNTED.sub(lambda match: " " * len(match.group()), text)
+    for index, word in enumerate(WORD.finditer(counted), 1):
+        if index == n:
+            return word.start()
+    return len(text)
+
+
+class WordCutoff:
+    """
+    Cuts a stream of chunks at the first sentence boundary after words_limit words,
+    or at the hard limit. fired tells whether the reply was cut.
+    """
+    def __init__(self, words_limit: int, margin: float = HARD_LIMIT_MARGIN):
+        self.words_limit = words_limit
+        self.hard_limit = math.ceil(words_limit * margin)
+        self.fired = False
+        self.words = 0
+
+    def cut(self, chunks: Iterable[str]) -> Generator[str, None, None]:
+        """
+        Yields the chunks up to the cut. The source is closed when the reply is cut,
+        which ends the provider stream.
+        """
+        text, emitted = "", 0
+        try:
+            for chunk in chunks:
+                text += chunk
+                self.words = count_words(text)
+                if self.words < self.words_limit:
+                    yield text[emitted:]
+                    emitted = len(text)
+                    continue
+
+                # Past the limit the text is held back until the sentence of the last word within it ends
+                end = self._sentence_end(text, emitted, word_start(text, self.words_limit))
+                if end is None and self.words < self.hard_limit:
+                    continue
+                self.fired = True
+                end_at = self._hard_cut(text, emitted) if end is None else end
+                self.words = count_words(text[:end_at])
+                if end_at > emitted:
+                    yield text[emitted:end_at]
+                return
+            # The reply ended by itself within the hard limit
+            if len(text) > emitted:
+                yield text[emitted:]
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    @staticmethod
+    def _sentence_end(text: str, emitted: int, start: int):
+        """
+        End of the first sentence ending from start, the offset of the words_limit-th word, that is
+        not emitted yet. A whole reply in one chunk is searched from the limit, not from its start.
+        """
+        for end in SENTENCE_END.finditer(text, start):
+            if end.end() >= emitted:
+                return end.end()
+        return None
+
+    def _hard_cut(self, text: str, emitted: int) -> int:
+        """End of the last held back word within the hard limit."""
+        end_at = emitted
+        for word in WORD.finditer(text, emitted):
+            if count_words(text[:word.end()]) > self.hard_limit:
+                break
+            end_at = word.end()
+        return end_at
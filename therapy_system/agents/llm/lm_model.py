@@ -1,7 +1,15 @@
 from abc import ABC, abstractmethod
 import copy
-from typing import Generator, Union
+import time
+from typing import Any, Generator, Union
 from therapy_system.utils import escape_special_characters, unescape_special_characters
+from therapy_system.agents.llm.structured import complete_structured, schema_instruction
+from therapy_system.agents.llm.cutoff import WordCutoff, count_words
+from therapy_system.budget import estimate_prompt_tokens, estimate_completion_tokens
+from therapy_system.cancellation import Cancelled, CANCELLATION_STATS
+from therapy_system.metrics import ERRORS
+from therapy_system.tracing import NO_SPAN, start_span
+
 class LM_Agent(ABC):
     def __init__(self,
                  engine="gpt-3.5-turbo",
@@ -12,14 +20,150 @@ class LM_Agent(ABC):
         self.engine = engine
         self.temperature = temperature
         self.max_tokens = max_tokens
-        self.stream = stream    
-    
+        self.stream = stream
+        self.last_call = None
+        # Budget of the session, see therapy_system.budget, and the call site the calls are recorded under
+        self.requested_engine = engine
+        self.ledger = None
+        self.call_site = "agent"
+        # Replies are cut at the first sentence boundary after words_limit words, None keeps them whole
+        self.words_limit = None
+        # Cancellation token of the session, see therapy_system.cancellation
+        self.cancellation = None
+        # Span of the call when the turn is traced, a stream ends it once drained
+        self._span = NO_SPAN
+
+    def set_ledger(self, ledger, call_site: str):
+        self.ledger = ledger
+        self.call_site = call_site
+
+    def set_words_limit(self, words_limit: int = None):
+        self.words_limit = words_limit
+
+    def set_cancellation(self, cancellation):
+        self.cancellation = cancellation
+
+    def _start_call(self):
+        if self.cancellation is not None and self.cancellation.cancelled:
+            # Nobody waits for the reply, the call is not made
+            CANCELLATION_STATS.record(self.call_site, self.cancellation.reason, self.max_tokens)
+            raise Cancelled(self.cancellation.reason)
+        if self.ledger is not None:
+            # Over budget, the call goes to a cheaper model of the provider
+            self.engine = self.ledger.choose_model(self.requested_engine)
+        self.last_call = {
+            "model": self.engine,
+            "started_at": time.time(),
+            "ended_at": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "latency_ms": None,
+            "words_cutoff": False,
+            "cancelled": None,
+        }
+        self._span = start_span(f"llm.{self.call_site}", model=self.engine, stream=self.stream)
 
     def chat(self, messages) -> Union[str, Generator[str, None, None]]:
+        self._start_call()
         if self.stream:
-            return escape_special_characters(self._chat_with_stream(messages))
+            return escape_special_characters(
+                self._timed_stream(self._cut_at_words(self._chat_with_stream(messages), messages), messages))
         else:
-            return escape_special_characters(self._chat(messages))
+            try:
+                response = "".join(self._cut_at_words(iter([self._chat(messages)]), messages))
+            except Exception:
+                ERRORS.inc(call_site=self.call_site)
+                raise
+            self._finish_call()
+            return escape_special_characters(response)
+
+    def _cut_at_words(self, chunks, messages) -> Generator[str, None, None]:
+        """The reply up to the word-budget cutoff, see therapy_system.agents.llm.cutoff."""
+        if self.words_limit is None:
+            yield from chunks
+            return
+        cutoff = WordCutoff(self.words_limit)
+        yield from cutoff.cut(chunks)
+        if cutoff.fired:
+            self.last_call["words_cutoff"] = True
+            self._estimate_usage(messages, cutoff.words)
+
+    def _estimate_usage(self, messages, words: int):
+        # A stream closed early has no usage, it is estimated so that the ledger stays close
+        if self.last_call["completion_tokens"] is None:
+            self.record_usage(estimate_prompt_tokens(messages), estimate_completion_tokens(words))
+
+    def _cancel_call(self, reason: str, text: str, messages):
+        self.last_call["cancelled"] = reason
+        self._estimate_usage(messages, count_words(text))
+        CANCELLATION_STATS.record(self.call_site, reason, self.max_tokens - self.last_call["completion_tokens"])
+
+    def chat_structured(self, messages, schema: dict, name: str = "response") -> Any:
+        """
+        Returns the reply as a value of the JSON schema, see therapy_system.agents.llm.structured.
+        Raises StructuredOutputError when the reply still does not parse after one repair attempt.
+        """
+        self._start_call()
+        try:
+            return complete_structured(lambda msgs: self._chat_structured(msgs, schema, name), messages, schema, name)
+        except Exception:
+            ERRORS.inc(call_site=self.call_site)
+            raise
+        finally:
+            self._finish_call()
+
+    def _chat_structured(self, messages, schema: dict, name: str) -> str:
+        """
+        Reply text for the schema. Providers override this with their schema enforcing mode,
+        by default the schema is only given in the prompt.
+        """
+        messages = copy.deepcopy(messages)
+        messages[-1]["content"] += schema_instruction(schema)
+        return self._chat(messages)
+
+    def _timed_stream(self, stream: Generator[str, None, None], messages) -> Generator[str, None, None]:
+        """
+        The call only ends once the caller has drained the stream. The stream is closed, which stops the
+        generation, when the session is cancelled or the caller stops reading, e.g. its script run was
+        interrupted. Raises Cancelled in the first case.
+        """
+        text = ""
+        try:
+            for chunk in stream:
+                if self.cancellation is not None and self.cancellation.cancelled:
+                    self._cancel_call(self.cancellation.reason, text, messages)
+                    raise Cancelled(self.cancellation.reason)
+                text += chunk
+                yield chunk
+        except GeneratorExit:
+            self._cancel_call("abandoned", text, messages)
+            raise
+        except Cancelled:
+            raise
+        except Exception:
+            ERRORS.inc(call_site=self.call_site)
+            raise
+        finally:
+            stream.close()
+            self._finish_call()
+
+    def _finish_call(self):
+        self.last_call["ended_at"] = time.time()
+        self.last_call["latency_ms"] = (self.last_call["ended_at"] - self.last_call["started_at"]) * 1000
+        self._span.end(prompt_tokens=self.last_call["prompt_tokens"], completion_tokens=self.last_call["completion_tokens"],
+                       words_cutoff=self.last_call["words_cutoff"], cancelled=self.last_call["cancelled"])
+        self._span = NO_SPAN
+        if self.ledger is not None:
+            self.ledger.record(self.call_site, self.engine, self.last_call["prompt_tokens"],
+                               self.last_call["completion_tokens"], self.last_call["latency_ms"])
+
+    def record_usage(self, prompt_tokens=None, completion_tokens=None):
+        """
+        Called by the provider implementations with the usage reported by the API
+        """
+        if self.last_call is not None:
+            self.last_call["prompt_tokens"] = prompt_tokens
+            self.last_call["completion_tokens"] = completion_tokens
 
     @abstractmethod
     def _chat(self, messages) -> str:
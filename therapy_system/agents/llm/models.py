@@ -0,0 +1,31 @@
+"""
+Display names of the supported models and their provider model ids.
+
+Kept free of provider SDK imports so the names can be listed without loading
+openai or boto3.
+"""
+
+GPT_MODELS_MAPPING = {
+    "GPT-4o-mini": "gpt-4o-mini",
+    "GPT-3.5-turbo": "gpt-3.5-turbo",
+    "GPT-4o": "gpt-4o-2024-08-06",
+}
+
+AWS_MODELS_MAPPING = {
+    # Claude models
+    "Claude 3 Sonnet": "anthropic.claude-3-sonnet-20240229-v1:0",
+    "Claude 3 Haiku": "anthropic.claude-3-haiku-20240307-v1:0",
+    "Claude 3.5 Sonnet": "anthropic.claude-3-5-sonnet-20240620-v1:0",
+    
+    # Cohere models
+    "Command-R": "cohere.command-r-v1:0",
+    "Command-R Plus": "cohere.command-r-plus-v1:0",
+    
+    # HuggingFace models
+    "LLaMA-3-8B-Instruct": "meta.llama3-8b-instruct-v1:0",
+    "LLaMA-3-70B-Instruct": "meta.llama3-70b-instruct-v1:0",
+    "Mistral-7B-Instruct": "mistral.mistral-7b-instruct-v0:2",
+    "Mixtral-8x7B-Instruct": "mistral.mixtral-8x7b-instruct-v0:1",
+    "Mistral Large": "mistral.mistral-large-2402-v1:0",
+    "Mistral Small": "mistral.mistral-small-2402-v1:0"
+}
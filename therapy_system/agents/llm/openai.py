@@ -3,12 +3,9 @@ from openai import OpenAI
 
 from therapy_system.agents.llm import LM_Agent
 from typing import Generator
+from therapy_system.agents.llm.models import GPT_MODELS_MAPPING
+from therapy_system.agents.llm.structured import response_format
 
-GPT_MODELS_MAPPING = {
-    "GPT-4o-mini": "gpt-4o-mini",
-    "GPT-3.5-turbo": "gpt-3.5-turbo",
-    "GPT-4o": "gpt-4o-2024-08-06",
-}
 
 class OpenAIAgent(LM_Agent):
     def __init__(
@@ -30,9 +27,24 @@ class OpenAIAgent(LM_Agent):
             temperature=self.temperature,
             max_tokens=self.max_tokens,
         )
+        if chat.usage is not None:
+            self.record_usage(chat.usage.prompt_tokens, chat.usage.completion_tokens)
 
         return chat.choices[0].message.content
     
+    def _chat_structured(self, messages, schema: dict, name: str) -> str:
+        chat = self.client.chat.completions.create(
+            model=self.engine,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            response_format=response_format(schema, name),
+        )
+        if chat.usage is not None:
+            self.record_usage(chat.usage.prompt_tokens, chat.usage.completion_tokens)
+
+        return chat.choices[0].message.content
+
     def _chat_with_stream(self, messages) -> Generator[str, None, None]:
         chat = self.client.chat.completions.create(
             model=self.engine,
@@ -40,7 +52,13 @@ class OpenAIAgent(LM_Agent):
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             stream=True,
+            stream_options={"include_usage": True},
         )
-        for chunk in chat:
-            if chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
\ No newline at end of file
+        # Closing the generator, e.g. on a word-budget cutoff, closes the connection and stops the generation
+        with chat:
+            for chunk in chat:
+                # The final chunk carries the usage and has no choices
+                if chunk.usage is not None:
+                    self.record_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+Structured outputs of the LLM calls.
+
+A call that returns JSON is described by a JSON schema. The providers enforce
+the schema where they can (OpenAI `response_format` json_schema, Bedrock tool
+use). The reply is parsed tolerantly, validated against the schema and, when
+that fails, the model gets one repair attempt with the error. Every outcome
+is counted per call name in the metrics, so the parse failure rate of each call is known.
+
+The schemas follow the OpenAI strict mode rules: every object lists all its
+properties in `required` and sets `additionalProperties` to false.
+"""
+import copy
+import json
+import re
+from typing import Any, Callable, Dict, List
+
+from therapy_system.metrics import counter
+
+OK, REPAIRED, FAILED = "ok", "repaired", "failed"
+
+
+class StructuredOutputError(ValueError):
+    """The reply could not be parsed into a value of the schema."""
+
+
+class ParseStats:
+    """Count of the structured output outcomes per call name, kept in the metrics of the process."""
+    def __init__(self):
+        self.outcomes = counter("therapy_structured_outputs_total", "Structured output outcomes by call name",
+                                ["name", "outcome"])
+
+    def record(self, name: str, outcome: str):
+        self.outcomes.inc(name=name, outcome=outcome)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Counts per call name with the failure rate, the share of calls whose
+        first reply did not parse, whether or not the repair succeeded.
+        """
+        counts = {}
+        for (name, outcome), count in self.outcomes.values().items():
+            counts.setdefault(name, {OK: 0, REPAIRED: 0, FAILED: 0})[outcome] = count
+        for outcomes in counts.values():
+            calls = sum(outcomes.values())
+            outcomes["calls"] = calls
+            outcomes["failure_rate"] = (outcomes[REPAIRED] + outcomes[FAILED]) / calls if calls else 0.0
+        return counts
+
+
+PARSE_STATS = ParseStats()
+
+
+def response_format(schema: dict, name: str) -> dict:
+    """OpenAI response_format enforcing the schema."""
+    return {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+
+
+def schema_instruction(schema: dict) -> str:
+    """Prompt suffix for providers without a schema mode."""
+    return ("\n\nReply with only a JSON value, without code fences or other text, "
+            f"that follows this JSON schema:\n{json.dumps(schema)}")
+
+
+def repair_prompt(error: Exception, schema: dict) -> str:
+    return (f"Your previous reply could not be used: {error}\n"
+            f"Reply again with only the corrected JSON value following this JSON schema:\n{json.dumps(schema)}")
+
+
+def close_json(text: str) -> str:
+    """
+    Complete a JSON text cut off by the token limit by closing the open string,
+    arrays and objects. A trailing comma or a dangling key is dropped.
+    """
+    stack, in_string, escaped = [], False, False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    # A value cut right after a comma or a key has nothing to keep
+    text = re.sub(r',\s*$', "", text)
+    text = re.sub(r',?\s*"[^"]*"\s*:\s*$', "", text)
+    return text + "".join(reversed(stack))
+
+
+def parse_json(text: str) -> Any:
+    """
+    Tolerant JSON parsing of a model reply: code fences and text around the value
+    are ignored and a truncated value is closed. Raises StructuredOutputError.
+    """
+    if text is None:
+        raise StructuredOutputError("No reply")
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise StructuredOutputError(f"No JSON value in the reply: {text[:200]}")
+    text = text[min(starts):]
+    decoder = json.JSONDecoder()
+    try:
+        value, _ = decoder.raw_decode(text)
+        return value
+    except json.JSONDecodeError:
+        pass
+    try:
+        value, _ = decoder.raw_decode(close_json(text.replace("```", "")))
+        return value
+    except json.JSONDecodeError as e:
+        raise StructuredOutputError(f"Malformed JSON in the reply: {e}") from e
+
+
+_TYPES = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "null": (type(None),),
+}
+
+
+def validate(value: Any, schema: dict, path: str = "$"):
+    """
+    Check the value against the subset of JSON schema used by the structured outputs:
+    type, enum, properties, required, additionalProperties, items, minItems and maxItems.
+    Raises StructuredOutputError with the path of the first mismatch.
+    """
+    types = schema.get("type")
+    if types is not None:
+        types = types if isinstance(types, list) else [types]
+        python_types = tuple(t for name in types for t in _TYPES[name])
+        # bool is an int in python but not in JSON
+        if not isinstance(value, python_types) or (isinstance(value, bool) and "boolean" not in types):
+            raise StructuredOutputError(f"{path} should be of type {'/'.join(types)}, got {json.dumps(value)[:100]}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise StructuredOutputError(f"{path} should be one of {schema['enum']}, got {json.dumps(value)[:100]}")
+
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in value:
+                raise StructuredOutputError(f"{path} is missing {key}")
+        for key, item in value.items():
+            if key in properties:
+                validate(item, properties[key], f"{path}.{key}")
+            elif schema.get("additionalProperties") is False:
+                raise StructuredOutputError(f"{path} has the unexpected property {key}")
+    elif isinstance(value, list):
+        if "minItems" in schema and len(value) < schema["minItems"]:
+            raise StructuredOutputError(f"{path} should have at least {schema['minItems']} items")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            raise StructuredOutputError(f"{path} should have at most {schema['maxItems']} items")
+        if "items" in schema:
+            for i, item in enumerate(value):
+                validate(item, schema["items"], f"{path}[{i}]")
+
+
+def parse_structured(text: str, schema: dict) -> Any:
+    value = parse_json(text)
+    validate(value, schema)
+    return value
+
+
+def complete_structured(call: Callable[[List[dict]], str], messages: List[dict], schema: dict, name: str) -> Any:
+    """
+    Get a value of the schema from call(messages), which returns the reply text.
+    A reply that does not parse gets one repair attempt with the error.
+    Raises StructuredOutputError when the repaired reply does not parse either.
+    """
+    text = call(messages)
+    try:
+        value = parse_structured(text, schema)
+        PARSE_STATS.record(name, OK)
+        return value
+    except StructuredOutputError as e:
+        error = e
+
+    repair_messages = copy.deepcopy(messages) + [
+        {"role": "assistant", "content": text or ""},
+        {"role": "user", "content": repair_prompt(error, schema)},
+    ]
+    try:
+        value = parse_structured(call(repair_messages), schema)
+    except StructuredOutputError:
+        PARSE_STATS.record(name, FAILED)
+        raise
+    PARSE_STATS.record(name, REPAIRED)
+    return value
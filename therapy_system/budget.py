@@ -0,0 +1,199 @@
+"""
+Token, latency and cost budgeting of the LLM calls of a session.
+
+Each session has a Ledger recording the tokens, estimated cost and latency of
+every call by call site, e.g. the therapist agent, the persona search or the
+survey detection. The ledger enforces a per-session cap and, with the
+process-wide StudySpend, a per-study cap: once the spend reaches DOWNGRADE_AT of
+a cap the calls are moved to a cheaper model of the same provider, so the
+participant is never refused a reply.
+
+The study spend is counted per process. It starts from zero on every restart
+unless it is seeded, e.g. from the budget totals of the stored sessions.
+"""
+import math
+import time
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+from therapy_system.log import get_logger
+from therapy_system.metrics import counter, gauge, histogram
+
+logger = get_logger(__name__)
+
+# Calls of all the sessions of the process, see therapy_system.metrics
+LLM_CALLS = counter("therapy_llm_calls_total", "Model calls by call site and model", ["call_site", "model"])
+LLM_TOKENS = counter("therapy_llm_tokens_total", "Tokens of the model calls by call site and kind", ["call_site", "kind"])
+LLM_COST = counter("therapy_llm_cost_usd_total", "Estimated cost in USD of the model calls by call site", ["call_site"])
+LLM_LATENCY = histogram("therapy_llm_call_seconds", "Latency of the model calls by call site", ["call_site"])
+DOWNGRADED_CALLS = counter("therapy_llm_downgraded_calls_total", "Calls moved to a cheaper model by the budget",
+                           ["model"])
+
+# Average tokens of an English word for the GPT and Claude tokenizers, with headroom
+TOKENS_PER_WORD = 1.4
+# Margin over the words limit before a reply is cut, the prompt limit is not strict
+WORDS_LIMIT_MARGIN = 1.25
+# Average characters of a token, to estimate the usage of a stream closed before the API reported it
+CHARS_PER_TOKEN = 4
+# Tokens of the <technique> and <response> tags and the technique name of a persuasion reply
+PERSUASION_TAGS_TOKENS = 40
+
+# Estimated USD per million prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o-2024-08-06": (2.50, 10.00),
+    "anthropic.claude-3-haiku-20240307-v1:0": (0.25, 1.25),
+    "anthropic.claude-3-sonnet-20240229-v1:0": (3.00, 15.00),
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": (3.00, 15.00),
+    "cohere.command-r-v1:0": (0.50, 1.50),
+    "cohere.command-r-plus-v1:0": (3.00, 15.00),
+    "meta.llama3-8b-instruct-v1:0": (0.30, 0.60),
+    "meta.llama3-70b-instruct-v1:0": (2.65, 3.50),
+    "mistral.mistral-7b-instruct-v0:2": (0.15, 0.20),
+    "mistral.mixtral-8x7b-instruct-v0:1": (0.45, 0.70),
+    "mistral.mistral-small-2402-v1:0": (1.00, 3.00),
+    "mistral.mistral-large-2402-v1:0": (4.00, 12.00),
+}
+
+# Cheaper model of the same provider used once a cap is reached
+DOWNGRADES = {
+    "gpt-4o": "gpt-4o-mini",
+    "gpt-4o-2024-08-06": "gpt-4o-mini",
+    "gpt-3.5-turbo": "gpt-4o-mini",
+    "anthropic.claude-3-sonnet-20240229-v1:0": "anthropic.claude-3-haiku-20240307-v1:0",
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": "anthropic.claude-3-haiku-20240307-v1:0",
+    "cohere.command-r-plus-v1:0": "cohere.command-r-v1:0",
+    "meta.llama3-70b-instruct-v1:0": "meta.llama3-8b-instruct-v1:0",
+    "mistral.mistral-large-2402-v1:0": "mistral.mistral-small-2402-v1:0",
+    "mistral.mixtral-8x7b-instruct-v0:1": "mistral.mistral-7b-instruct-v0:2",
+}
+
+# Share of a cap spent before the calls are downgraded
+DOWNGRADE_AT = 0.8
+
+
+def max_tokens_for_words(words_limit: int, persuasion_flag: bool = False) -> int:
+    """Completion token limit of a reply asked to stay within words_limit words."""
+    max_tokens = math.ceil(words_limit * TOKENS_PER_WORD * WORDS_LIMIT_MARGIN)
+    return max_tokens + PERSUASION_TAGS_TOKENS if persuasion_flag else max_tokens
+
+
+def estimate_prompt_tokens(messages: List[dict]) -> int:
+    return math.ceil(sum(len(message["content"]) for message in messages) / CHARS_PER_TOKEN)
+
+
+def estimate_completion_tokens(words: int) -> int:
+    return math.ceil(words * TOKENS_PER_WORD)
+
+
+def estimate_cost(model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> float:
+    """Estimated USD cost of a call, 0 for a model without a known price."""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return ((prompt_tokens or 0) * prompt_price + (completion_tokens or 0) * completion_price) / 1e6
+
+
+def cheapest_model(model: str) -> str:
+    """The cheapest model the model is downgraded to."""
+    while model in DOWNGRADES:
+        model = DOWNGRADES[model]
+    return model
+
+
+class StudySpend:
+    """Estimated spend of all the sessions of the process, checked against the study cap."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cost_usd = 0.0
+
+    def add(self, cost_usd: float):
+        with self._lock:
+            self.cost_usd += cost_usd
+
+    def seed(self, cost_usd: float):
+        """Start from the spend of earlier runs of the study."""
+        with self._lock:
+            self.cost_usd = cost_usd
+
+
+STUDY_SPEND = StudySpend()
+gauge("therapy_study_spend_usd", "Estimated spend in USD of the study in the process").set_function(
+    lambda: STUDY_SPEND.cost_usd)
+
+
+def _empty_totals() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "latency_ms": 0.0}
+
+
+class Ledger:
+    """
+    Tokens, estimated cost and latency of the LLM calls of one session by call site.
+    Thread-safe, the calls of the background detection are recorded from worker threads.
+    """
+    def __init__(self, session_cap_usd: float = None, study_cap_usd: float = None,
+                 study_spend: StudySpend = STUDY_SPEND):
+        self.session_cap_usd = session_cap_usd
+        self.study_cap_usd = study_cap_usd
+        self.study_spend = study_spend
+        self._lock = threading.Lock()
+        self._by_call_site = defaultdict(_empty_totals)
+        self.downgrades = 0
+
+    def record(self, call_site: str, model: str, prompt_tokens: int = None, completion_tokens: int = None,
+               latency_ms: float = None):
+        cost_usd = estimate_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            totals = self._by_call_site[call_site]
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens or 0
+            totals["completion_tokens"] += completion_tokens or 0
+            totals["cost_usd"] += cost_usd
+            totals["latency_ms"] += latency_ms or 0.0
+        self.study_spend.add(cost_usd)
+        LLM_CALLS.inc(call_site=call_site, model=model)
+        LLM_TOKENS.inc(prompt_tokens or 0, call_site=call_site, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens or 0, call_site=call_site, kind="completion")
+        LLM_COST.inc(cost_usd, call_site=call_site)
+        if latency_ms is not None:
+            LLM_LATENCY.observe(latency_ms / 1000, call_site=call_site)
+
+    @property
+    def cost_usd(self) -> float:
+        with self._lock:
+            return sum(totals["cost_usd"] for totals in self._by_call_site.values())
+
+    def over_budget(self) -> bool:
+        """True once the session or the study spent DOWNGRADE_AT of its cap."""
+        if self.session_cap_usd is not None and self.cost_usd >= DOWNGRADE_AT * self.session_cap_usd:
+            return True
+        return self.study_cap_usd is not None and self.study_spend.cost_usd >= DOWNGRADE_AT * self.study_cap_usd
+
+    def choose_model(self, model: str) -> str:
+        """The model to call, downgraded to the cheapest one of its provider when over budget."""
+        if not self.over_budget():
+            return model
+        cheaper = cheapest_model(model)
+        if cheaper != model:
+            with self._lock:
+                self.downgrades += 1
+            DOWNGRADED_CALLS.inc(model=model)
+            logger.warning("Budget reached, calling %s instead of %s", cheaper, model)
+        return cheaper
+
+    def totals(self) -> dict:
+        """Totals of the session and per call site, as stored with the session record."""
+        with self._lock:
+            by_call_site = {site: dict(totals) for site, totals in self._by_call_site.items()}
+        session = _empty_totals()
+        for totals in by_call_site.values():
+            for key in session:
+                session[key] += totals[key]
+        session.update({
+            "by_call_site": by_call_site,
+            "downgrades": self.downgrades,
+            "session_cap_usd": self.session_cap_usd,
+            "study_cap_usd": self.study_cap_usd,
+            "recorded_at": time.time(),
+        })
+        return session
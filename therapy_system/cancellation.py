@@ -0,0 +1,105 @@
+"""
+Cooperative cancellation of the model calls of a session.
+
+A session holds a CancellationToken that is cancelled once its results are not wanted
+anymore, e.g. the participant ended the therapy, left the page or closed the tab. The
+streaming loops, the helper calls and the background jobs check the token: a call not
+started yet is skipped and a running stream is closed at its next chunk, which stops the
+generation and releases the connection.
+
+The completion tokens that were not generated are counted per call site in
+CANCELLATION_STATS, as the max_tokens of the call minus the tokens already generated.
+The counts are kept in the metrics of the process.
+"""
+import time
+import threading
+from typing import Callable, Dict, List, Optional
+from therapy_system.log import get_logger
+from therapy_system.metrics import counter
+
+logger = get_logger(__name__)
+
+
+class Cancelled(RuntimeError):
+    """The work was cancelled, nobody waits for its result."""
+
+
+class CancellationToken:
+    """
+    Thread-safe cancellation flag with the reason of the cancellation.
+    A child token is cancelled with its parent, but can also be cancelled alone.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason: Optional[str] = None
+        self.cancelled_at: Optional[float] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled"):
+        """Cancel the token and run its callbacks, once. Later calls keep the first reason."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self.cancelled_at = time.time()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        logger.info("Cancelled: %s", reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Cancellation callback failed")
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Run the callback when the token is cancelled, at once when it already is."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def child(self) -> "CancellationToken":
+        child = CancellationToken()
+        self.on_cancel(lambda: child.cancel(self.reason))
+        return child
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Sleep until the token is cancelled or the timeout passed, True when it was cancelled."""
+        return self._event.wait(timeout)
+
+
+class CancellationStats:
+    """Count of the cancelled calls and the completion tokens they saved per call site, kept in the metrics."""
+    def __init__(self):
+        self.calls = counter("therapy_cancelled_calls_total", "Cancelled model calls by call site and reason",
+                             ["call_site", "reason"])
+        self.tokens_saved = counter("therapy_cancelled_tokens_saved_total",
+                                    "Completion tokens not generated by the cancelled calls", ["call_site"])
+
+    def record(self, call_site: str, reason: str, tokens_saved: int):
+        self.calls.inc(call_site=call_site, reason=reason)
+        self.tokens_saved.inc(max(0, tokens_saved or 0), call_site=call_site)
+
+    def snapshot(self) -> Dict[str, dict]:
+        counts = {}
+        for (call_site, reason), calls in self.calls.values().items():
+            site = counts.setdefault(call_site, {"calls": 0, "tokens_saved": 0, "by_reason": {}})
+            site["calls"] += calls
+            site["by_reason"][reason] = calls
+        for (call_site,), tokens_saved in self.tokens_saved.values().items():
+            if call_site in counts:
+                counts[call_site]["tokens_saved"] = tokens_saved
+        return counts
+
+
+CANCELLATION_STATS = CancellationStats()
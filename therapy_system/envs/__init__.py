@@ -1,12 +1,33 @@
-from therapy_system.envs.alternating_conv import Turn, AlternatingConv
-from therapy_system.envs.conversation import Conv
-from therapy_system.envs.therapy import Therapy
+import importlib
+from therapy_system.envs.transcript import TurnRecord, TRANSCRIPT_SCHEMA_VERSION
 
-def make(env_name, **kwargs) -> Conv:
+# The environments depend on gymnasium and are loaded on first access (PEP 562)
+_LAZY_ATTRIBUTES = {
+    "Turn": "therapy_system.envs.alternating_conv",
+    "AlternatingConv": "therapy_system.envs.alternating_conv",
+    "Conv": "therapy_system.envs.conversation",
+    "Therapy": "therapy_system.envs.therapy",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+
+def make(env_name, **kwargs) -> "Conv":
     '''
     Defining the environment
     '''
     if env_name == "Therapy":
+        from therapy_system.envs.therapy import Therapy
         return Therapy(**kwargs)
     else:
-        raise NotImplementedError(f"Environment {env_name} not found")
\ No newline at end of file
+        raise NotImplementedError(f"Environment {env_name} not found")
@@ -6,7 +6,20 @@ from enum import Enum
 from typing import Union, Generator
 from typing import Tuple
 import re
+import time
+from therapy_system.agents.llm.structured import PARSE_STATS, OK, FAILED
+from therapy_system.envs.scheduler import Schedule, Scheduler
+from therapy_system.envs.opening_pool import OpeningPool, OpeningKey, Opening
+from therapy_system.agents.llm import LM_Agent
+from therapy_system.log import get_logger
+from therapy_system.tracing import traced
 
+logger = get_logger(__name__)
+
+# The closing tag may be missing at the end of a reply cut by the token limit
+TECHNIQUE_TAG = re.compile(r"<technique>(.*?)(?:</technique>|$)", re.DOTALL)
+RESPONSE_TAG = re.compile(r"<response>(.*?)(?:</response>|$)", re.DOTALL)
+PERSUASION_TAGS = re.compile(r"</?(?:technique|response)>")
 # create enum for game state
 class Turn(Enum):
     ASSISTANT = 0
@@ -41,6 +54,10 @@ class AlternatingConv(Conv):
                  log_dir=".logs",
                  log_path=None,
                  game_state=None,
+                 schedule: Schedule = None,
+                 ledger=None,
+                 opening_pool: OpeningPool = None,
+                 cancellation=None,
     ):
         '''
         agents: List of agents with their respective configurations
@@ -50,16 +67,41 @@ class AlternatingConv(Conv):
             "system_message": SYSTEM_MESSAGE,
             "action_space": ACTION_SPACE}, 
         ]
+        schedule: speakers and side agents of each step, the speakers of transit alternate without
+        side agents by default, see therapy_system.envs.scheduler
+        ledger: budget ledger of the session the model calls of the agents are recorded in, see therapy_system.budget
+        opening_pool: pre-generated openings served as the first reply of the speaker, see therapy_system.envs.opening_pool
+        cancellation: token of the session, once cancelled the model calls are skipped or stopped and the side
+        agents dropped, see therapy_system.cancellation
         '''
         super().__init__(log_dir, log_path)
         self.state = 0
-        self.transit = transit
+        self.schedule = schedule if schedule is not None else Schedule.alternating(transit)
+        self.transit = self.schedule.transit
         self.persuasion_flag = persuasion_flag
         self.words_limit = words_limit
         self.game_state = game_state if game_state is not None else []
         self.init_message = init_message
 
-        self.players = self.init_players(agents, self.game_state, transit)
+        self.players = self.init_players(agents, self.game_state, self.transit)
+        self.scheduler = Scheduler(self.schedule, self.players)
+        self.opening_pool = opening_pool
+        # Opening served from the pool at state 0, its call is written with the turn
+        self.opening: Opening = None
+        self.ledger = ledger
+        if ledger is not None:
+            for player in self.players.values():
+                player.set_ledger(ledger)
+        self.cancellation = None
+        if cancellation is not None:
+            self.set_cancellation(cancellation)
+
+    def set_cancellation(self, cancellation):
+        """Use the token for the next model calls, e.g. a new one when a paused conversation goes on."""
+        self.cancellation = cancellation
+        for player in self.players.values():
+            player.set_cancellation(cancellation)
+        cancellation.on_cancel(self.scheduler.cancel)
 
     def read_iteration_message(self, iteration):
         message = self.game_state[iteration].get(
@@ -71,35 +113,32 @@ class AlternatingConv(Conv):
         action_space = self.transit[self.state]
         return self.players[action_space].action_space.sample()
 
-    def extract_persuasion_response(self, text):
+    def extract_persuasion_response(self, text, cut: bool = False):
         """
         Extracts the 'technique' and 'response' from a text string with specific XML-like tags.
+        Tags spanning several lines and a missing closing tag at the end are accepted, and no
+        tag is left in the response text. A reply cut at the words limit is well formed
+        without its closing </response> tag.
         """
         # Convert `chat_response` to a single string if it is a generator
         chat_response_str = ''.join(text) if isinstance(text, Generator) else text
 
-        print(f"Chat response: {chat_response_str}")
-        # If tags not found, use entire response as response_text with no technique
-        technique = re.search(r"<technique>(.*?)</technique>", chat_response_str)
-        response = re.search(r"<response>(.*?)</response>", chat_response_str)
-        
-        if not technique and not response:
-            # No tags found - use full response as response text
-            technique_text = None
-            response_text = chat_response_str
-        elif not technique:
-            # Only response tag found
+        logger.debug("Chat response: %s", chat_response_str)
+        technique = TECHNIQUE_TAG.search(chat_response_str)
+        response = RESPONSE_TAG.search(chat_response_str)
+
+        technique_text = technique.group(1).strip() if technique else None
+        if response:
             response_text = response.group(1)
-            technique_text = None 
-        elif not response:
-            # Only technique tag found
-            technique_text = technique.group(1)
-            response_text = chat_response_str
         else:
-            # Both tags found
-            technique_text = technique.group(1)
-            response_text = response.group(1)
+            # No response tag - use the text outside the technique tag as the response
+            response_text = TECHNIQUE_TAG.sub("", chat_response_str)
+        response_text = PERSUASION_TAGS.sub("", response_text).strip()
 
+        # Both tags closed is the expected format, anything else is a parse failure
+        well_formed = bool(technique and technique.group(0).endswith("</technique>")
+                           and response and (cut or response.group(0).endswith("</response>")))
+        PARSE_STATS.record("persuasion_response", OK if well_formed else FAILED)
         return technique_text, response_text
 
     
@@ -111,34 +150,70 @@ class AlternatingConv(Conv):
     
 
     # def get_response(self, action: Action) -> Union[str, Generator[str, None, None]]:
+    @traced("env.get_response")
     def get_response(self, action: Action) -> Tuple[str, Union[str, Generator[str, None, None]]]:
         next = self.transit[self.state]
         # Print current state index and next player for debugging
         # print(f"Current state index: {self.state}")
         # print(f"Next player to act: {next}")
+        last_message = self.read_iteration_message(self.state)
+        # The side agents of the step run while the speaker replies
+        self.scheduler.fan_out(self.state, last_message)
         if (self.state == 0) and (self.init_message):
             response = self.init_message
         else:
-            last_message = self.read_iteration_message(self.state)
             # adding persona, conversation history
             persona = self.players[next].get_persona()
             conversation = self.players[next].get_conversation()
 
             prompt = action(last_message, persona, conversation, self.persuasion_flag, self.words_limit)
 
-            response = self.players[next].chat(prompt)
+            self.opening = self.take_opening(next, prompt) if self.state == 0 else None
+            if self.opening is not None:
+                self.players[next].update_conversation_tracking("user", prompt)
+                response = self.opening.response
+                if self.players[next].chat_model.stream:
+                    response = (x for x in [response])
+            else:
+                response = self.players[next].chat(prompt)
         
         # Extract technique if persuasion_flag is set
         technique = None
         if self.persuasion_flag:
-            technique, response = self.extract_persuasion_response(response)
-            print(f"In alternating conversation: {technique}, {response}")
+            response = ''.join(response) if isinstance(response, Generator) else response
+            # A reply cut at the words limit has lost its closing </response> tag
+            if self.opening is not None:
+                call = self.opening.call
+            else:
+                call = getattr(self.players[next].chat_model, "last_call", None) or {}
+            technique, response = self.extract_persuasion_response(response, cut=call.get("words_cutoff", False))
+            logger.debug("Persuasion technique %s of the response: %s", technique, response)
             # self.update_technique_in_game_state(technique)
             return technique, (x for x in [response])
         
         return technique, response
 
+    def discard_response(self):
+        """
+        Forget a response asked for with get_response but never stepped with, e.g. cut off by a
+        cancellation, so that asking again does not leave its prompt twice in the conversation.
+        """
+        self.opening = None
+        conversation = self.players[self.transit[self.state]].get_conversation()
+        if conversation and conversation[-1]["role"] == "user":
+            conversation.pop()
+
+    def take_opening(self, name: str, prompt: str) -> Union[Opening, None]:
+        """A pre-generated opening of the player for the prompt, None without a pool or when none is ready."""
+        player = self.players[name]
+        # Human players have no model calls
+        if self.opening_pool is None or not isinstance(player.chat_model, LM_Agent):
+            return None
+        key = OpeningKey(player.engine, self.persuasion_flag, player.chat_model.words_limit, player.system, prompt)
+        return self.opening_pool.take(key)
 
+
+    @traced("env.step")
     def step(self, action: Action, technique: str = None, response: str = None):
         """
         Should return (observagtion: ObsType, reward: float, terminated: bool, truncated: bool, info: dict)
@@ -149,6 +224,8 @@ class AlternatingConv(Conv):
 
         if response is None:
             technique, response = self.get_response(action)
+        else:
+            self.scheduler.fan_out(self.state, self.read_iteration_message(self.state))
         
         self.players[next].update_conversation_tracking("assistant", response)
 
@@ -164,14 +241,46 @@ class AlternatingConv(Conv):
             reward=reward, 
             terminated=terminated,
             truncated=truncated,
-            persuasion_technique=technique
+            persuasion_technique=technique,
+            call=self.pop_turn_call(next),
         )
             # persuasion_technique=technique)
+
+        # Side agents alongside the speaker are gathered with the turn, those on its reply on later turns
+        self.record_side_agents(self.state, self.scheduler.gather(self.state, after_speaker=False))
+        self.scheduler.fan_out(self.state, response, after_speaker=True)
+        for state, outcomes in self.scheduler.gather_finished().items():
+            self.record_side_agents(state, outcomes)
+        if terminated or truncated:
+            self.finish_side_agents()
         
         self.get_next_player()
+        # The side agents of the next step start on this reply, e.g. while the patient types
+        self.scheduler.fan_out(self.state, response)
 
         return response, reward, terminated, truncated, info
     
+    def pop_turn_call(self, name: str) -> Union[dict, None]:
+        """The model call of the turn, that of the opening when it was served from the pool."""
+        call = self.players[name].pop_last_call()
+        if self.opening is not None:
+            call, self.opening = self.opening.call, None
+        return call
+
+    def record_side_agents(self, state: int, outcomes: dict):
+        """Add the outcomes of the side agents to the game state of the step."""
+        if not outcomes:
+            return
+        for entry in reversed(self.game_state):
+            if entry.get("current_iteration") == state:
+                entry.setdefault("side_agents", {}).update(outcomes)
+                return
+
+    def finish_side_agents(self):
+        """Gather the side agents still running, e.g. before the game state is saved."""
+        for state, outcomes in self.scheduler.gather_all().items():
+            self.record_side_agents(state, outcomes)
+
     def get_info(self) -> dict:
         return {
             "name": self.players[self.transit[self.state]].name
@@ -186,8 +295,13 @@ class AlternatingConv(Conv):
                          reward: int,
                          terminated: bool,
                          truncated: bool, 
-                         persuasion_technique: str = None):
-            
+                         persuasion_technique: str = None,
+                         call: dict = None):
+        ended_at = time.time()
+        # A human turn starts when the previous turn was written
+        previous_end = self.game_state[-1].get("ended_at") if self.game_state else None
+        call = call or {}
+
         curr_state = dict(
             current_iteration=self.state,
             response=response,
@@ -196,7 +310,15 @@ class AlternatingConv(Conv):
             terminated=terminated,
             truncated=truncated,
             action=player.action_space,
-            persuasion_technique=persuasion_technique
+            persuasion_technique=persuasion_technique,
+            started_at=call.get("started_at", previous_end),
+            ended_at=call.get("ended_at") or ended_at,
+            model=call.get("model"),
+            prompt_tokens=call.get("prompt_tokens"),
+            completion_tokens=call.get("completion_tokens"),
+            latency_ms=call.get("latency_ms"),
+            words_cutoff=call.get("words_cutoff", False),
+            pre_generated=call.get("pre_generated", False),
         )
         self.game_state.append(curr_state)
     
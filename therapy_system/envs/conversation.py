@@ -7,7 +7,7 @@ from typing import List
 from abc import ABC, abstractmethod
 from therapy_system.agents import Agent
 from therapy_system.action import Action, ActionSpace
-from therapy_system.action.therapy import TAXONOMY
+from therapy_system.envs.transcript import TurnRecord, transcript_to_dict
 from gymnasium import Env
 from gymnasium.core import ObsType, ActType
 from typing import Union, Generator
@@ -110,6 +110,26 @@ class Conv(Env, ABC):
         # with open(os.path.join(self.log_path, "game_state.json"), "w") as f:
         #     json.dump(self.to_dict(), f, cls=GameEncoder, indent=2)
 
+    def get_transcript(self) -> List[TurnRecord]:
+        """
+        Structured, versioned view of the conversation turns
+        """
+        return [
+            TurnRecord.from_game_state(state)
+            for state in self.game_state[1:]
+            if state["current_iteration"] != "END"
+        ]
+
+    def log_transcript(self) -> dict:
+        """
+        Serializable transcript document, written next to the human readable log
+        """
+        Path(self.log_path).mkdir(parents=True, exist_ok=True)
+        transcript = transcript_to_dict(self.get_transcript())
+        with open(os.path.join(self.log_path, "transcript.json"), "w") as f:
+            json.dump(transcript, f)
+        return transcript
+
     def log_human_readable_state(self): 
         """
         easy to inspect log file
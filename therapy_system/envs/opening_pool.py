@@ -0,0 +1,120 @@
+"""
+Warm pool of pre-generated opening messages.
+
+The first therapist turn is generated from the same system prompt and the same prompt
+on an empty patient message for every participant, so it does not have to wait on a
+live call right after the login. The pool keeps a few openings per configuration,
+i.e. the engine, persuasion flag, words limit, system prompt and prompt, and serves
+each of them once. Every opening taken or warmed up is replaced in the background.
+
+The openings are generated with a ledger of the pool, their cost counts towards the
+study spend but not towards the session that is served.
+"""
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Optional
+
+from therapy_system.budget import Ledger, max_tokens_for_words
+from therapy_system.log import get_logger
+from therapy_system.metrics import counter, gauge
+
+logger = get_logger(__name__)
+
+OPENING_TAKES = counter("therapy_opening_pool_takes_total", "Openings asked from the pool, hit when one was ready",
+                        ["result"])
+
+OPENING_POOL_SIZE = 4 # openings kept ready per configuration
+OPENING_POOL_WORKERS = 2 # openings generated at once for all the configurations
+
+
+@dataclass(frozen=True)
+class OpeningKey:
+    engine: str
+    persuasion_flag: bool
+    words_limit: Optional[int]
+    system: str
+    prompt: str
+
+
+@dataclass
+class Opening:
+    response: str
+    # Model call of the generation, as in LM_Agent.last_call
+    call: dict = field(default_factory=dict)
+
+
+class OpeningPool:
+    """Openings ready to serve by configuration, refilled on a small thread pool."""
+    def __init__(self, size: int = OPENING_POOL_SIZE, max_workers: int = OPENING_POOL_WORKERS):
+        self.size = size
+        self.ledger = Ledger()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="opening_pool")
+        self._lock = threading.Lock()
+        self._openings: Dict[OpeningKey, Deque[Opening]] = {}
+        self._generating: Dict[OpeningKey, int] = {}
+        gauge("therapy_opening_pool_ready", "Openings ready to serve").set_function(
+            lambda: sum(map(len, list(self._openings.values()))))
+        gauge("therapy_opening_pool_generating", "Openings being generated or queued").set_function(
+            lambda: sum(list(self._generating.values())))
+
+    def take(self, key: OpeningKey) -> Optional[Opening]:
+        """
+        An opening of the configuration, None when none is ready yet. The call of the
+        opening records that it was pre-generated and that the participant did not wait on it.
+        """
+        with self._lock:
+            openings = self._openings.get(key)
+            opening = openings.popleft() if openings else None
+        self.warm(key)
+        if opening is None:
+            OPENING_TAKES.inc(result="miss")
+            logger.info("No opening ready for %s, generating live", key.engine)
+            return None
+        OPENING_TAKES.inc(result="hit")
+        served_at = time.time()
+        opening.call.update(started_at=served_at, ended_at=served_at, latency_ms=0.0, pre_generated=True)
+        return opening
+
+    def warm(self, key: OpeningKey):
+        """Start generating the openings missing from the pool of the configuration."""
+        with self._lock:
+            missing = self.size - len(self._openings.get(key, ())) - self._generating.get(key, 0)
+            if missing <= 0:
+                return
+            self._generating[key] = self._generating.get(key, 0) + missing
+        for _ in range(missing):
+            self._executor.submit(self._generate, key)
+
+    def ready(self, key: OpeningKey) -> int:
+        with self._lock:
+            return len(self._openings.get(key, ()))
+
+    def _generate(self, key: OpeningKey):
+        # Imported here, the provider SDKs are loaded on first use
+        from therapy_system.agents.llm import load_llm_agent
+        try:
+            model_args = {"stream": True}
+            if key.words_limit is not None:
+                model_args["max_tokens"] = max_tokens_for_words(key.words_limit, key.persuasion_flag)
+            chat_model = load_llm_agent(key.engine, model_args)
+            chat_model.set_words_limit(key.words_limit)
+            chat_model.set_ledger(self.ledger, "opening_pool")
+            messages = [{"role": "user", "content": key.prompt}]
+            if key.system:
+                messages.insert(0, {"role": "system", "content": key.system})
+            response = "".join(chat_model.chat(messages))
+            call = dict(chat_model.last_call, generated_at=chat_model.last_call["started_at"],
+                        generation_latency_ms=chat_model.last_call["latency_ms"])
+            with self._lock:
+                openings = self._openings.setdefault(key, deque())
+                # Each opening is served once, a repeated one adds no variety
+                if response and all(opening.response != response for opening in openings):
+                    openings.append(Opening(response, call))
+        except Exception:
+            logger.exception("Opening generation for %s failed", key.engine)
+        finally:
+            with self._lock:
+                self._generating[key] -= 1
@@ -0,0 +1,209 @@
+"""
+Conversation schedules for more than two agents.
+
+A schedule is a list of steps. Each step has one speaker, whose reply is the turn
+message, and any number of side agents run concurrently on the same turn, e.g. a
+supervisor checking the therapist's draft or a disclosure monitor. A side agent
+runs either alongside the speaker on the previous message or after it on the
+speaker's reply. In both cases it is started in the background (fan-out) and
+collected later (gather), so it does not add to the wait of the participant
+unless it is required.
+
+An optional side agent is skipped when it has not finished by its deadline.
+A required one is waited for, which blocks the end of the step.
+
+The schedule of a plain alternating conversation is `Schedule.alternating(transit)`,
+which has no side agents and runs exactly as before.
+"""
+import time
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Dict, List, Optional, Sequence, Union, Generator
+from therapy_system.log import get_logger, with_log_context
+from therapy_system.metrics import gauge
+from therapy_system.tracing import span
+
+logger = get_logger(__name__)
+
+SIDE_AGENTS_IN_FLIGHT = gauge("therapy_side_agents_in_flight", "Side agents queued or running on the shared pool")
+
+SIDE_AGENT_WORKERS = 8 # side agents running at once for all the conversations of the process
+
+# Side agent outcomes
+DONE, FAILED, SKIPPED = "done", "failed", "skipped"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def side_agent_executor() -> ThreadPoolExecutor:
+    """Thread pool shared by the side agents of all the conversations, created on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SIDE_AGENT_WORKERS, thread_name_prefix="side_agent")
+        return _executor
+
+
+@dataclass
+class SideAgent:
+    """
+    An agent run in the background on a step.
+    name: the player name of the agent
+    after_speaker: run on the speaker's reply instead of alongside the speaker on the previous message
+    optional: skipped when it has not finished by the deadline, a required agent is always waited for
+    deadline: seconds from its start, None waits until the step is gathered
+    prompt: the message sent to the agent, with {message} replaced by its input
+    """
+    name: str
+    after_speaker: bool = False
+    optional: bool = True
+    deadline: Optional[float] = None
+    prompt: str = "{message}"
+
+
+@dataclass
+class Step:
+    speaker: str
+    side_agents: List[SideAgent] = field(default_factory=list)
+
+    @property
+    def agents(self) -> List[str]:
+        return [self.speaker] + [side.name for side in self.side_agents]
+
+
+@dataclass
+class Schedule:
+    steps: List[Step]
+
+    @classmethod
+    def alternating(cls, transit: Sequence[str]) -> "Schedule":
+        """One speaker per step in the order of transit, without side agents."""
+        return cls([Step(speaker) for speaker in transit])
+
+    @classmethod
+    def with_side_agents(cls, transit: Sequence[str], side_agents: Dict[str, List[SideAgent]]) -> "Schedule":
+        """The alternating schedule of transit with the side agents added to every step of their speaker."""
+        return cls([Step(speaker, list(side_agents.get(speaker, []))) for speaker in transit])
+
+    @property
+    def transit(self) -> List[str]:
+        return [step.speaker for step in self.steps]
+
+    @property
+    def agents(self) -> set:
+        return {name for step in self.steps for name in step.agents}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index) -> Step:
+        return self.steps[index]
+
+
+@dataclass
+class SideRun:
+    side_agent: SideAgent
+    future: Future
+    started_at: float
+
+    def expired(self, now: float) -> bool:
+        deadline = self.side_agent.deadline
+        return self.side_agent.optional and deadline is not None and now > self.started_at + deadline
+
+    def wait(self):
+        """Wait for the agent to finish, an optional agent only until its deadline."""
+        timeout = None
+        if self.side_agent.optional and self.side_agent.deadline is not None:
+            timeout = max(0.0, self.started_at + self.side_agent.deadline - time.time())
+        wait([self.future], timeout=timeout)
+
+    def outcome(self) -> dict:
+        if not self.future.done():
+            self.future.cancel()
+            return {"status": SKIPPED, "response": None, "latency_ms": None}
+        try:
+            response, latency_ms = self.future.result()
+        except Exception as e:
+            return {"status": FAILED, "response": None, "error": str(e), "latency_ms": None}
+        return {"status": DONE, "response": response, "latency_ms": latency_ms}
+
+
+class Scheduler:
+    """Fans the side agents of the steps out on the shared pool and gathers their outcomes."""
+    def __init__(self, schedule: Schedule, players: dict):
+        missing = schedule.agents - set(players)
+        assert not missing, f"Scheduled agents {missing} must be players {list(players)}"
+        self.schedule = schedule
+        self.players = players
+        # Side agents started and not gathered yet, by step index
+        self.running: Dict[int, List[SideRun]] = {}
+
+    def fan_out(self, state: int, message: Union[str, Generator], after_speaker: bool = False):
+        """Start the side agents of the step that run alongside or after the speaker on the message."""
+        if state >= len(self.schedule):
+            return
+        runs = self.running.setdefault(state, [])
+        started = {run.side_agent.name for run in runs}
+        for side in self.schedule[state].side_agents:
+            if side.after_speaker != after_speaker or side.name in started:
+                continue
+            future = side_agent_executor().submit(with_log_context(self._run), side, message)
+            SIDE_AGENTS_IN_FLIGHT.inc()
+            future.add_done_callback(lambda _: SIDE_AGENTS_IN_FLIGHT.dec())
+            runs.append(SideRun(side, future, time.time()))
+
+    def _run(self, side: SideAgent, message: str):
+        start = time.perf_counter()
+        player = self.players[side.name]
+        with span("side_agent", agent=side.name):
+            response = player.chat(side.prompt.format(message=message))
+            if isinstance(response, Generator):
+                response = "".join(response)
+        player.update_conversation_tracking("assistant", response)
+        return response, (time.perf_counter() - start) * 1000
+
+    def gather(self, state: int, after_speaker: bool = None, block: bool = True) -> Dict[str, dict]:
+        """
+        Outcomes of the side agents started on the step, by agent name, only those running alongside
+        or after the speaker when after_speaker is given. With block, required agents are waited for
+        and optional ones until their deadline. Otherwise only the agents finished or past their
+        deadline are gathered and the others keep running.
+        """
+        now = time.time()
+        runs = [run for run in self.running.get(state, [])
+                if after_speaker is None or run.side_agent.after_speaker == after_speaker]
+        if block:
+            for run in runs:
+                run.wait()
+        else:
+            runs = [run for run in runs if run.future.done() or run.expired(now)]
+
+        outcomes = {run.side_agent.name: run.outcome() for run in runs}
+        remaining = [run for run in self.running.get(state, []) if run not in runs]
+        if remaining:
+            self.running[state] = remaining
+        else:
+            self.running.pop(state, None)
+        for name, outcome in outcomes.items():
+            if outcome["status"] != DONE:
+                logger.info("Side agent %s of step %d %s %s", name, state, outcome["status"], outcome.get("error", ""))
+        return outcomes
+
+    def gather_finished(self) -> Dict[int, Dict[str, dict]]:
+        """Outcomes of the side agents of all the steps that finished or are past their deadline, by step index."""
+        outcomes = {state: self.gather(state, block=False) for state in list(self.running)}
+        return {state: outcome for state, outcome in outcomes.items() if outcome}
+
+    def gather_all(self) -> Dict[int, Dict[str, dict]]:
+        """Outcomes of the side agents of all the steps, waiting for them as in gather."""
+        return {state: self.gather(state) for state in list(self.running)}
+
+    def cancel(self):
+        """Skip every side agent not finished yet, e.g. when the conversation ends."""
+        # Called from the thread cancelling the session too
+        for runs in list(self.running.values()):
+            for run in runs:
+                run.future.cancel()
+        self.running.clear()
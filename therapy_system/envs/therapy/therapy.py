@@ -1,9 +1,9 @@
 from therapy_system.agents import Agent
 from therapy_system.envs import AlternatingConv, Turn
 from therapy_system.action import get_action_space
+from therapy_system.budget import max_tokens_for_words
 from typing import List, Dict
 import re
-from therapy_system.action.therapy import TAXONOMY
 
 
 class Therapy(AlternatingConv):
@@ -17,8 +17,13 @@ class Therapy(AlternatingConv):
         log_dir=".logs",
         log_path=None,
         game_state=None,
+        schedule=None,
+        ledger=None,
+        opening_pool=None,
+        cancellation=None,
     ):
-        super().__init__(agents, transit, init_message, persuasion_flag, words_limit, log_dir, log_path, game_state)
+        super().__init__(agents, transit, init_message, persuasion_flag, words_limit, log_dir, log_path, game_state,
+                         schedule, ledger, opening_pool, cancellation)
         self.game_state : List[dict] = [
             {
                 "current_iteration": "START",
@@ -36,6 +41,8 @@ class Therapy(AlternatingConv):
     def init_players(self, agents, game_state, transit) -> Dict[str, Agent]:
         roles = [p['role'] for p in agents]
         assert all([t in roles for t in set(transit)]), f"Transit roles {transit} must be subset of agent roles {roles}"
+        # Replies are cut a little after the words limit asked in the prompt unless the agent sets its own limit
+        max_tokens = max_tokens_for_words(self.words_limit, self.persuasion_flag)
 
         players = {
             p['name'] : Agent(
@@ -43,13 +50,16 @@ class Therapy(AlternatingConv):
                 engine=p['engine'],
                 system=p['system'],
                 persona=p['persona'] if 'persona' in p else {},
-                model_args=p['model_args'] if 'model_args' in p else {},
+                model_args={"max_tokens": max_tokens, **p.get('model_args', {})},
                 action_space=get_action_space(p['action_space']),
                 prolific_id=p['prolific_id'] if 'prolific_id' in p else None,
                 # api=p['api'] if 'api' in p else None,
             )
             for p in agents
         }
+        # The words limit is enforced on the replies, an agent can set its own or None to keep them whole
+        for p in agents:
+            players[p['name']].set_words_limit(p.get('words_limit', self.words_limit))
         return players
     
     def get_reward(self):
@@ -0,0 +1,99 @@
+import re
+from dataclasses import dataclass, asdict, fields
+from typing import List, Optional
+
+# Bump whenever a field is added, removed or changes meaning
+TRANSCRIPT_SCHEMA_VERSION = 2
+
+
+@dataclass
+class TurnRecord:
+    """
+    One turn of a conversation in the persisted transcript.
+
+    Timestamps are unix epoch seconds, latency is in milliseconds and token
+    counts are the provider-reported usage (None for human turns or when the
+    provider does not report usage). words_cutoff tells that the reply was cut
+    after the words limit and pre_generated that it was served from the
+    opening pool, whose generation the participant did not wait on.
+    """
+    iteration: int
+    player: str
+    text: str
+    technique: Optional[str] = None
+    started_at: Optional[float] = None
+    ended_at: Optional[float] = None
+    model: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    latency_ms: Optional[float] = None
+    words_cutoff: bool = False
+    pre_generated: bool = False
+    schema_version: int = TRANSCRIPT_SCHEMA_VERSION
+
+    @classmethod
+    def from_game_state(cls, state: dict) -> "TurnRecord":
+        return cls(
+            iteration=state["current_iteration"],
+            player=state["player"],
+            text=state["response"],
+            technique=state.get("persuasion_technique"),
+            started_at=state.get("started_at"),
+            ended_at=state.get("ended_at"),
+            model=state.get("model"),
+            prompt_tokens=state.get("prompt_tokens"),
+            completion_tokens=state.get("completion_tokens"),
+            latency_ms=state.get("latency_ms"),
+            words_cutoff=state.get("words_cutoff", False),
+            pre_generated=state.get("pre_generated", False),
+        )
+
+    @classmethod
+    def from_dict(cls, record: dict) -> "TurnRecord":
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in record.items() if k in known})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def transcript_to_dict(records: List[TurnRecord]) -> dict:
+    """
+    Serialize a transcript into the versioned document stored alongside the chat history
+    """
+    return {
+        "schema_version": TRANSCRIPT_SCHEMA_VERSION,
+        "turns": [record.to_dict() for record in records],
+    }
+
+
+def transcript_from_dict(document: dict) -> List[TurnRecord]:
+    return [TurnRecord.from_dict(turn) for turn in document.get("turns", [])]
+
+
+_LOG_BLOCK = re.compile(
+    r"Current Iteration: (?P<iteration>\d+)\n"
+    r"Player: (?P<player>.*?)\n"
+    r"Response: (?P<text>.*?)\n"
+    r"Persuasion Technique: (?P<technique>.*?)(?:\n\n|\Z)",
+    re.DOTALL,
+)
+
+
+def transcript_from_log_str(log_str: str) -> List[TurnRecord]:
+    """
+    Backfill a transcript from the human readable `Conv.log_human_readable_state` output.
+    Only needed for sessions recorded before the structured transcript existed.
+    """
+    body = log_str.split("------------------ \n", 1)[-1]
+    records = []
+    for match in _LOG_BLOCK.finditer(body):
+        technique = match.group("technique")
+        records.append(TurnRecord(
+            iteration=int(match.group("iteration")),
+            player=match.group("player"),
+            text=match.group("text"),
+            technique=None if technique == "None" else technique,
+            schema_version=0,
+        ))
+    return records
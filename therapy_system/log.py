@@ -0,0 +1,196 @@
+"""
+Structured logging of the study.
+
+The modules log through `get_logger(__name__)` with the usual levels and lazy
+%-arguments, so a record below the level costs one level check. `configure_logging`
+sets up, once per process:
+
+- a QueueHandler on the root logger, so the request threads only put the record on
+  a queue while a listener thread formats and writes it
+- one JSON object per line with the time, level, logger, message and the context
+- the context of the session bound with `bind_log_context`, e.g. the session id,
+  the Prolific ID and the page, added to every record of the thread or of the
+  work started from it with `with_log_context`
+- sampling of the records below WARNING per logger, for the chatty ones
+
+The level, format and sampling are read from the environment, e.g.
+THERAPY_LOG_LEVEL=DEBUG, THERAPY_LOG_FORMAT=text and
+THERAPY_LOG_SAMPLE="therapy_system.envs.alternating_conv=0.1".
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict
+
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "json" # json or text
+LOG_QUEUE_SIZE = 10000 # records waiting to be written before new ones are dropped
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+# Context of the session added to every record
+_log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+_configure_lock = threading.Lock()
+_listener = None
+
+# Attributes of every LogRecord, the others were given as extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+def bind_log_context(**fields):
+    """Add the fields to the context of the records of the current thread, e.g. at the start of a rerun."""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+@contextmanager
+def log_context(**fields):
+    """Add the fields to the context of the records logged inside the block."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def with_log_context(fn: Callable) -> Callable:
+    """fn running with the context of the caller, for work handed over to another thread."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the context of the session to the record, in the thread that logs it."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _log_context.get()
+        if context:
+            record.context = context
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps the given share of the records below WARNING of the loggers, by logger name prefix."""
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        # Longest prefix first, so the most specific rate applies
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        for prefix, rate in self.rates:
+            if record.name == prefix or record.name.startswith(prefix + "."):
+                return random.random() < rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        entry.update({key: value for key, value in vars(record).items()
+                      if key not in _RECORD_ATTRIBUTES and key != "context"})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = getattr(record, "context", None)
+        if context:
+            line += " " + " ".join(f"{key}={value}" for key, value in context.items())
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts the record on the queue without formatting it, only its message is merged with
+    its arguments. A record is dropped rather than block the thread when the queue is full,
+    and counted in dropped when it is given.
+    """
+    def __init__(self, records: queue.Queue, dropped=None):
+        super().__init__(records)
+        self.dropped = dropped
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # The traceback objects do not outlive the thread, their text does
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.dropped is not None:
+                self.dropped.inc()
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """Rates from "logger=rate,logger=rate"."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def configure_logging(level: str = None, fmt: str = None, sample_rates: Dict[str, float] = None, stream=None):
+    """
+    Route the records of the process through the logging queue, once. Later calls only change the level.
+    The arguments default to the THERAPY_LOG_LEVEL, THERAPY_LOG_FORMAT and THERAPY_LOG_SAMPLE environment variables.
+    """
+    global _listener
+    level = (level or os.environ.get("THERAPY_LOG_LEVEL", LOG_LEVEL)).upper()
+    root = logging.getLogger()
+    with _configure_lock:
+        root.setLevel(level)
+        if _listener is not None:
+            return
+        fmt = fmt or os.environ.get("THERAPY_LOG_FORMAT", LOG_FORMAT)
+        if sample_rates is None:
+            sample_rates = parse_sample_rates(os.environ.get("THERAPY_LOG_SAMPLE", ""))
+
+        output = logging.StreamHandler(stream or sys.stderr)
+        if fmt == "json":
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(TextFormatter(TEXT_FORMAT))
+        # Imported here, the metrics log through this module
+        from therapy_system.metrics import counter, gauge
+        records = queue.Queue(LOG_QUEUE_SIZE)
+        gauge("therapy_log_queue_depth", "Log records waiting to be written").set_function(records.qsize)
+        handler = DroppingQueueHandler(records, counter("therapy_log_dropped_total", "Log records dropped on a full queue"))
+        handler.addFilter(ContextFilter())
+        if sample_rates:
+            handler.addFilter(SamplingFilter(sample_rates))
+
+        # The queue replaces the handlers writing from the request threads
+        for previous in list(root.handlers):
+            root.removeHandler(previous)
+        root.addHandler(handler)
+        _listener = QueueListener(records, output, respect_handler_level=False)
+        _listener.start()
+        atexit.register(_listener.stop)
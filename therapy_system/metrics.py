@@ -0,0 +1,313 @@
+"""
+Process-wide metrics of the study.
+
+The modules declare their counters, gauges and histograms once at import time on
+the registry of the process, e.g.
+
+    REQUESTS = counter("therapy_requests_total", "Requests served", ["page"])
+    REQUESTS.inc(page="Survey")
+
+A gauge either is set by the code or reads its value when the metrics are
+collected, e.g. the depth of a queue. The registry renders the Prometheus text
+format, served by `start_metrics_server` on a local port for the operators to
+scrape or to watch on the admin page while the study runs.
+
+The port is read from the environment, THERAPY_METRICS_PORT=0 turns the server off.
+"""
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+from therapy_system.log import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_HOST = "127.0.0.1" # the endpoint is only reachable from the machine
+METRICS_PORT = 9464
+# Upper bounds in seconds of the histogram buckets, from a cached lookup to a long model call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_server = None
+_server_lock = threading.Lock()
+
+# A sample is (name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if not labels:
+        return f"{name} {_format_value(value)}"
+    pairs = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+    return f"{name}{{{pairs}}} {_format_value(value)}"
+
+
+class Metric:
+    """A metric with its values by label values. Thread-safe."""
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {list(self.labelnames)}, got {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError(f"{self.name} can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def values(self) -> Dict[tuple, float]:
+        """Values by label values, in the order of the label names."""
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], Union[float, Dict[tuple, float]]]):
+        """
+        Read the value when the metrics are collected instead. The function returns the value,
+        or the values by label values for a gauge with labels.
+        """
+        self._function = function
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        return next((value for _, sample_key, value in self._keyed_samples() if sample_key == key), 0)
+
+    def _keyed_samples(self) -> List[Tuple[str, tuple, float]]:
+        if self._function is None:
+            with self._lock:
+                return [(self.name, key, value) for key, value in self._values.items()]
+        try:
+            values = self._function()
+        except Exception:
+            logger.exception("Collecting %s failed", self.name)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, tuple(str(label) for label in key), value) for key, value in values.items()]
+
+    def samples(self) -> List[Sample]:
+        return [(name, self._labels(key), value) for name, key, value in sorted(self._keyed_samples())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the seconds the block took."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, counts, total in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", {**labels, "le": _format_value(float(bound))}, cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    """The metrics of the process by name. Declaring a metric twice returns the first one."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def _declare(self, cls, name: str, documentation: str, labelnames: Sequence[str], **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"{name} is already a {metric.kind} with the labels {list(metric.labelnames)}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._declare(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._declare(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._declare(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def metrics(self) -> List[Metric]:
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(_format_sample(*sample) for sample in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# Errors of the model calls, the storage writes and the jobs, by where they happened
+ERRORS = counter("therapy_errors_total", "Errors by call site", ["call_site"])
+
+
+class SessionPhases:
+    """
+    Phase of the browser sessions of the process, counted per phase for the sessions still open.
+    The app sets is_open to tell whether a session is still open, without it no session is dropped.
+    It lives here rather than in the webapp, whose pages may load their modules under two names.
+    """
+    def __init__(self, phases: Sequence[str] = ("initial", "chat", "post_survey")):
+        self.phases = tuple(phases)
+        self.is_open: Callable[[str], bool] = None
+        self._lock = threading.Lock()
+        self._phases: Dict[str, str] = {}
+
+    def set(self, session_id: str, phase: str):
+        with self._lock:
+            self._phases[session_id] = phase
+
+    def counts(self) -> Dict[tuple, int]:
+        with self._lock:
+            if self.is_open is not None:
+                for session_id in [session_id for session_id in self._phases if not self.is_open(session_id)]:
+                    del self._phases[session_id]
+            phases = list(self._phases.values())
+        counts = {(phase,): 0 for phase in self.phases}
+        for phase in phases:
+            counts[(phase,)] = counts.get((phase,), 0) + 1
+        return counts
+
+
+SESSION_PHASES = SessionPhases()
+gauge("therapy_active_sessions", "Open browser sessions by phase", ["phase"]).set_function(SESSION_PHASES.counts)
+
+
+def start_metrics_server(port: int = None, host: str = METRICS_HOST):
+    """
+    Serve the metrics of the process on http://host:port/metrics from a daemon thread, once.
+    The port defaults to THERAPY_METRICS_PORT, 0 serves nothing. Returns the server, None when it is off.
+    """
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server or None
+        port = int(os.environ.get("THERAPY_METRICS_PORT", METRICS_PORT)) if port is None else port
+        if port == 0:
+            return None
+        # Imported here, most processes never serve the metrics
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = REGISTRY.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+        try:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            # Another process of the app serves the port already
+            logger.warning("Metrics server not started on %s:%s: %s", host, port, e)
+            _server = False
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics_server", daemon=True).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+        return _server
+
@@ -0,0 +1,18 @@
+from therapy_system.storage.storage import (
+    Storage, CHAT_HISTORIES, SURVEY_ONE_RESPONSES, SURVEY_TWO_RESPONSES, SURVEY_THREE_RESPONSES
+)
+from typing import Dict
+
+def get_storage(config: Dict[str, any]) -> Storage:
+    '''
+    config: {"name": "firestore", "credentials": SERVICE_ACCOUNT} or {"name": "sqlite", "path": DB_PATH}
+    '''
+    storage_name = config.get("name", "firestore")
+    if storage_name == "firestore":
+        from therapy_system.storage.firestore import FirestoreStorage
+        return FirestoreStorage(credentials=config.get("credentials"), client=config.get("client"))
+    elif storage_name == "sqlite":
+        from therapy_system.storage.sqlite import SQLiteStorage
+        return SQLiteStorage(config.get("path", "study.db"))
+    else:
+        raise ValueError(f"Unknown storage backend: {storage_name}")
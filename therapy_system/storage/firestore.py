@@ -0,0 +1,100 @@
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+from therapy_system.storage.storage import Storage
+
+# Firestore limits a batch to 500 writes
+MAX_BATCH_SIZE = 500
+
+
+class FirestoreStorage(Storage):
+    def __init__(self, credentials: dict = None, client=None):
+        '''
+        credentials: service account dictionary used to initialize firebase_admin
+        client: an existing Firestore client, or a stand-in with the same interface
+        '''
+        if client is None:
+            import firebase_admin
+            from firebase_admin import credentials as firebase_credentials, firestore
+            if not firebase_admin._apps:
+                firebase_admin.initialize_app(firebase_credentials.Certificate(credentials))
+            client = firestore.client()
+            self.server_timestamp = firestore.SERVER_TIMESTAMP
+        else:
+            self.server_timestamp = getattr(client, "SERVER_TIMESTAMP", None)
+            if self.server_timestamp is None:
+                from firebase_admin import firestore
+                self.server_timestamp = firestore.SERVER_TIMESTAMP
+        self.db = client
+
+    def _stamped(self, document: dict) -> dict:
+        return {**document, "timestamp": self.server_timestamp}
+
+    def put_document(self, collection: str, doc_id: str, document: dict):
+        self.db.collection(collection).document(doc_id).set(self._stamped(document))
+
+    def append_turn(self, collection: str, session_id: str, turn: dict):
+        turn_id = str(turn["iteration"]).zfill(4)
+        self.db.collection(collection).document(session_id).collection("turns").document(turn_id).set(self._stamped(turn))
+
+    def batch_write(self, writes: List[Tuple[str, str, dict]]):
+        for start in range(0, len(writes), MAX_BATCH_SIZE):
+            batch = self.db.batch()
+            for collection, doc_id, document in writes[start:start + MAX_BATCH_SIZE]:
+                batch.set(self.db.collection(collection).document(doc_id), self._stamped(document))
+            batch.commit()
+
+    def query(self,
+              collection: str,
+              prolific_id: str = None,
+              since: datetime = None,
+              fields: List[str] = None,
+              page_size: int = 200,
+              since_doc_id: str = None) -> Iterator[Tuple[str, Dict]]:
+        query = self.db.collection(collection)
+        if prolific_id is not None:
+            query = query.where("prolific_id", "==", prolific_id)
+        if since is not None and since_doc_id is None:
+            query = query.where("timestamp", ">", since)
+        query = query.order_by("timestamp").order_by("__name__")
+        if fields is not None:
+            query = query.select(sorted(set(fields) | {"prolific_id", "timestamp"}))
+
+        # Page through the results with cursors on the last document of each page,
+        # the first page starts after the (timestamp, doc_id) given by the caller
+        cursor = {"timestamp": since, "__name__": since_doc_id} if since_doc_id is not None else None
+        while True:
+            page_query = query.limit(page_size)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+            page = list(page_query.stream())
+            for doc in page:
+                yield doc.id, doc.to_dict()
+            if len(page) < page_size:
+                break
+            cursor = page[-1]
+
+    def query_unstamped(self,
+                        collection: str,
+                        fields: List[str] = None,
+                        page_size: int = 200) -> Iterator[Tuple[str, Dict]]:
+        # Documents written before the backend stamped them, a read-only scan of the whole collection
+        query = self.db.collection(collection).order_by("__name__")
+        if fields is not None:
+            query = query.select(sorted(set(fields) | {"prolific_id", "timestamp"}))
+        last_doc = None
+        while True:
+            page_query = query.limit(page_size)
+            if last_doc is not None:
+                page_query = page_query.start_after(last_doc)
+            page = list(page_query.stream())
+            for doc in page:
+                document = doc.to_dict()
+                if document.get("timestamp") is None:
+                    yield doc.id, {**document, "timestamp": None}
+            if len(page) < page_size:
+                break
+            last_doc = page[-1]
+
+    def get_turns(self, collection: str, session_id: str) -> List[dict]:
+        turns = self.db.collection(collection).document(session_id).collection("turns").stream()
+        return sorted((doc.to_dict() for doc in turns), key=lambda turn: turn["iteration"])
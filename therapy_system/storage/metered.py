@@ -0,0 +1,57 @@
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+from therapy_system.metrics import ERRORS, gauge, histogram
+from therapy_system.tracing import span
+from therapy_system.storage.storage import Storage
+
+# The writes run on the script threads of the sessions, those in flight are the write backlog
+WRITES_IN_FLIGHT = gauge("therapy_storage_writes_in_flight", "Storage writes started and not finished", ["backend"])
+WRITE_LATENCY = histogram("therapy_storage_write_seconds", "Latency of the storage writes", ["backend", "operation"])
+
+
+class MeteredStorage(Storage):
+    """Storage counting the writes in flight, their latency and their errors of the backend it wraps."""
+    def __init__(self, storage: Storage, backend: str):
+        self.storage = storage
+        self.backend = backend
+
+    def _write(self, operation: str, write, *args):
+        WRITES_IN_FLIGHT.inc(backend=self.backend)
+        start = time.perf_counter()
+        try:
+            with span(f"storage.{operation}", backend=self.backend):
+                return write(*args)
+        except Exception:
+            ERRORS.inc(call_site=f"storage.{operation}")
+            raise
+        finally:
+            WRITES_IN_FLIGHT.dec(backend=self.backend)
+            WRITE_LATENCY.observe(time.perf_counter() - start, backend=self.backend, operation=operation)
+
+    def put_document(self, collection: str, doc_id: str, document: dict):
+        self._write("put_document", self.storage.put_document, collection, doc_id, document)
+
+    def append_turn(self, collection: str, session_id: str, turn: dict):
+        self._write("append_turn", self.storage.append_turn, collection, session_id, turn)
+
+    def batch_write(self, writes: List[Tuple[str, str, dict]]):
+        self._write("batch_write", self.storage.batch_write, writes)
+
+    def query(self,
+              collection: str,
+              prolific_id: str = None,
+              since: datetime = None,
+              fields: List[str] = None,
+              page_size: int = 200,
+              since_doc_id: str = None) -> Iterator[Tuple[str, Dict]]:
+        return self.storage.query(collection, prolific_id, since, fields, page_size, since_doc_id)
+
+    def query_unstamped(self,
+                        collection: str,
+                        fields: List[str] = None,
+                        page_size: int = 200) -> Iterator[Tuple[str, Dict]]:
+        return self.storage.query_unstamped(collection, fields, page_size)
+
+    def get_turns(self, collection: str, session_id: str) -> List[dict]:
+        return self.storage.get_turns(collection, session_id)
@@ -0,0 +1,122 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Tuple
+from therapy_system.storage.storage import Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    prolific_id TEXT,
+    timestamp TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, doc_id)
+);
+CREATE INDEX IF NOT EXISTS documents_by_time ON documents (collection, timestamp);
+CREATE INDEX IF NOT EXISTS documents_by_participant ON documents (collection, prolific_id, timestamp);
+CREATE TABLE IF NOT EXISTS turns (
+    collection TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, session_id, iteration)
+);
+"""
+
+
+class SQLiteStorage(Storage):
+    """
+    Embedded backend for pilots and load tests. The database runs in WAL mode so
+    the Streamlit session threads can read while another one writes. Each thread
+    uses its own connection.
+    """
+
+    def __init__(self, path: str = "study.db"):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _format(timestamp: datetime) -> str:
+        # Fixed width UTC timestamps so that they sort and compare as text
+        return timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+    def _now(self) -> str:
+        return self._format(datetime.now(timezone.utc))
+
+    @staticmethod
+    def _dumps(document: dict) -> str:
+        # Sets and numpy scalars from the survey state are stored as plain JSON
+        return json.dumps(document, default=lambda o: sorted(o) if isinstance(o, set) else str(o))
+
+    def _document_row(self, collection: str, doc_id: str, document: dict) -> tuple:
+        return (collection, doc_id, document.get("prolific_id"), self._now(), self._dumps(document))
+
+    def put_document(self, collection: str, doc_id: str, document: dict):
+        self.batch_write([(collection, doc_id, document)])
+
+    def append_turn(self, collection: str, session_id: str, turn: dict):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?, ?)",
+                (collection, session_id, turn["iteration"], self._now(), self._dumps(turn)),
+            )
+
+    def batch_write(self, writes: List[Tuple[str, str, dict]]):
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                [self._document_row(*write) for write in writes],
+            )
+
+    def query(self,
+              collection: str,
+              prolific_id: str = None,
+              since: datetime = None,
+              fields: List[str] = None,
+              page_size: int = 200,
+              since_doc_id: str = None) -> Iterator[Tuple[str, Dict]]:
+        sql = "SELECT doc_id, timestamp, data FROM documents WHERE collection = ?"
+        params = [collection]
+        if prolific_id is not None:
+            sql += " AND prolific_id = ?"
+            params.append(prolific_id)
+        if since is not None and since_doc_id is not None:
+            sql += " AND (timestamp > ? OR (timestamp = ? AND doc_id > ?))"
+            params += [self._format(since), self._format(since), since_doc_id]
+        elif since is not None:
+            sql += " AND timestamp > ?"
+            params.append(self._format(since))
+        sql += " ORDER BY timestamp, doc_id"
+
+        cursor = self._connection().execute(sql, params)
+        keep = None if fields is None else set(fields) | {"prolific_id", "timestamp"}
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            for doc_id, timestamp, data in rows:
+                document = json.loads(data)
+                document["timestamp"] = datetime.fromisoformat(timestamp)
+                if keep is not None:
+                    document = {k: v for k, v in document.items() if k in keep}
+                yield doc_id, document
+
+    def get_turns(self, collection: str, session_id: str) -> List[dict]:
+        rows = self._connection().execute(
+            "SELECT data FROM turns WHERE collection = ? AND session_id = ? ORDER BY iteration",
+            (collection, session_id),
+        )
+        return [json.loads(data) for data, in rows]
@@ -0,0 +1,75 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+# Collections of the study, shared by the webapp and the export
+CHAT_HISTORIES = "group_two_chat_histories"
+SURVEY_ONE_RESPONSES = "group_two_survey_one_responses"
+SURVEY_TWO_RESPONSES = "group_two_survey_two_responses"
+SURVEY_THREE_RESPONSES = "group_two_survey_three_responses"
+
+
+class Storage(ABC):
+    """
+    Base class for persistence backends.
+
+    Documents are keyed by (collection, doc_id) and carry a `prolific_id`.
+    The backend sets `timestamp` on write, which is what `query` orders by, ties
+    broken by doc_id.
+    Turns are appended under a session document as the conversation runs.
+    """
+
+    @abstractmethod
+    def put_document(self, collection: str, doc_id: str, document: dict):
+        """
+        Create or replace a document
+        """
+        pass
+
+    @abstractmethod
+    def append_turn(self, collection: str, session_id: str, turn: dict):
+        """
+        Append a conversation turn to the session document
+        """
+        pass
+
+    @abstractmethod
+    def batch_write(self, writes: List[Tuple[str, str, dict]]):
+        """
+        Write (collection, doc_id, document) triples together
+        """
+        pass
+
+    @abstractmethod
+    def query(self,
+              collection: str,
+              prolific_id: str = None,
+              since: datetime = None,
+              fields: List[str] = None,
+              page_size: int = 200,
+              since_doc_id: str = None) -> Iterator[Tuple[str, Dict]]:
+        """
+        Yield (doc_id, document) in (`timestamp`, doc_id) order, optionally only the
+        documents of one participant and those after `since`. With `since_doc_id`,
+        the documents written at `since` with a greater doc_id are yielded too, so
+        that the last document yielded is a cursor to resume from.
+        `fields` projects the documents, `prolific_id` and `timestamp` are always returned.
+        """
+        pass
+
+    def query_unstamped(self,
+                        collection: str,
+                        fields: List[str] = None,
+                        page_size: int = 200) -> Iterator[Tuple[str, Dict]]:
+        """
+        Yield (doc_id, document) in doc_id order for the documents written without a `timestamp`,
+        which `query` never returns, with `timestamp` set to None. Backends that always stored it have none.
+        """
+        return iter(())
+
+    @abstractmethod
+    def get_turns(self, collection: str, session_id: str) -> List[dict]:
+        """
+        Turns appended to the session document, in order
+        """
+        pass
@@ -0,0 +1,210 @@
+"""
+Span tracing of the turns of a session.
+
+A turn is traced from the page down to the model and storage calls, e.g.
+
+    with trace("turn", session_id=session_id, turn=3):
+        with span("retrieve_persona_details"):
+            ...
+
+The spans started inside the trace, on the thread or on the work handed to other
+threads with `with_log_context`, are its children. A span that crosses the yields
+of a stream is started with `start_span` and ended by hand, e.g. a streamed model call.
+
+The sampling is decided at the head of the trace and by session, so a sampled
+participant has every turn traced and the others pay one context lookup per span.
+Each turn is written to traces/<session id>/turn_<turn>.json in the Chrome trace
+event format, which chrome://tracing and https://ui.perfetto.dev open as a waterfall.
+
+The share of the sessions traced and the directory are read from the environment,
+e.g. THERAPY_TRACE_SAMPLE=1 and THERAPY_TRACE_DIR=/tmp/traces.
+"""
+import os
+import json
+import zlib
+import time
+import itertools
+import threading
+import contextvars
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from therapy_system.log import get_logger
+
+logger = get_logger(__name__)
+
+TRACE_SAMPLE_RATE = 0.1 # share of the sessions whose turns are traced
+TRACE_DIR = "traces"
+
+# Trace and span the new spans of the context are children of
+_current: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+_span_ids = itertools.count(1)
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def session_sampled(session_id: str, rate: float) -> bool:
+    """Whether the session is traced, the same for every turn and process."""
+    return zlib.crc32(session_id.encode()) / 2 ** 32 < rate
+
+
+def _write_executor() -> ThreadPoolExecutor:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace_writer")
+        return _writer
+
+
+class Span:
+    """A timed step of a trace, written once it ends."""
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[int], attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = next(_span_ids)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.thread = threading.current_thread()
+        self.start = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, **attrs):
+        self.attrs.update(attrs)
+        self.trace.add(self, time.perf_counter())
+
+
+class NoSpan:
+    """Span of a context that is not traced."""
+    def set(self, **attrs):
+        pass
+
+    def end(self, **attrs):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Trace:
+    """The spans of one turn, as Chrome trace events. Spans ending after the turn rewrite its file."""
+    def __init__(self, session_id: str, turn, directory: str):
+        self.session_id = session_id
+        self.turn = turn
+        self.path = os.path.join(directory, str(session_id), f"turn_{turn:04d}.json" if isinstance(turn, int)
+                                 else f"turn_{turn}.json")
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._events: List[dict] = []
+        self._threads = {}
+        self.finished = False
+
+    def add(self, span: Span, end: float):
+        event = {
+            "name": span.name,
+            "ph": "X",
+            "ts": round((span.start - self.start) * 1e6, 1),
+            "dur": round((end - span.start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": span.thread.ident,
+            "args": {"span_id": span.span_id, "parent_id": span.parent_id, **span.attrs},
+        }
+        with self._lock:
+            self._events.append(event)
+            self._threads[span.thread.ident] = span.thread.name
+            finished = self.finished
+        if finished:
+            self.write()
+
+    def finish(self):
+        with self._lock:
+            self.finished = True
+        self.write()
+
+    def write(self):
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                 for tid, name in threads.items()]
+        document = {
+            "traceEvents": names + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"session_id": self.session_id, "turn": self.turn, "started_at": self.started_at},
+        }
+        # Written off the script thread, one file at a time
+        _write_executor().submit(self._dump, document)
+
+    def _dump(self, document: dict):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(document, f, default=str)
+        except OSError:
+            logger.exception("Writing the trace %s failed", self.path)
+
+
+@contextmanager
+def trace(name: str, session_id: str, turn, sample_rate: float = None, directory: str = None, **attrs):
+    """
+    Trace the block as the root span of the turn of the session, when the session is sampled.
+    sample_rate and directory default to THERAPY_TRACE_SAMPLE and THERAPY_TRACE_DIR.
+    """
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("THERAPY_TRACE_SAMPLE", TRACE_SAMPLE_RATE))
+    if not session_sampled(session_id, sample_rate):
+        yield NO_SPAN
+        return
+    turn_trace = Trace(session_id, turn, directory or os.environ.get("THERAPY_TRACE_DIR", TRACE_DIR))
+    token = _current.set((turn_trace, None))
+    try:
+        with span(name, session_id=session_id, turn=turn, **attrs) as root:
+            yield root
+    finally:
+        _current.reset(token)
+        turn_trace.finish()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time the block as a child of the current span, nothing outside a trace."""
+    current = _current.get()
+    if current is None:
+        yield NO_SPAN
+        return
+    turn_trace, parent_id = current
+    block = Span(turn_trace, name, parent_id, attrs)
+    token = _current.set((turn_trace, block.span_id))
+    try:
+        yield block
+    except BaseException as e:
+        block.set(error=type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        block.end()
+
+
+def start_span(name: str, **attrs):
+    """A child of the current span that is ended by hand, its own children are not tracked."""
+    current = _current.get()
+    if current is None:
+        return NO_SPAN
+    return Span(current[0], name, current[1], attrs)
+
+
+def traced(name: str) -> Callable:
+    """Decorator timing each call of the function as a span."""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
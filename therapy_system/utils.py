@@ -1,4 +1,5 @@
-from typing import Generator, Union
+import json
+from typing import Any, Generator, Iterable, List, Tuple, Union
 
 def escape_special_characters(text : Union[str, Generator[str, None, None]]) -> Union[str, Generator[str, None, None]]:
     rules = lambda x: x.replace("$", "\$").replace("*", "\*")
@@ -15,3 +16,64 @@ def unescape_special_characters(text : str) -> str:
     #         yield rules(chunk)
     # else:
     #     return rules(text)
+
+
+def iter_json_object(chunks: Iterable[str]) -> Generator[Tuple[str, Any], None, None]:
+    """
+    Incrementally parse a streamed JSON object and yield each (key, value) member
+    as soon as its value is complete, so the caller does not wait for the whole reply.
+    Text before the opening brace, like a ```json fence, is skipped.
+    Raises ValueError when a member is malformed or the stream ends before the object closes.
+    """
+    depth, in_string, escaped = 0, False, False
+    member = []
+    for chunk in chunks:
+        for char in chunk:
+            if depth == 0:
+                # Outside the object, only its opening brace matters
+                if char == "{":
+                    depth = 1
+                continue
+
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+                member.append(char)
+                continue
+
+            if char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+                if depth == 0:
+                    # End of the object, the last member has no trailing comma
+                    if "".join(member).strip():
+                        yield _parse_json_member(member)
+                    return
+                if depth == 1:
+                    # A nested object or array value just closed
+                    member.append(char)
+                    yield _parse_json_member(member)
+                    member = []
+                    continue
+            elif char == "," and depth == 1:
+                if "".join(member).strip():
+                    yield _parse_json_member(member)
+                member = []
+                continue
+            member.append(char)
+    raise ValueError("JSON stream ended before the object was closed")
+
+
+def _parse_json_member(member: List[str]) -> Tuple[str, Any]:
+    try:
+        (key, value), = json.loads("{" + "".join(member) + "}").items()
+    except ValueError as e:  # json.JSONDecodeError is a ValueError
+        raise ValueError(f"Malformed JSON member: {''.join(member).strip()}") from e
+    return key, value
@@ -1,56 +1,70 @@
 import os
 import sys
 import time
-import logging
 import streamlit as st
 from pathlib import Path
 from dotenv import load_dotenv
 from typing import Generator
-import openai
-from openai import OpenAI
-
-# firebase related imports
-import firebase_admin
-from firebase_admin import credentials, firestore
 
 # therapy_system related imports
 sys.path.append("../")
 sys.path.append("./")
 import therapy_system
 from therapy_system.utils import unescape_special_characters
-from therapy_system.agents.llm.aws import AWS_MODELS_MAPPING
-from therapy_system.agents.llm.openai import GPT_MODELS_MAPPING
+from therapy_system.storage import get_storage, CHAT_HISTORIES
+from therapy_system.storage.metered import MeteredStorage
+from therapy_system.budget import Ledger
+from therapy_system.action import get_action_space
+from therapy_system.envs.opening_pool import OpeningPool, OpeningKey
+from therapy_system.cancellation import Cancelled
+from therapy_system.log import configure_logging, get_logger
+from therapy_system.tracing import trace, span, traced
 
 # Import functions from therapy_utils and feedback_utils
 from therapy_utils import (
     secure_log_api_key, clean_chat, stream_data, generate_response,
-    gpt4_search_persona, read_persona_csv,
-    read_unnecessary_info_csv
+    gpt4_search_persona, load_persona_catalog
 )
 from feedback_utils import (
-    disable_copy_paste)
+    disable_copy_paste, start_turn_detection, detect_turn)
+from jobs import END_THERAPY, new_conversation_cancellation, cancel_conversation, resume_conversation, get_session_id
+from chat_state import IDLE, AWAITING_PATIENT, GENERATING_THERAPIST, STREAMING, new_chat_state, get_chat_state
+import perf
+
+logger = get_logger(__name__)
 
 
 def setup_logging():
-    """Set up logging configuration."""
-    logging.basicConfig(level=logging.INFO)
+    """Set up logging configuration, see therapy_system.log."""
+    configure_logging()
 
 
-def setup_firebase():
-    """Set up Firebase Firestore connection."""
-    if not firebase_admin._apps:
+@st.cache_resource
+def load_storage():
+    """
+    Create the persistence backend once per process. Firestore is used unless the secrets select another one, e.g.
+    [storage]
+    name = "sqlite"
+    path = "study.db"
+    """
+    storage_config = dict(st.secrets.get("storage", {"name": "firestore"}))
+    if storage_config.get("name", "firestore") == "firestore":
         # Load Firebase credentials from Streamlit secrets
-        firebase_credentials_dict = dict(st.secrets["firebase_service_account"])  # Convert to a Python dictionary
-        # Initialize the Firebase Admin SDK using the credentials dictionary
-        cred = credentials.Certificate(firebase_credentials_dict)
-        firebase_admin.initialize_app(cred)
-        logging.info("Firebase initialized successfully.")
+        storage_config["credentials"] = dict(st.secrets["firebase_service_account"])  # Convert to a Python dictionary
 
-    # Get a reference to the Firestore database
-    st.session_state.firestore_db = firestore.client()
-    logging.info("Firebase Firestore setup completed.")
+    # The writes of the sessions are counted in the metrics of the process
+    storage = MeteredStorage(get_storage(storage_config), storage_config.get("name", "firestore"))
+    logger.info("Storage backend %s setup completed.", storage_config.get("name", "firestore"))
+    return storage
 
 
+def setup_storage():
+    """Set up the persistence backend of the session."""
+    if "storage" not in st.session_state:
+        st.session_state.storage = load_storage()
+
+
+@st.cache_resource
 def load_environment_variables():
     """Load environment variables from the .env file."""
     # env_path = Path(".") / "secrets.env"
@@ -112,6 +126,35 @@ def initialize_session_state():
         st.session_state.start_button_clicked = False
 
 
+def new_ledger():
+    """
+    Budget ledger of the session. The caps in USD are read from the secrets, e.g.
+    [budget]
+    session_cap_usd = 0.5
+    study_cap_usd = 100
+    """
+    budget_config = st.secrets.get("budget", {})
+    return Ledger(session_cap_usd=budget_config.get("session_cap_usd"),
+                  study_cap_usd=budget_config.get("study_cap_usd"))
+
+
+@st.cache_resource
+def get_opening_pool() -> OpeningPool:
+    """Pre-generated openings of the therapist shared by all the sessions of the process."""
+    return OpeningPool()
+
+
+def warm_openings(agent_1, therapist_system_prompt, persuasion_techique, persuasion_flag, words_limit):
+    """Start generating the openings of the therapist while the participant logs in."""
+    if agent_1 == "Human" or "openings_warmed" in st.session_state:
+        return
+    # The same prompt the environment sends on the empty message of state 0
+    action_space = get_action_space({"name": "therapy", "action": int(persuasion_techique.split(":")[0].strip()) - 1})
+    prompt = action_space.sample()("", {}, [], persuasion_flag, words_limit)
+    get_opening_pool().warm(OpeningKey(agent_1, persuasion_flag, words_limit, therapist_system_prompt, prompt))
+    st.session_state.openings_warmed = True
+
+
 def start_conversation(agent_1, agent_2, therapist_system_prompt, persuasion_techique, init_message_flag,
                        is_stream, event, min_interactions, max_iteractions, words_limit, persuasion_flag, prolific_id):
     """Initialize the conversation settings and environment."""
@@ -162,22 +205,66 @@ def start_conversation(agent_1, agent_2, therapist_system_prompt, persuasion_tec
     st.session_state.iterations = min_interactions
     st.session_state.event_kwargs = event_kwargs
     st.session_state.turn = 1 if init_message_flag else 0
-    st.session_state.temp_response = ""
-    env = therapy_system.make(event, **event_kwargs)
+    new_chat_state()
+    # The turns are appended under the chat document while the conversation runs
+    st.session_state.chat_document_id = f"chat_{prolific_id}_{int(st.session_state.start_time)}"
+    st.session_state.ledger = new_ledger()
+    env = therapy_system.make(event, ledger=st.session_state.ledger, opening_pool=get_opening_pool(),
+                              cancellation=new_conversation_cancellation(), **event_kwargs)
     st.session_state.env = env
+    # Disclosures are detected turn by turn while the chat goes on
+    start_turn_detection()
 
 
-def display_messages():
-    """Display all chat messages in the conversation."""
-    for message in st.session_state.messages:
+def display_messages(slots):
+    """
+    Lay out one fragment per message of the conversation. A message is drawn in its slot once,
+    when it is sent, so the turns never redraw the history above them.
+    """
+    for index in range(slots):
+        st.fragment(display_message, key=message_slot(index))(index)
+    st.session_state.settled_messages = len(st.session_state.messages)
+
+
+def message_slot(index):
+    return f"message_{index}"
+
+
+def display_message(index):
+    """The message at the index, nothing while it is not sent."""
+    if index < len(st.session_state.messages):
+        message = st.session_state.messages[index]
+        with st.chat_message(message["turn"]):
+            st.write(message["response"])
+
+
+def display_unsettled_messages():
+    """The messages of the turns not drawn in their slot yet, e.g. the last reply of the therapist."""
+    for message in st.session_state.messages[st.session_state.settled_messages:]:
         with st.chat_message(message["turn"]):
             st.write(message["response"])
 
+
+def send_patient_message(players):
+    """
+    Take the message of the patient before the turns rerun. Only the slots of the messages
+    since the last one sent and the turns are redrawn.
+    """
+    response = st.session_state.human_input
+    turn = get_chat_state()
+    if not response or turn.state != AWAITING_PATIENT:
+        return
+    turn.send(response)
+    st.session_state.messages.append({"turn": players[st.session_state.turn % 2], "response": response})
+    settled = st.session_state.settled_messages
+    st.session_state.settled_messages = len(st.session_state.messages)
+    st.rerun([message_slot(index) for index in range(settled, len(st.session_state.messages))] + ["chat_turns"])
+
 def display_persona_info(persona_category_info, main_categories):
     """ Display the persona information in the sidebar."""
     if "sidebar_container" not in st.session_state:
         st.session_state.sidebar_container = st.sidebar.container()
-    with st.session_state.sidebar_container:
+    with perf.phase("persona_sidebar"), st.session_state.sidebar_container:
     # Add the static personal information section
         st.markdown("#### Personal Information")
         for category in main_categories:
@@ -187,19 +274,22 @@ def display_persona_info(persona_category_info, main_categories):
                     for info in persona_category_info[category]:
                         st.write(info)
 
-def retrieve_persona_details(formatted_query, persona_hierarchy_info, main_categories, persona_category_info):
+@traced("retrieve_persona_details")
+def retrieve_persona_details(formatted_query, persona_catalog):
     """Retrieve and display persona details based on the conversation."""
-    detected_groups = gpt4_search_persona(formatted_query, persona_hierarchy_info)
+    persona_category_info = persona_catalog["category_info"]
+    with perf.phase("persona_search"):
+        detected_groups = gpt4_search_persona(formatted_query, persona_catalog)
 
     # Display relevant persona details or newly generated persona information in the sidebar
     st.session_state.sidebar_container = st.sidebar.container()
 
     with st.session_state.sidebar_container:
         st.markdown("#### Possible Related Information")
-        if detected_groups and detected_groups != 'None':
+        if detected_groups:
             # st.write(f"**Detected Groups:** {detected_groups}")
-            category_map = {cat.lower(): cat for cat in persona_category_info.keys()}
-            for group in detected_groups.split(', '):
+            category_map = persona_catalog["category_map"]
+            for group in detected_groups:
                 proper_group = category_map.get(group.lower().strip())
                 if proper_group and proper_group in persona_category_info:
                     st.markdown(f"**{proper_group}**:")
@@ -229,78 +319,163 @@ def retrieve_persona_details(formatted_query, persona_hierarchy_info, main_categ
                 user_prompt="Generate relevant persona information for the recent chat history",
                 model="gpt-4o-mini",
                 max_tokens=100,
-                temperature=0
+                temperature=0,
+                ledger=st.session_state.get("ledger"),
+                call_site="persona_generation",
+                cancellation=st.session_state.get("cancellation"),
             )
             st.write("No relevant persona information found. Here is the **newly generated persona information**: ", generated_info)
 
-        display_persona_info(persona_category_info, main_categories)
+        display_persona_info(persona_category_info, persona_catalog["main_categories"])
 
 
-def run_conversation(env, players, is_stream, persona_hierarchy_info, main_categories, persona_category_info
-                     , min_interaction_time, elapsed_time):
-    """Handle the main conversation loop."""
-    if st.session_state.current_iteration >= st.session_state.iterations or elapsed_time >= min_interaction_time:
-        if not st.session_state_terminate_button_displayed:  # Only display the button if it hasn't been displayed yet
-            st.session_state_terminated_button = st.button("End Therapy (Feel free to end anytime)", key="terminate_button")
-            st.session_state_terminate_button_displayed = True  # Set the flag to indicate the button has been displayed
+@st.fragment(key="chat_turns")
+def chat_turns(env, players, is_stream, persona_catalog, min_interaction_time):
+    """
+    The turns of the conversation, rerun on their own when the patient sends a message.
+    Each rerun plays the turns the chat state asks for and returns once it waits for the patient.
+    """
+    with perf.fragment_rerun("Chat_with_AI_Therapist", "chat_turns"):
+        turn = get_chat_state()
+        display_unsettled_messages()
+        turn.resume()
+        if turn.state == IDLE:
+            next_turn(turn, env)
+
+        elapsed_time = time.time() - st.session_state.start_time
+        if not turn.done and (st.session_state.current_iteration >= st.session_state.iterations
+                              or elapsed_time >= min_interaction_time):
+            st.button("End Therapy (Feel free to end anytime)", key="terminate_button", on_click=end_therapy)
+
+        while turn.state == GENERATING_THERAPIST:
+            with perf.phase("run_conversation"):
+                if not run_conversation(env, turn, players, is_stream, persona_catalog):
+                    return
+
+        if turn.state == AWAITING_PATIENT:
+            st.chat_input("You:", key="human_input", on_submit=send_patient_message, args=(players,))
+        elif turn.done:
+            finish_chat(env)
+
+
+def next_turn(turn, env):
+    """Move the chat to the speaker of the next turn, to done past the last one."""
+    if env.is_truncated_state():
+        turn.end()
+    elif str(env.sample_action()) == "Human-input":
+        turn.move(AWAITING_PATIENT)
+    else:
+        turn.move(GENERATING_THERAPIST)
 
-    if st.session_state_terminated_button:
-        st.session_state.chat_finished = True
-        return
 
+def end_therapy():
+    # Nothing of the conversation is generated anymore, e.g. by the side agents
+    cancel_conversation(END_THERAPY)
+    get_chat_state().end()
+
+
+def finish_chat(env):
+    """Save the chat and move on to the survey."""
+    st.session_state.chat_finished = True
+    st.session_state.phase = "post_survey"
+    chat_history = env.log_state()
+    transcript = env.log_transcript()
+    save_chat_history(st.session_state.prolific_id, chat_history, transcript) # Debug
+    target_page = "pages/Survey.py"
+    st.switch_page(target_page)
+
+
+def run_conversation(env, turn, players, is_stream, persona_catalog):
+    """
+    Play the message the patient sent, if any, and the reply of the therapist.
+    Returns False when the reply was cut off, the turn is then played again on the next rerun,
+    with the same reply when it was already generated.
+    """
+    if turn.patient_message is not None:
+        with trace("turn", session_id=get_session_id(), turn=st.session_state.current_iteration,
+                   speaker=players[st.session_state.turn % 2]):
+            play_patient_turn(env, turn.patient_message, persona_catalog)
+        turn.patient_played()
+        next_turn(turn, env)
+        if turn.state != GENERATING_THERAPIST:
+            return True
+
+    # The turn is traced from here on, the wait for the patient is not part of it
+    with trace("turn", session_id=get_session_id(), turn=st.session_state.current_iteration,
+               speaker=players[st.session_state.turn % 2]):
+        try:
+            play_therapist_turn(env, turn, players, is_stream, persona_catalog)
+        except Cancelled:
+            # The conversation was ended or left while the therapist replied
+            if not turn.done:
+                turn.move(GENERATING_THERAPIST)
+            return False
+    next_turn(turn, env)
+    return True
+
+
+def play_therapist_turn(env, turn, players, is_stream, persona_catalog):
+    """Generate and show the reply of the therapist, or show again the one a rerun cut off."""
     action = env.sample_action()
-    technique = None
-    if (str(action) == "Human-input") and (st.session_state.temp_response == ""):
-        with st.form(key='human_input_form', clear_on_submit=True):
-            response = st.text_input("You:", key="human_input") # "You" instead of "Your turn"
-            submit_button = st.form_submit_button(label='Send')
-        if submit_button and response:
-            with st.chat_message(players[st.session_state.turn % 2]):
-                st.write(response)
-            st.session_state.temp_response = response
-            st.session_state.messages.append({"turn": players[st.session_state.turn % 2], "response": response})
-            st.rerun()
-        else:
-            st.stop()
-    elif (str(action) == "Human-input") and (st.session_state.temp_response != ""):
-        response = st.session_state.temp_response
-    else:
+    if turn.pending_reply is None:
+        # A reply cut off while it was generated left its prompt in the conversation of the agent
+        env.discard_response()
         technique, response = env.get_response(action)
-        with st.chat_message(players[st.session_state.turn % 2]):
-            if is_stream:
-                if isinstance(response, Generator):
-                    response = ''.join(response)
-                else:
-                    response = response
-                    response = unescape_special_characters(response)
-
-                response_placeholder = st.empty()
-                full_response = ""
+        if isinstance(response, Generator):
+            response = ''.join(response)
+        elif is_stream:
+            response = unescape_special_characters(response)
+        turn.reply_generated(technique, response)
+    technique, response = turn.pending_reply
+
+    with st.chat_message(players[st.session_state.turn % 2]):
+        if is_stream:
+            turn.move(STREAMING)
+            response_placeholder = st.empty()
+            full_response = ""
+            with span("stream_data"):
                 for chunk in stream_data(response):
                     full_response += chunk
                     response_placeholder.markdown(full_response + "▌")
                 response_placeholder.markdown(full_response)
-                response = full_response
-            else:
-                st.write(response)
-        st.session_state.messages.append({"turn": players[st.session_state.turn % 2], "response": response})
+            response = full_response
+        else:
+            st.write(response)
+    st.session_state.messages.append({"turn": players[st.session_state.turn % 2], "response": response})
+    response = unescape_special_characters(response)
+
+    if "sidebar_container" not in st.session_state:
+        display_persona_info(persona_catalog["category_info"], persona_catalog["main_categories"])
+    step(env, action, technique, response)
+    turn.reply_played()
+
+
+def play_patient_turn(env, response, persona_catalog):
+    """Play the message the patient sent, shown in its slot by the callback of the chat input."""
+    action = env.sample_action()
     response = unescape_special_characters(response)
 
     # Retrieve persona details based on the human response and assistant's previous response
-    if (st.session_state.turn >= 0) and (str(action) == "Human-input"):
+    if st.session_state.turn >= 0:
         previous_response = st.session_state.messages[-2]["response"] if len(st.session_state.messages) > 1 else ""
         human_response = response
         formatted_query = f"Therapist: {previous_response}\nPatient: {human_response}"
-        retrieve_persona_details(formatted_query, persona_hierarchy_info, main_categories, persona_category_info)
+        retrieve_persona_details(formatted_query, persona_catalog)
     if "sidebar_container" not in st.session_state:
-        display_persona_info(persona_category_info, main_categories)
+        display_persona_info(persona_catalog["category_info"], persona_catalog["main_categories"])
+    step(env, action, None, response)
+    detect_turn(len(st.session_state.messages) - 1, response)
+
+
+def step(env, action, technique, response):
+    """Record the turn in the environment and the chat document."""
     _, reward, terminated, truncated, info = env.step(action, technique, response)
+    save_turn(env.get_transcript()[-1].to_dict())
     st.session_state.turn += 1
-    st.session_state.temp_response = ""
     st.session_state.current_iteration += 1
     # if terminated:
     #     st.write("Manually terminated.")
-    #     logging.info("Manually terminated.")
+    #     logger.info("Manually terminated.")
     #     clean_chat()
     #     return
 
@@ -317,43 +492,54 @@ def run_conversation(env, players, is_stream, persona_hierarchy_info, main_categ
         #         st.write(info)
 
 
-def save_chat_history_to_firebase(prolific_id, chat_history):
-    """Save the chat history to Firebase Firestore."""
-    if "firestore_db" not in st.session_state:
-        logging.error("Firestore DB not set up. Please initialize Firebase first.")
+def save_turn(turn):
+    """Append the latest turn to the chat document, so partial sessions are kept."""
+    if "storage" not in st.session_state:
+        logger.error("Storage not set up. Please initialize the storage backend first.")
         return
 
-    db = st.session_state.firestore_db
-    document_name = f"chat_{prolific_id}_{int(time.time())}"  # Create a unique document name using prolific_id and timestamp
+    try:
+        st.session_state.storage.append_turn(CHAT_HISTORIES, st.session_state.chat_document_id, turn)
+    except Exception:
+        logger.exception("Failed to save the chat turn")
+
+
+def save_chat_history(prolific_id, chat_history, transcript=None):
+    """Save the chat history and its structured transcript."""
+    if "storage" not in st.session_state:
+        logger.error("Storage not set up. Please initialize the storage backend first.")
+        return
 
     # Prepare the data to be saved
     chat_document = {
         "prolific_id": prolific_id,
         "chat_history": chat_history,
-        "timestamp": firestore.SERVER_TIMESTAMP,  # Automatically set the timestamp in Firestore
+        "transcript": transcript,
     }
+    if st.session_state.get("ledger") is not None:
+        chat_document["budget"] = st.session_state.ledger.totals()
 
     try:
-        # Save the chat document to the Firestore collection named "chat_histories"
-        db.collection("group_two_chat_histories").document(document_name).set(chat_document)
-        logging.info("Chat history successfully saved to Firebase Firestore.")
-    except Exception as e:
-        logging.error(f"Failed to save chat history to Firebase Firestore: {e}")
+        # Save the chat document to the chat histories collection
+        st.session_state.storage.put_document(CHAT_HISTORIES, st.session_state.chat_document_id, chat_document)
+        logger.info("Chat history successfully saved.")
+    except Exception:
+        logger.exception("Failed to save chat history")
 
 
 def main():
     """Main function to run the Streamlit app."""
     PERSONA_FILENAME = "persona_info_hierarchy.csv"
-    UNN_INFO_FNAME = "unn_info.csv"
     
     # Streamlit page configuration
     configure_streamlit()
     initialize_session_state()
     setup_logging()
-    load_environment_variables()
-    setup_firebase() # Debug
-    main_categories, persona_category_info, persona_hierarchy_info = read_persona_csv(PERSONA_FILENAME)
-    read_unnecessary_info_csv(UNN_INFO_FNAME)
+    # Clients and immutable data are cached per process, later reruns only look them up
+    with perf.phase("load_resources"):
+        load_environment_variables()
+        setup_storage() # Debug
+        persona_catalog = load_persona_catalog(PERSONA_FILENAME)
 
     # Set default values for variables
     persuasion_techique = "0: None"
@@ -385,19 +571,22 @@ def main():
     if st.session_state.phase == "initial":
         # Display "Enter Prolific ID" and related UI elements
         ask_prolific_id()
+        warm_openings(agent_1, therapist_system_prompt, persuasion_techique, persuasion_flag, words_limit)
 
-        print("Prolific ID entered:", st.session_state.prolific_id_entered)
-        print("Current phase:", st.session_state.phase)
+        logger.debug("Prolific ID entered: %s, current phase: %s",
+                     st.session_state.prolific_id_entered, st.session_state.phase)
 
     elif st.session_state.phase == "chat" or st.session_state.phase == "post_survey":
-        # Disable the copy-paste functionality
-        disable_copy_paste() # Debug
-        # Place two images in like click to reveal the information # Half width for each image side by side
-        header = st.container()
-        header.image("webapp/assets/instruction.png", use_container_width=True)
-        col1, col2 = header.columns([3,3])
-        col1.image("webapp/assets/UserBioWeb1.png", use_container_width=True)
-        col2.image("webapp/assets/UserBioWeb2.png", use_container_width=True)
+        with perf.phase("disable_copy_paste"):
+            # Disable the copy-paste functionality
+            disable_copy_paste() # Debug
+        with perf.phase("header_images"):
+            # Place two images in like click to reveal the information # Half width for each image side by side
+            header = st.container()
+            header.image("webapp/assets/instruction.png", use_container_width=True)
+            col1, col2 = header.columns([3,3])
+            col1.image("webapp/assets/UserBioWeb1.png", use_container_width=True)
+            col2.image("webapp/assets/UserBioWeb2.png", use_container_width=True)
 
         # Streamlit sidebar
         st.sidebar.title("Your Related Information")
@@ -420,25 +609,13 @@ def main():
             env = st.session_state.env
 
             # Display all chat messages (history)
-            display_messages()
+            with perf.phase("display_messages"):
+                display_messages(len(env.transit))
 
             # Handle conversation loop
             if st.session_state.phase == "chat":
-                elapsed_time = time.time() - st.session_state.start_time
-
-                st.session_state_terminate_button_displayed = False
-                st.session_state_terminated_button = False
-                while True:
-                    run_conversation(env, players, is_stream, persona_hierarchy_info, main_categories, persona_category_info,
-                                     min_interaction_time, elapsed_time)
-
-                    if st.session_state.chat_finished:
-                        st.session_state.phase = "post_survey"
-                        chat_history = env.log_state()
-                        save_chat_history_to_firebase(st.session_state.prolific_id, chat_history) # Debug
-                        target_page = "pages/Survey.py"
-                        st.switch_page(target_page)
-                        # st.rerun()  # Trigger rerun to refresh UI
+                resume_conversation(env)
+                chat_turns(env, players, is_stream, persona_catalog, min_interaction_time)
 
         # If the chat is finished, proceed to the post-survey phase
         # Survey section should be displayed if in the post-survey phase
@@ -449,4 +626,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    perf.start_rerun("Chat_with_AI_Therapist")
+    try:
+        main()
+    finally:
+        perf.finish_rerun()
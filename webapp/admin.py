@@ -0,0 +1,105 @@
+# admin.py
+"""
+Operator page with the live metrics of a running instance of the study.
+
+It is not under pages/, so the participants never see it in the navigation. It runs
+as its own Streamlit app on the machine of the instance and reads the local metrics
+endpoint, see therapy_system.metrics:
+
+    streamlit run webapp/admin.py --server.port 8502
+
+With an [admin] token in the secrets the page is only shown for ?token=<token>.
+"""
+import os
+import re
+import urllib.request
+from collections import defaultdict
+from typing import Dict, List, Tuple
+import pandas as pd
+import streamlit as st
+
+METRICS_URL = os.environ.get("THERAPY_METRICS_URL", "http://127.0.0.1:9464/metrics")
+REFRESH_SECONDS = 5
+
+SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$")
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+# Metric, label and title of the headline numbers
+HEADLINES = [
+    ("therapy_active_sessions", "phase", "Active sessions"),
+    ("therapy_jobs", "status", "Background jobs"),
+    ("therapy_storage_writes_in_flight", "backend", "Storage writes in flight"),
+    ("therapy_errors_total", "call_site", "Errors"),
+]
+
+
+def unescape(label: str) -> str:
+    return re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), label)
+
+
+def parse_metrics(text: str) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+    """Samples of the Prometheus text format by sample name."""
+    samples = defaultdict(list)
+    for line in text.splitlines():
+        match = SAMPLE.match(line.strip())
+        if line.startswith("#") or match is None:
+            continue
+        name, labels, value = match.groups()
+        labels = {key: unescape(label) for key, label in LABEL.findall(labels or "")}
+        samples[name].append((labels, float(value)))
+    return samples
+
+
+def fetch_metrics(url: str = METRICS_URL) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+    with urllib.request.urlopen(url, timeout=2) as response:
+        return parse_metrics(response.read().decode())
+
+
+def samples_table(samples: List[Tuple[Dict[str, str], float]]) -> pd.DataFrame:
+    return pd.DataFrame([{**labels, "value": value} for labels, value in samples])
+
+
+def authorized() -> bool:
+    try:
+        token = st.secrets.get("admin", {}).get("token")
+    except FileNotFoundError:
+        # No secrets on the machine of the operator
+        token = None
+    return token is None or st.query_params.get("token") == token
+
+
+@st.fragment(run_every=REFRESH_SECONDS)
+def show_metrics():
+    try:
+        metrics = fetch_metrics()
+    except OSError as e:
+        st.error(f"No metrics at {METRICS_URL}: {e}")
+        return
+
+    columns = st.columns(len(HEADLINES))
+    for column, (name, label, title) in zip(columns, HEADLINES):
+        samples = metrics.get(name, [])
+        column.metric(title, f"{sum(value for _, value in samples):g}")
+        for labels, value in samples:
+            column.caption(f"{labels.get(label, '')}: {value:g}")
+
+    # Every metric as a table, the histograms by their counts and sums
+    for name in sorted(metrics):
+        if name.endswith("_bucket"):
+            continue
+        with st.expander(name):
+            st.dataframe(samples_table(metrics[name]), use_container_width=True, hide_index=True)
+
+
+def main():
+    st.set_page_config(page_title="Study metrics", layout="wide")
+    if not authorized():
+        st.error("Not authorized.")
+        st.stop()
+    st.title("Study metrics")
+    st.caption(f"{METRICS_URL}, refreshed every {REFRESH_SECONDS}s")
+    show_metrics()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# chat_state.py
+"""
+Turn state of the chat of a session.
+
+    idle -> generating_therapist -> streaming -> awaiting_patient -> generating_therapist ...
+                                                                  -> done
+
+The patient moves the chat on by sending a message, from the callback of the
+chat input, and the therapist replies in the rerun of the turns that follows.
+The reply is kept until it is in the conversation, so a reply cut off while it
+is shown is played again rather than generated again.
+Ending the therapy moves it to done from any state.
+"""
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import streamlit as st
+from therapy_system.log import get_logger
+
+logger = get_logger(__name__)
+
+IDLE = "idle" # conversation set up, no turn played yet
+AWAITING_PATIENT = "awaiting_patient"
+GENERATING_THERAPIST = "generating_therapist" # the message of the patient, if any, is played first
+STREAMING = "streaming"
+DONE = "done"
+
+# States each state moves to. A reply cut off by a rerun is played again.
+TRANSITIONS = {
+    IDLE: {AWAITING_PATIENT, GENERATING_THERAPIST, DONE},
+    AWAITING_PATIENT: {GENERATING_THERAPIST, DONE},
+    GENERATING_THERAPIST: {STREAMING, AWAITING_PATIENT, GENERATING_THERAPIST, DONE},
+    STREAMING: {AWAITING_PATIENT, GENERATING_THERAPIST, DONE},
+    DONE: set(),
+}
+
+
+@dataclass
+class ChatTurnState:
+    """
+    State of the turns of one conversation, with the message of the patient waiting to be played
+    and the (technique, response) of the therapist generated but not in the conversation yet.
+    """
+    state: str = IDLE
+    patient_message: Optional[str] = None
+    pending_reply: Optional[Tuple[Optional[str], str]] = None
+
+    def move(self, state: str):
+        if state not in TRANSITIONS[self.state]:
+            raise ValueError(f"The chat cannot move from {self.state} to {state}")
+        logger.debug("Chat turn moves from %s to %s", self.state, state)
+        self.state = state
+
+    def send(self, message: str):
+        """The patient sent the message, the therapist replies to it."""
+        self.move(GENERATING_THERAPIST)
+        self.patient_message = message
+
+    def patient_played(self):
+        """The message of the patient is in the conversation, only the reply is left."""
+        self.patient_message = None
+
+    def reply_generated(self, technique: Optional[str], response: str):
+        self.pending_reply = (technique, response)
+
+    def reply_played(self):
+        """The reply of the therapist is in the conversation."""
+        self.pending_reply = None
+
+    def resume(self):
+        """A reply cut off by a rerun, e.g. a closed tab or a click, is played again from pending_reply."""
+        if self.state == STREAMING:
+            self.move(GENERATING_THERAPIST)
+
+    def end(self):
+        if self.state != DONE:
+            self.move(DONE)
+
+    @property
+    def done(self) -> bool:
+        return self.state == DONE
+
+
+def new_chat_state() -> ChatTurnState:
+    """State of a new conversation of the session."""
+    st.session_state.chat_state = ChatTurnState()
+    return st.session_state.chat_state
+
+
+def get_chat_state() -> ChatTurnState:
+    """State of the conversation of the session, created on first use."""
+    if "chat_state" not in st.session_state:
+        return new_chat_state()
+    return st.session_state.chat_state
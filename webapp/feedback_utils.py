@@ -2,67 +2,254 @@
 import re
 import streamlit as st
 import time
-import logging
 import datetime
 import json
 import os
+import math
+import itertools
+import queue
+import unicodedata
 from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import List
+import numpy as np
 import pandas as pd
-from therapy_utils import generate_response, clean_chat
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from therapy_utils import stream_response, clean_chat
+from survey_state import get_survey_state
+from jobs import get_session_cancellation
+from therapy_system.utils import iter_json_object
+from therapy_system.agents.llm.structured import PARSE_STATS, OK, REPAIRED, FAILED
+from therapy_system.storage import SURVEY_TWO_RESPONSES
+from therapy_system.cancellation import Cancelled, CancellationToken
+from therapy_system.log import get_logger, with_log_context
+
+logger = get_logger(__name__)
 
 MIN_WORDS = 10
+POSTHOC_SURVEY_FILENAME = "posthoc_survey.csv"
+SURVEY_TWO = "post_survey_two" # name of the survey state of the detection feedback
 
-def enhance_evidence(evidence:str, usr_conv_list:List[str], agt_conv_list:List[str]) -> str:
+EVIDENCE_SEPARATOR = " | " # joins multiple quotes in one evidence, see DETECTION_SYSTEM_PROMPT
+EVIDENCE_NGRAM = 2 # token n-grams indexed by the evidence locator
+EVIDENCE_MIN_COVERAGE = 0.5 # share of the fragment n-grams found in a turn to locate it there
+EVIDENCE_MAX_SHIFT = 3 # tokens inserted or dropped by a paraphrase within a located fragment
+WORD_TOKEN = re.compile(r"[^\W_]+")
+
+
+def span_tokens(text: str) -> list:
+    """Normalized tokens of the text, see normalize_tokens, with their character span in the text."""
+    tokens = []
+    for match in WORD_TOKEN.finditer(text):
+        for token in normalize_tokens(match.group()):
+            tokens.append((token, match.start(), match.end()))
+    return tokens
+
+
+class EvidenceLocator:
+    """
+    Index of the patient messages of a conversation to find where each detection evidence was said.
+
+    Every token n-gram of the messages is indexed once. A fragment of evidence, an evidence
+    holds several fragments joined by EVIDENCE_SEPARATOR, is located by letting its n-grams
+    vote for a message and an alignment offset, so quotes with a few words changed,
+    added or dropped are still found.
+    """
+    def __init__(self, messages: List[dict]):
+        self.messages = messages
+        self.tokens = {}
+        self.index = defaultdict(list)
+        for turn_index, message in enumerate(messages):
+            if message["turn"] != "user":
+                continue
+            tokens = span_tokens(message["response"])
+            self.tokens[turn_index] = tokens
+            words = [token for token, _, _ in tokens]
+            for n in range(1, EVIDENCE_NGRAM + 1):
+                for position in range(len(words) - n + 1):
+                    self.index[tuple(words[position:position + n])].append((turn_index, position))
+
+    def locate_fragment(self, fragment: str):
+        """
+        Returns (turn index, start, end) of the character span of the fragment in the chat messages,
+        or None when no patient message covers enough of the fragment.
+        """
+        words = [token for token, _, _ in span_tokens(fragment)]
+        if not words:
+            return None
+        n = min(EVIDENCE_NGRAM, len(words))
+        # Votes per message for the offset of the fragment start in the message
+        votes = defaultdict(lambda: defaultdict(set))
+        for offset in range(len(words) - n + 1):
+            for turn_index, position in self.index.get(tuple(words[offset:offset + n]), ()):
+                votes[turn_index][position - offset].add(position)
+
+        best_turn, best_hits = None, []
+        for turn_index in sorted(votes):
+            shifts = votes[turn_index]
+            for shift in shifts:
+                # Hits on nearby offsets belong to the same quote with words inserted or dropped
+                hits = set().union(*(positions for other, positions in shifts.items()
+                                     if abs(other - shift) <= EVIDENCE_MAX_SHIFT))
+                # The earliest message wins a tie, where the information was first revealed
+                if len(hits) > len(best_hits):
+                    best_turn, best_hits = turn_index, hits
+        if len(best_hits) / (len(words) - n + 1) < EVIDENCE_MIN_COVERAGE:
+            return None
+        hits = sorted(best_hits)
+        tokens = self.tokens[best_turn]
+        return best_turn, tokens[hits[0]][1], tokens[hits[-1] + n - 1][2]
+
+    def locate(self, evidence: str) -> List[dict]:
+        """Span of each located fragment of the evidence, ordered as in the chat."""
+        spans = []
+        for fragment in evidence.split(EVIDENCE_SEPARATOR.strip()):
+            located = self.locate_fragment(fragment)
+            if located is not None:
+                turn_index, start, end = located
+                spans.append({"turn_index": turn_index, "start": start, "end": end})
+        return sorted(spans, key=lambda span: (span["turn_index"], span["start"]))
+
+    def question(self, turn_index: int):
+        """The chatbot message the patient message at turn_index answered."""
+        for message in reversed(self.messages[:turn_index]):
+            if message["turn"] == "assistant":
+                return message["response"]
+        return None
+
+
+def get_evidence_locator() -> EvidenceLocator:
+    """Evidence locator of the chat, built once per conversation."""
+    locator = st.session_state.get("evidence_locator")
+    if locator is None or locator.messages is not st.session_state.messages:
+        locator = st.session_state.evidence_locator = EvidenceLocator(st.session_state.messages)
+    return locator
+
+
+def enhance_evidence(evidence: str, locator: EvidenceLocator):
     """
-    Enhance the evidence by adding chatbot quesion reference in the click to see in chat feature.
+    Enhance the evidence for the click to see in chat feature: each patient message
+    revealing it is shown with the located quote in bold, after the chatbot question it answered.
+    Returns the text and the located spans.
     """
-    # Obtains the question asked by the chatbot for the evidence
-    search_indx = None
-    for indx, message in enumerate(usr_conv_list):
-        if evidence in message:
-            print(f"""Evidence: {evidence}, indx: {indx}""")
-            search_indx = indx
-            break
-    if search_indx is not None:
-        agent_question = agt_conv_list[search_indx]
-        return f"AI therapy:{agent_question} {os.linesep} You: **{evidence}**"
-    # If the evidence is not found in the user conversation, return the evidence as it is
-    return f"You: **{evidence}**"
+    spans = locator.locate(evidence)
+    if not spans:
+        # If the evidence is not found in the user conversation, return the evidence as it is
+        return f"You: **{evidence}**", spans
+
+    parts = []
+    for turn_index, turn_spans in itertools.groupby(spans, key=lambda span: span["turn_index"]):
+        message = locator.messages[turn_index]["response"]
+        text, last = "", 0
+        for span in turn_spans:
+            if span["start"] < last:
+                continue
+            text += f"{message[last:span['start']]}**{message[span['start']:span['end']]}**"
+            last = span["end"]
+        text += message[last:]
+        agent_question = locator.question(turn_index)
+        parts.append(f"AI therapy: {agent_question} {os.linesep} You: {text}" if agent_question else f"You: {text}")
+    return (os.linesep * 2).join(parts), spans
+
+
+class SurveySampler:
+    """
+    Samples the detections shown in the survey while they are still arriving.
+    Each category first gets an equal share of the max_display slots, the slots
+    left over by categories with few detections are filled in `finish`.
+    """
+    def __init__(self, categories: List[str], max_display: int = 10):
+        self.max_display = max_display
+        self.share = max(1, math.ceil(max_display / max(1, len(categories))))
+        self.sampled = {}
+        self.per_category = defaultdict(int)
+        self.held_back = defaultdict(list)
+
+    def offer(self, key: str, detection: dict) -> bool:
+        """Returns True when the detection is sampled right away."""
+        category = detection["category"]
+        if len(self.sampled) < self.max_display and self.per_category[category] < self.share:
+            self.sampled[key] = detection
+            self.per_category[category] += 1
+            return True
+        self.held_back[category].append((key, detection))
+        return False
+
+    def finish(self) -> dict:
+        """Fill the remaining slots one category at a time and return the sample."""
+        while len(self.sampled) < self.max_display and any(self.held_back.values()):
+            for category in sorted(self.held_back):
+                if len(self.sampled) >= self.max_display:
+                    break
+                if self.held_back[category]:
+                    key, detection = self.held_back[category].pop(0)
+                    self.sampled[key] = detection
+        return self.sampled
+
+
+def add_better_evidence(detection: dict):
+    """
+    Adds the evidence with the chatbot question it answered, used by the see in chat feature,
+    and the chat turns and character spans where it was said.
+    """
+    detection["better_evidence"], detection["evidence_spans"] = enhance_evidence(detection["revealation"],
+                                                                                 get_evidence_locator())
 
 
 def get_survey_sample(all_detections:dict, max_display:int = 10):
     """
     This function samples the survey questions for the user to provide feedback.
     """
-    user_conv_list = st.session_state.usr_conv_list
-    agent_conv_list = st.session_state.agt_conv_list
-
     for key in all_detections:
-        evidence = all_detections[key]["revealation"]
-        better_evidence = enhance_evidence(evidence, user_conv_list, agent_conv_list)
-        all_detections[key]["better_evidence"] = better_evidence
+        add_better_evidence(all_detections[key])
 
-    if len(all_detections) <= max_display:
-        return all_detections
-
-    # Group the detections by category
-    categories = defaultdict(list)
+    sampler = SurveySampler({value["category"] for value in all_detections.values()}, max_display)
     for key, value in all_detections.items():
-        categories[value["category"]].append(key)
-    
-    # Start with sampling
-    samples, sampled_detections = 0, {}
-    while samples < max_display:
-        for category in sorted(categories):
-            if samples >= max_display:
-                return sampled_detections
-                # We can sample only if the category has more than one detection
-            if len(categories[category]):
-                key = categories[category].pop(0)
-                sampled_detections[key] = all_detections[key]
-                samples += 1
-    return sampled_detections
+        sampler.offer(key, value)
+    return sampler.finish()
+
+
+def stream_survey_sample(max_display:int = 10):
+    """
+    Runs the detection and lists each sampled detection as soon as it is reported,
+    while the other phrases are still being analyzed.
+    With a turn detector, its detections are kept and only the turns it did not check are analyzed.
+    Sets the complete detections and the survey info when the detection is finished.
+    """
+    survey_info = st.session_state.posthoc_survey_info
+    sampler = SurveySampler(survey_info["category"].unique().tolist(), max_display)
+    complete_detections, failed_shards = {}, []
+
+    phrases, conversation, found = survey_info, st.session_state.user_conversation, {}
+    turn_detector = st.session_state.get("turn_detector")
+    if turn_detector is not None:
+        turn_detector.stop()
+        found, failed_turns = turn_detector.results()
+        logger.info("Detections made during the chat: %s, turns not checked: %s", found, list(failed_turns))
+        st.session_state.detection_failed_turns = list(failed_turns)
+        phrases = survey_info.drop(index=[int(key) for key in found])
+        conversation = "\n".join(failed_turns.values())
+    detections = iter_disclosures(phrases, conversation, failed_shards, ledger=st.session_state.get("ledger"),
+                                  cancellation=get_session_cancellation()) if conversation else iter(())
+
+    st.subheader("Select the following information that you think it's necessary to share for the therapy")
+    with st.spinner("Analyzing conversation..."):
+        for key, detection in itertools.chain(found.items(), detections):
+            complete_detections[key] = detection
+            if sampler.offer(key, detection):
+                add_better_evidence(detection)
+                # Preview only, the selectable checkboxes are shown once the detection is complete
+                st.checkbox(f"{detection['survey_display']}", value=False, disabled=True)
+
+    for detection in complete_detections.values():
+        if "better_evidence" not in detection:
+            add_better_evidence(detection)
+    st.session_state.complete_detections = dict(sorted(complete_detections.items(), key=lambda item: int(item[0])))
+    st.session_state.detection_failed_shards = failed_shards
+    st.session_state.survey_info = sampler.finish()
+    logger.info("Complete Detections : %s", st.session_state.complete_detections)
+    logger.info("Sampled Survey info: %s", st.session_state.survey_info)
 
 
 def disable_copy_paste():
@@ -169,12 +356,48 @@ def disable_copy_paste():
         """, unsafe_allow_html=True)
 
 
-def get_survey_info():
-    """
-    Use GPT-4 to determine the survey questions for post conversation
-    Return all the detected revealed unnecessary information.
+# Detection is split into one request per phrase category, run concurrently
+DETECTION_MODEL = "gpt-4o-mini"
+DETECTION_SHARD_COLUMN = "category"
+DETECTION_SHARD_MAX_TOKENS = 800
+DETECTION_SHARD_TIMEOUT = 30 # seconds per attempt
+DETECTION_SHARD_RETRIES = 2 # attempts after the first one
+DETECTION_FINISH_POLL = 0.2 # seconds between the checks of the cancellation while the turn detection finishes
+
+DETECTION_SYSTEM_PROMPT = """
+    You are a smart semantic analyzer that evaluates dialogue content against specific phrases. 
+    Your core capabilities include:
+        1. MATCHING LEVELS
+        - Direct matches (exact or rephrased)
+        - Semantic equivalents (synonyms, contextual matches)
+        - Logical inferences (combined evidence)
+        - Professional terminology alignment
+        - Name/location variations
+
+        2. PRESENT CRITERIA
+        Answer "Yes" when information is:
+        - Explicitly stated
+        - Clearly paraphrased
+        - Logically inferrable
+        Answer "No" when:
+        - Information contradicts dialogue
+        - Cannot be reasonably inferred
+        - Too speculative
+
+        3. EVIDENCE STANDARDS
+        - Use exact quotes from text
+        - Multiple quotes separated by ' | '
+        - Include context for clarity
+        - All supporting evidence for inferences
+
+        You must be precise, thorough, and avoid speculation beyond reasonable inference.
     """
 
+
+def detection_prompt(phrases: dict, conversation: str) -> str:
+    """
+    User prompt checking the conversation against the phrases, a dict of phrase index to phrase.
+    """
     # Define the response format exclusively as we cannot have {} in the user prompt
     json_response_format = {
         "phrase": "[The phrase being checked]",
@@ -183,14 +406,14 @@ def get_survey_info():
     }
 
     # User Prompt to set the format of the output and provide only when there is a match.
-    user_prompt = f"""Analyze the given dialogue carefully and compare it against each phrase in the specified list of phrases (including some rewording of the phrases, or can be easily inferred). For each phrase:
+    return f"""Analyze the given dialogue carefully and compare it against each phrase in the specified list of phrases (including some rewording of the phrases, or can be easily inferred). For each phrase:
 
         1. Determine if the phrase or its semantic equivalent is present in the dialogue. Consider:
         - Exact matches
         - Paraphrases or rewordings
         - Implied meanings that can be reasonably inferred from the context
 
-        2. Provide a nested JSON response where key is the index of each phrase in the list of phrases and value is the phrase attributes, i.e. for each phrase provide a Json response with the following structure:
+        2. Provide a nested JSON response where key is the index of each phrase given below and value is the phrase attributes, i.e. for each phrase provide a Json response with the following structure:
         {json_response_format}
 
         3. For the "present" field:
@@ -199,77 +422,524 @@ def get_survey_info():
 
         4. For the "evidence" field:
         - If present, provide the most relevant quote from the dialogue
-        - If not present, skip the field
+        - If not present, leave it empty
 
         Ensure your analysis is thorough and considers both explicit and implicit information in the dialogue.
         
-        ### Phrases to check against:
-        {st.session_state.posthoc_survey_info['user_mentioned'].tolist()}
+        ### Phrases to check against, by index:
+        {json.dumps({str(index): phrase for index, phrase in phrases.items()}, ensure_ascii=False)}
 
         ### Dialogue:
-        {st.session_state.user_conversation}
+        {conversation}
         """
 
-    system_prompt = """
-    You are a smart semantic analyzer that evaluates dialogue content against specific phrases. 
-    Your core capabilities include:
-        1. MATCHING LEVELS
-        - Direct matches (exact or rephrased)
-        - Semantic equivalents (synonyms, contextual matches)
-        - Logical inferences (combined evidence)
-        - Professional terminology alignment
-        - Name/location variations
 
-        2. PRESENT CRITERIA
-        Answer "Yes" when information is:
-        - Explicitly stated
-        - Clearly paraphrased
-        - Logically inferrable
-        Answer "No" when:
-        - Information contradicts dialogue
-        - Cannot be reasonably inferred
-        - Too speculative
+def detection_schema(phrases: dict) -> dict:
+    """Strict JSON schema of the detection response for the phrases, a dict of phrase index to phrase."""
+    detection = {
+        "type": "object",
+        "properties": {
+            "phrase": {"type": "string"},
+            "present": {"type": "string", "enum": ["Yes", "No"]},
+            "evidence": {"type": "string"},
+        },
+        "required": ["phrase", "present", "evidence"],
+        "additionalProperties": False,
+    }
+    keys = [str(index) for index in phrases]
+    return {
+        "type": "object",
+        "properties": {key: detection for key in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
 
-        3. EVIDENCE STANDARDS
-        - Use exact quotes from text
-        - Multiple quotes separated by ' | '
-        - Include context for clarity
-        - All supporting evidence for inferences
 
-        You must be precise, thorough, and avoid speculation beyond reasonable inference.
+# Lexical pre-filter, see prefilter_phrases
+PRESENT, ABSENT, UNCERTAIN = "present", "absent", "uncertain"
+PREFILTER_PRESENT_SIMILARITY = 0.85 # bigram Dice similarity of a token to count as a match of a name
+PREFILTER_ABSENT_SIMILARITY = 0.75 # below this no conversation token is close enough to the phrase
+# The absent rule also rules out paraphrases, e.g. "I'm a marketer" for Marketing or "late 20s" for 28.
+# It stays opt-in until benchmarks/prefilter_agreement.py shows it agrees with the LLM-only detection.
+PREFILTER_ABSENT = False
+GENERIC_WORDS = {"the", "user", "users", "user's", "you", "your", "a", "an"}
+NUMBER_WORDS = ["zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+                "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen", "nineteen"]
+TENS_WORDS = ["", "", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety"]
+ENTITY_ALIASES = {
+    ("new", "york"): [("nyc",), ("new", "york", "city")],
+    ("nyc",): [("new", "york"), ("new", "york", "city")],
+}
+CAPITALIZED_WORD = re.compile(r"[A-Z][\w'’-]*")
+PARENTHESIZED = re.compile(r"((?:[A-Z][\w'’-]*\s*)*)\(([^)]+)\)")
+
+
+def normalize_tokens(text: str) -> tuple:
+    """Lowercase alphanumeric tokens of the text, with unicode quotes and accents folded."""
+    text = unicodedata.normalize("NFKD", text).lower().replace("’", "'")
+    return tuple(re.findall(r"[a-z0-9]+", text))
+
+
+def number_variants(number: str) -> list:
+    """The number in digits and, below 100, in words."""
+    variants = [(number,)]
+    n = int(number)
+    if n < 20:
+        variants.append((NUMBER_WORDS[n],))
+    elif n < 100:
+        variants.append((TENS_WORDS[n // 10],) if n % 10 == 0 else (TENS_WORDS[n // 10], NUMBER_WORDS[n % 10]))
+    return variants
+
+
+def catalog_proper_nouns(phrases: List[str]) -> set:
+    """Words capitalized inside a sentence of the catalog, used to tell names from capitalized first words."""
+    nouns = set()
+    for phrase in phrases:
+        for part in re.split(r"\s/\s", phrase):
+            for word in part.split()[1:]:
+                bare = word.strip(".,;:()")
+                if CAPITALIZED_WORD.fullmatch(bare) and bare.lower().replace("’", "'") not in GENERIC_WORDS:
+                    nouns.update(normalize_tokens(bare))
+    return nouns
+
+
+def phrase_anchors(phrase: str, proper_nouns: set) -> list:
     """
+    Concrete strings of the phrase, i.e. names, places, acronyms and numbers, that cannot be
+    revealed without being written. Each anchor is a list of variants, each variant a token tuple.
+    """
+    anchors = []
+    # Parenthesized alternatives and acronyms, e.g. "Generalized Anxiety Disorder (GAD)", "(Ambien/Zolpidam)"
+    for match in PARENTHESIZED.finditer(phrase):
+        variants = [normalize_tokens(variant) for variant in match.group(2).split("/")]
+        if match.group(1).strip():
+            variants.append(normalize_tokens(match.group(1)))
+        anchors.append(variants)
+    text = PARENTHESIZED.sub(" , ", phrase)
+
+    # Capitalized spans, the first word of a sentence only counts when it is a proper noun of the catalog
+    for part in re.split(r"\s/\s", text):
+        span = []
+        for i, word in enumerate(part.split() + [","]):
+            bare = word.strip(".,;:")
+            tokens = normalize_tokens(bare)
+            keep = (CAPITALIZED_WORD.fullmatch(bare) is not None
+                    and bare.lower().replace("’", "'") not in GENERIC_WORDS
+                    and (i > 0 or (len(tokens) > 0 and tokens[0] in proper_nouns)))
+            if keep:
+                span.append(bare)
+            if span and (not keep or word.endswith((",", ".", ";"))):
+                tokens = normalize_tokens(" ".join(span))
+                anchors.append([tokens] + ENTITY_ALIASES.get(tokens, []))
+                span = []
+
+    for number in re.findall(r"\b\d+\b", text):
+        anchors.append(number_variants(number))
+    return anchors
+
+
+def _bigrams(token: str) -> set:
+    padded = f" {token} "
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def token_similarity(tokens: List[str], vocabulary: List[str]) -> np.ndarray:
+    """
+    Similarity of each token to each vocabulary word as the Dice coefficient of their character bigrams,
+    computed for all pairs at once. Numbers and tokens shorter than 4 characters only match exactly.
+    """
+    grams = {gram: i for i, gram in enumerate(sorted(set().union(*map(_bigrams, tokens), *map(_bigrams, vocabulary))))}
 
-    gpt_response = generate_response(
-        system_prompt=system_prompt,
-        user_prompt=user_prompt,
-        model="gpt-4o-mini",
-        max_tokens=2000,
-        temperature=0
-    )
-
-    logging.info("Detection GPT-4 responses : %s", gpt_response)
-
-    # Process to get rid of code and other unwanted characters
-    gpt_response = gpt_response.replace('```json', '').replace('```', '').strip()
-
-    # Evaluate the json and store it in a dictionary
-    llm_responses = json.loads(gpt_response)
-
-    survey_questions = {}
-    for key in llm_responses:
-        if llm_responses[key]["present"].lower() == "yes":
-            kn = int(key)
-            survey_questions[key] = {
-                "revealation": llm_responses[key]["evidence"],
-                "category": st.session_state.posthoc_survey_info.loc[kn, "category"],
-                "priority": st.session_state.posthoc_survey_info.loc[kn, "category priority"].astype(int).astype(str),
-                "user_mentioned": st.session_state.posthoc_survey_info.loc[kn, "user_mentioned"],
-                "survey_display": st.session_state.posthoc_survey_info.loc[kn, "survey_display"],
-            }
+    def incidence(words):
+        matrix = np.zeros((len(words), len(grams)), dtype=np.float32)
+        for row, word in enumerate(words):
+            matrix[row, [grams[gram] for gram in _bigrams(word)]] = 1
+        return matrix
+
+    token_grams, vocabulary_grams = incidence(tokens), incidence(vocabulary)
+    shared = token_grams @ vocabulary_grams.T
+    dice = 2 * shared / (token_grams.sum(axis=1)[:, None] + vocabulary_grams.sum(axis=1)[None, :])
+    exact = np.array(tokens, dtype=object)[:, None] == np.array(vocabulary, dtype=object)[None, :]
+    fuzzy = np.array([len(token) >= 4 and not token.isdigit() for token in tokens])[:, None]
+    return np.where(fuzzy, dice, exact.astype(np.float32))
+
+
+def prefilter_phrases(survey_info: pd.DataFrame, conversation: str, indices: List[int] = None,
+                      absent: bool = PREFILTER_ABSENT) -> pd.DataFrame:
+    """
+    Classify each survey phrase from the words of the conversation, one patient message per line:
+    - present: the full name the phrase is about is written in a message, the evidence is its sentence
+    - absent, only with absent: no word of the concrete strings of the phrase, or a close variant, is written
+    - uncertain: everything else, left to the LLM detection
+    Only the phrases at indices are classified when given.
+    Returns a frame indexed like the phrases with the status and evidence columns.
+    """
+    proper_nouns = catalog_proper_nouns(survey_info["user_mentioned"].tolist())
+    phrases = survey_info["user_mentioned"] if indices is None else survey_info.loc[indices, "user_mentioned"]
+    anchors = {kn: phrase_anchors(phrase, proper_nouns) for kn, phrase in phrases.items()}
+
+    messages = [message for message in conversation.split("\n") if message.strip()]
+    message_tokens = [normalize_tokens(message) for message in messages]
+    vocabulary = sorted({token for tokens in message_tokens for token in tokens})
+    anchor_tokens = sorted({token for variants in anchors.values() for anchor in variants
+                            for variant in anchor for token in variant})
+
+    # Conversation words close enough to each anchor token
+    if anchor_tokens and vocabulary:
+        similarity = token_similarity(anchor_tokens, vocabulary)
+    else:
+        similarity = np.zeros((len(anchor_tokens), len(vocabulary)), dtype=np.float32)
+    words = np.array(vocabulary, dtype=object)
+    close = {token: set(words[similarity[row] >= PREFILTER_ABSENT_SIMILARITY])
+             for row, token in enumerate(anchor_tokens)}
+    matching = {token: set(words[similarity[row] >= PREFILTER_PRESENT_SIMILARITY])
+                for row, token in enumerate(anchor_tokens)}
+
+    def name_evidence(name):
+        for message, tokens in zip(messages, message_tokens):
+            for start in range(len(tokens) - len(name) + 1):
+                if all(tokens[start + i] in matching[token] for i, token in enumerate(name)):
+                    sentences = re.split(r"(?<=[.!?])\s+", message)
+                    return next((sentence.strip() for sentence in sentences
+                                 if tokens[start] in normalize_tokens(sentence)), message.strip())
+        return None
+
+    rows = {}
+    for kn, phrase in phrases.items():
+        status, evidence = UNCERTAIN, None
+        if "name" in phrase.lower():
+            names = [variant for anchor in anchors[kn] for variant in anchor if len(variant) >= 2]
+            evidence = next(filter(None, map(name_evidence, names)), None)
+            if evidence is not None:
+                status = PRESENT
+        if (absent and status == UNCERTAIN and anchors[kn]
+                and not any(close[token] for anchor in anchors[kn] for variant in anchor for token in variant)):
+            status = ABSENT
+        rows[kn] = {"status": status, "evidence": evidence}
+    return pd.DataFrame.from_dict(rows, orient="index", columns=["status", "evidence"])
+
+
+def check_detection(key: str, value, phrases: dict):
+    """
+    Strict schema check of one streamed detection object.
+    Returns the phrase index and the evidence, which is None when the phrase is not present,
+    or None for a key that is not the index of one of the phrases.
+    Raises ValueError when the object does not follow the response format.
+    """
+    if not key.isdigit() or int(key) not in phrases:
+        return None
+    if not isinstance(value, dict):
+        raise ValueError(f"Detection of phrase {key} is not an object: {value}")
+    present = value.get("present")
+    if not isinstance(present, str) or present.lower() not in ("yes", "no"):
+        raise ValueError(f"Detection of phrase {key} has an invalid present field: {present}")
+    if present.lower() == "no":
+        return int(key), None
+    evidence = value.get("evidence")
+    if not isinstance(evidence, str) or not evidence.strip():
+        raise ValueError(f"Detection of phrase {key} is present without evidence")
+    return int(key), evidence
+
+
+def iter_shard_detections(phrases: dict, conversation: str,
+                          retries: int = DETECTION_SHARD_RETRIES,
+                          timeout: float = DETECTION_SHARD_TIMEOUT,
+                          ledger=None, call_site: str = "survey_detection", cancellation=None):
+    """
+    Stream the detection of the phrases of one shard and yield (phrase index, evidence)
+    for each present phrase as soon as its object is complete.
+    The response is constrained to detection_schema. A failed or malformed response is retried
+    for the phrases not answered yet, the outcome is counted in PARSE_STATS as survey_detection.
+    Raises the last error when all the attempts fail, and Cancelled at once when the token is cancelled.
+    """
+    remaining = dict(phrases)
+    for attempt in range(retries + 1):
+        try:
+            stream = stream_response(
+                system_prompt=DETECTION_SYSTEM_PROMPT,
+                user_prompt=detection_prompt(remaining, conversation),
+                model=DETECTION_MODEL,
+                max_tokens=DETECTION_SHARD_MAX_TOKENS,
+                temperature=0,
+                timeout=timeout,
+                response_schema=detection_schema(remaining),
+                schema_name="survey_detection",
+                ledger=ledger,
+                call_site=call_site,
+                cancellation=cancellation,
+            )
+            for key, value in iter_json_object(stream):
+                detection = check_detection(key, value, remaining)
+                if detection is None:
+                    # Answers for phrases of other shards, or answered twice, are ignored
+                    logger.warning("Detection response has an unknown phrase index %s", key)
+                    continue
+                kn, evidence = detection
+                del remaining[kn]
+                logger.info("Detection of phrase %d: %s", kn, value)
+                if evidence is not None:
+                    yield kn, evidence
+            # The usage of the request comes after the end of the JSON object
+            for _ in stream:
+                pass
+        except Cancelled:
+            raise
+        except Exception as e:
+            logger.warning("Detection attempt %d for phrases %s failed: %s", attempt + 1, list(remaining), e)
+            error = e
+            continue
+        if remaining:
+            # Phrases left out of a well-formed response are not present
+            logger.info("Detection response skipped phrases %s", list(remaining))
+        PARSE_STATS.record("survey_detection", REPAIRED if attempt else OK)
+        return
+    PARSE_STATS.record("survey_detection", FAILED)
+    raise error
+
+
+def detection_record(survey_info: pd.DataFrame, kn: int, evidence: str) -> dict:
+    """Survey entry of the phrase with index kn revealed by the evidence."""
+    return {
+        "revealation": evidence,
+        "category": survey_info.loc[kn, "category"],
+        "priority": survey_info.loc[kn, "category priority"].astype(int).astype(str),
+        "user_mentioned": survey_info.loc[kn, "user_mentioned"],
+        "survey_display": survey_info.loc[kn, "survey_display"],
+    }
+
+
+def iter_disclosures(survey_info: pd.DataFrame, conversation: str, failed_shards: list = None,
+                     shard_by: str = DETECTION_SHARD_COLUMN, prefilter: bool = True, ledger=None, cancellation=None):
+    """
+    Detect the survey phrases revealed in the conversation with one concurrent streamed request per shard,
+    yielding (phrase index as a string, survey entry) as soon as any shard reports a detection.
+    With prefilter, the phrases settled by prefilter_phrases are not sent to the LLM.
+    The requests are recorded in the budget ledger of the session when it is given,
+    and stopped once the cancellation token is cancelled.
+    A shard that still fails after its retries is added to failed_shards, the others are kept.
+    """
+    phrases = survey_info
+    if prefilter:
+        statuses = prefilter_phrases(survey_info, conversation)
+        for kn, evidence in statuses.loc[statuses["status"] == PRESENT, "evidence"].items():
+            yield str(kn), detection_record(survey_info, kn, evidence)
+        phrases = survey_info.loc[statuses["status"] == UNCERTAIN]
+        logger.info("Pre-filter left %d of %d phrases to the LLM", len(phrases), len(survey_info))
+
+    shards = {
+        shard: phrases.loc[indices, "user_mentioned"].to_dict()
+        for shard, indices in phrases.groupby(shard_by).groups.items()
+    }
+    results = queue.Queue()
+
+    def run_shard(shard, phrases):
+        try:
+            for kn, evidence in iter_shard_detections(phrases, conversation, ledger=ledger,
+                                                      cancellation=cancellation):
+                results.put((kn, evidence))
+        except Cancelled:
+            pass
+        except Exception as e:
+            logger.error("Detection failed for %s %s: %s", shard_by, shard, e)
+            if failed_shards is not None:
+                failed_shards.append(shard)
+        finally:
+            results.put(None)
+
+    # The workers can use the streamlit caches of the session that started the detection
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=len(shards) or 1,
+                            initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+        for shard, phrases in shards.items():
+            executor.submit(with_log_context(run_shard), shard, phrases)
+        running = len(shards)
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+            kn, evidence = result
+            yield str(kn), detection_record(survey_info, kn, evidence)
+
+
+def detect_disclosures(survey_info: pd.DataFrame, conversation: str, shard_by: str = DETECTION_SHARD_COLUMN,
+                       prefilter: bool = True, ledger=None, cancellation=None):
+    """
+    Returns all the detections keyed by the phrase index as a string, and the list of failed shards.
+    """
+    failed_shards = []
+    survey_questions = dict(iter_disclosures(survey_info, conversation, failed_shards, shard_by, prefilter, ledger,
+                                             cancellation))
+    # Keep the order of the survey phrases
+    survey_questions = dict(sorted(survey_questions.items(), key=lambda item: int(item[0])))
+    return survey_questions, failed_shards
+
+
+def get_survey_info():
+    """
+    Use GPT-4 to determine the survey questions for post conversation
+    Return all the detected revealed unnecessary information.
+    """
+    survey_questions, failed_shards = detect_disclosures(st.session_state.posthoc_survey_info,
+                                                         st.session_state.user_conversation,
+                                                         ledger=st.session_state.get("ledger"))
+    st.session_state.detection_failed_shards = failed_shards
     st.session_state.complete_detections = survey_questions
     return survey_questions
 
 
+class IncrementalDetector:
+    """
+    Checks each new patient message against the survey phrases not detected yet, in the background
+    while the chat goes on, and keeps the running detections. Each detection carries the
+    turn_index of the message in the chat messages where the phrase was first revealed.
+    Messages are checked one at a time in the order they were sent.
+    """
+    def __init__(self, survey_info: pd.DataFrame, ledger=None, cancellation=None):
+        self.survey_info = survey_info
+        self.ledger = ledger
+        # Cancelled with the session, or alone when the detector is finished
+        self.cancellation = cancellation.child() if cancellation is not None else CancellationToken()
+        self.detections = {}
+        self.failed_turns = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="turn_detection")
+        # Turn index and message of each queued detection
+        self._futures = {}
+
+    def submit(self, turn_index: int, message: str):
+        """Queue the detection of a patient message."""
+        ctx = get_script_run_ctx()
+        future = self._executor.submit(with_log_context(self._detect_turn), turn_index, message, ctx)
+        self._futures[future] = (turn_index, message)
+
+    def remaining_phrases(self) -> dict:
+        with self._lock:
+            detected = {int(key) for key in self.detections}
+        return {kn: phrase for kn, phrase in self.survey_info["user_mentioned"].items() if kn not in detected}
+
+    def _detect_turn(self, turn_index, message, ctx):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        phrases = self.remaining_phrases()
+        if not phrases:
+            return
+
+        # Phrases settled by the words of the message are not sent to the LLM
+        statuses = prefilter_phrases(self.survey_info, message, list(phrases))
+        found = statuses.loc[statuses["status"] == PRESENT, "evidence"].to_dict()
+        phrases = {kn: phrase for kn, phrase in phrases.items() if statuses.loc[kn, "status"] == UNCERTAIN}
+        try:
+            detections = (iter_shard_detections(phrases, message, ledger=self.ledger, call_site="turn_detection",
+                                                cancellation=self.cancellation)
+                          if phrases else iter(()))
+            for kn, evidence in itertools.chain(found.items(), detections):
+                record = detection_record(self.survey_info, kn, evidence)
+                record["turn_index"] = turn_index
+                with self._lock:
+                    self.detections[str(kn)] = record
+            with self._lock:
+                self.failed_turns.pop(turn_index, None)
+        except Cancelled:
+            with self._lock:
+                self.failed_turns[turn_index] = message
+        except Exception as e:
+            logger.error("Detection failed for turn %d: %s", turn_index, e)
+            with self._lock:
+                self.failed_turns[turn_index] = message
+
+    def _wait(self, timeout: float, cancellation=None) -> bool:
+        """Wait for the queued messages, False when the detector or the cancellation token was cancelled meanwhile."""
+        deadline = time.monotonic() + timeout
+        pending = [future for future in list(self._futures) if not future.done()]
+        while pending:
+            if self.cancellation.cancelled or (cancellation is not None and cancellation.cancelled):
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _, pending = wait(pending, timeout=min(remaining, DETECTION_FINISH_POLL))
+        return not self.cancellation.cancelled
+
+    def finish(self, timeout: float = DETECTION_SHARD_TIMEOUT * (DETECTION_SHARD_RETRIES + 1), cancellation=None):
+        """
+        Wait for the queued messages, retry the failed ones once and stop the worker.
+        Once the cancellation token, e.g. of the job finishing the detection, is cancelled, the
+        detector stops at once without the retry.
+        Returns the results, see results.
+        """
+        if self._wait(timeout, cancellation):
+            with self._lock:
+                failed_turns = dict(self.failed_turns)
+            for turn_index, message in sorted(failed_turns.items()):
+                self.submit(turn_index, message)
+            self._wait(timeout, cancellation)
+        self.stop()
+        return self.results()
+
+    def stop(self):
+        """Stop the worker, the queued messages are dropped and the running one is cancelled."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.cancellation.cancel("finished")
+
+    def results(self):
+        """
+        Returns the detections in the order of the survey phrases and the messages of the turns
+        not checked by turn index: those that failed and, once stopped, those still queued or running.
+        """
+        with self._lock:
+            for future, (turn_index, message) in list(self._futures.items()):
+                if future.cancelled() or (self.cancellation.cancelled and not future.done()):
+                    self.failed_turns[turn_index] = message
+            detections = dict(sorted(self.detections.items(), key=lambda item: int(item[0])))
+            failed_turns = dict(sorted(self.failed_turns.items()))
+        return detections, failed_turns
+
+
+def start_turn_detection():
+    """Start the background detection of the patient messages for a new chat."""
+    catalog = load_posthoc_survey_catalog(POSTHOC_SURVEY_FILENAME)
+    # The survey still needs the detections after the chat ends, they stop only when the session is closed
+    st.session_state.turn_detector = IncrementalDetector(catalog["data"], st.session_state.get("ledger"),
+                                                         get_session_cancellation())
+
+
+def detect_turn(turn_index: int, message: str):
+    """Queue the detection of the patient message at turn_index of the chat messages."""
+    detector = st.session_state.get("turn_detector")
+    if detector is not None:
+        detector.submit(turn_index, message)
+
+
+def prepare_detections(turn_detector, survey_info: pd.DataFrame, conversation: str, ledger=None,
+                       cancellation=None) -> dict:
+    """
+    Complete detections of the chat as session state values, safe to run without the session:
+    the detections made during the chat by the turn detector when there is one, completed by
+    the detection of the turns it did not check, otherwise the detection of the whole conversation.
+    """
+    if turn_detector is None:
+        complete_detections, failed_shards = detect_disclosures(survey_info, conversation, ledger=ledger,
+                                                                cancellation=cancellation)
+        return {"complete_detections": complete_detections, "detection_failed_shards": failed_shards}
+
+    complete_detections, failed_turns = turn_detector.finish(cancellation=cancellation)
+    if cancellation is not None and cancellation.cancelled:
+        # Nobody takes the result, the survey detects the turns not checked in the foreground
+        return {}
+    logger.info("Detections made during the chat: %s, turns not checked: %s", complete_detections,
+                list(failed_turns))
+    failed_shards = []
+    if failed_turns:
+        # The phrases not found yet are detected in the turns not checked, as for a whole conversation
+        phrases = survey_info.drop(index=[int(key) for key in complete_detections])
+        detections, failed_shards = detect_disclosures(phrases, "\n".join(failed_turns.values()), ledger=ledger,
+                                                       cancellation=cancellation)
+        complete_detections = dict(sorted({**complete_detections, **detections}.items(),
+                                          key=lambda item: int(item[0])))
+    return {"complete_detections": complete_detections, "detection_failed_turns": list(failed_turns),
+            "detection_failed_shards": failed_shards}
+
+
 def setup_survey_config():
     """This function sets up the session state display options for the survey."""
 
@@ -309,9 +979,9 @@ def set_user_conversation():
     st.session_state.agt_conv_list = [message["response"] for message in st.session_state.messages
                      if message["turn"] == "assistant"]
     st.session_state.user_conversation = "\n".join(st.session_state.usr_conv_list)
-    logging.info("User conversation: %s", st.session_state.user_conversation)
-    logging.info("Agent conversation: %s", st.session_state.agt_conv_list)
-    logging.info("User conversation list: %s", st.session_state.usr_conv_list)
+    logger.info("User conversation: %s", st.session_state.user_conversation)
+    logger.info("Agent conversation: %s", st.session_state.agt_conv_list)
+    logger.info("User conversation list: %s", st.session_state.usr_conv_list)
 
 def get_user_selections():
     """
@@ -322,19 +992,18 @@ def get_user_selections():
         set_user_conversation()
 
     # If complete detections are not obtained in the daemon mode, enforce the user to wait
+    # and list the detections as they are found
     if "complete_detections" not in st.session_state:
-        logging.info("Forcing to get detections from user conversation")
-        with st.spinner("Analyzing conversation..."):
-            complete_detections = get_survey_info()
-        logging.info("Obtained gpt detections from user conversation")
-        logging.info("Complete Detections : %s", complete_detections)
-        st.session_state.complete_detections = complete_detections
+        logger.info("Forcing to get detections from user conversation")
+        stream_survey_sample()
+        logger.info("Obtained gpt detections from user conversation")
+        st.rerun()
 
     # Get the survey info from user conversation if not already obtained
     if "survey_info" not in st.session_state:
-        logging.info("Sampling survey info from the complete detections.")
+        logger.info("Sampling survey info from the complete detections.")
         st.session_state.survey_info = get_survey_sample(st.session_state.complete_detections)
-        logging.info("Sampled Survey info: %s", st.session_state.survey_info)
+        logger.info("Sampled Survey info: %s", st.session_state.survey_info)
 
     survey_info = st.session_state.survey_info
 
@@ -352,22 +1021,19 @@ def get_user_selections():
             # return None
 
         else:
-            logging.info("Surveying user, waiting for user to complete selections.")
+            logger.info("Surveying user, waiting for user to complete selections.")
 
             # Survey information
             st.subheader("Select the following information that you think it's necessary to share for the therapy")
 
             for key, value in survey_info.items():
-                # Commenting out the display in columns as click to see in the chat is not optimal
-                # col1, col3 = st.columns([5, 1])
-                # with col1:
-                #     st.checkbox(f"{value['survey_display']}", key=f"checkbox_{key}", value=False,
-                #                 disabled=st.session_state.disable_user_selections)
-                # with col3:
-                #     with st.expander("Click to see in chat"):
-                #         st.write(f":grey[{value['revealation']}]")
-
-                st.checkbox(f"{value['survey_display']}", key=f"checkbox_{key}", value=False)
+                col1, col3 = st.columns([5, 1])
+                with col1:
+                    st.checkbox(f"{value['survey_display']}", value=False,
+                                key=get_survey_state(SURVEY_TWO).bind("selected", key, f"checkbox_{key}"))
+                with col3:
+                    with st.expander("Click to see in chat"):
+                        st.write(f":grey[{value['better_evidence']}]")
             # Display button to fix the user selections to proceed to the next step and prevent change
             st.button("Next", on_click=fix_user_selections)
 
@@ -397,16 +1063,13 @@ def fix_user_selections():
     st.session_state.disable_user_selections = True # Disable the user selections
 
     # Store the user's selected options into st.session_state memory
-    # Depending up on the checkbox selection, obtain the keypart and store in memory.
-    for key, value in st.session_state.items():
-        if key.startswith("checkbox_"):
-            key_part = key.split("_")[1]
-            if value:
-                st.session_state.user_selections.add(key_part)
-            else:
-                st.session_state.user_non_selections.add(key_part)
-
-    logging.info("Captured User selection into selected and unselected as %s, %s",
+    for key, value in get_survey_state(SURVEY_TWO).values("selected").items():
+        if value:
+            st.session_state.user_selections.add(key)
+        else:
+            st.session_state.user_non_selections.add(key)
+
+    logger.info("Captured User selection into selected and unselected as %s, %s",
                  st.session_state.user_selections,
                  st.session_state.user_non_selections)
     st.session_state.user_selections_fixed = True # Do not display the selections again
@@ -423,12 +1086,12 @@ def get_necessary_reasoning():
         for key in st.session_state.user_selections:
             col1, col2 = st.columns([4, 4])
             col1.write(st.session_state.survey_info[key]["survey_display"])
-            # Commented out for now as the See in chat is not optimal for the user
             with col1.expander("See in chat"):
                 st.write(f":grey[{st.session_state.survey_info[key]['better_evidence']}]")
             
-            _ = col2.text_area("_", key=f"reasoning_{key}_necessary", label_visibility="collapsed",
-                                height=120)
+            _ = col2.text_area("_", label_visibility="collapsed", height=120,
+                               key=get_survey_state(SURVEY_TWO).bind("reasoning_necessary", key,
+                                                                     f"reasoning_{key}_necessary"))
 
         validate_reasoning(prefix="reasoning", suffix="necessary", var_name="disable_necessary_reasons")
         st.button("Next", on_click=set_user_nec_reasoning,
@@ -448,11 +1111,9 @@ def set_reasoning(prefix: str = "reasoning", suffix: str = "necessary",
     for specified combination of prefix and suffix.
     """
     # Captured the reasoning for the selected options
-    for key, value in st.session_state.items():
-        if key.startswith(f"{prefix}_") and key.endswith(f"_{suffix}"):
-            key_part = key.split("_")[1]
-            st.session_state.survey_info[key_part]["reasoning"] = value
-            st.session_state.survey_info[key_part]["selected"] = selection
+    for key, value in get_survey_state(SURVEY_TWO).values(f"{prefix}_{suffix}").items():
+        st.session_state.survey_info[key]["reasoning"] = value
+        st.session_state.survey_info[key]["selected"] = selection
     st.session_state[var_name] = True
 
 
@@ -462,11 +1123,9 @@ def set_user_nec_reasoning():
     provides reasoning for the selected options.
     """
     # Captured the reasoning for the selected options
-    for key, value in st.session_state.items():
-        if key.startswith("reasoning_") and key.endswith("_necessary"):
-            key_part = key.split("_")[1]
-            st.session_state.survey_info[key_part]["reasoning"] = value
-            st.session_state.survey_info[key_part]["selected"] = True
+    for key, value in get_survey_state(SURVEY_TWO).values("reasoning_necessary").items():
+        st.session_state.survey_info[key]["reasoning"] = value
+        st.session_state.survey_info[key]["selected"] = True
     st.session_state.user_nec_reasons_entered = True
 
 
@@ -476,11 +1135,9 @@ def set_user_unnec_reasoning():
     reasoning for the un-selected options.
     """
     # Captured the reasoning for the selected options
-    for key, value in st.session_state.items():
-        if key.startswith("reasoning_") and key.endswith("_unnecessary"):
-            key_part = key.split("_")[1]
-            st.session_state.survey_info[key_part]["reasoning"] = value
-            st.session_state.survey_info[key_part]["selected"] = True
+    for key, value in get_survey_state(SURVEY_TWO).values("reasoning_unnecessary").items():
+        st.session_state.survey_info[key]["reasoning"] = value
+        st.session_state.survey_info[key]["selected"] = True
     st.session_state.user_unnec_reasons_entered = True
 
 
@@ -502,13 +1159,14 @@ def get_unnecessary_reasoning():
 
                 # Display the information in the first column
                 col1.write(st.session_state.survey_info[key]["survey_display"])
-                # Commented out for now as the See in chat is not optimal for the user
                 with col1.expander("See in chat"):
                     st.write(f":grey[{st.session_state.survey_info[key]['better_evidence']}]")
 
                 # Display the reasoning text area in the second column
                 with col2:
-                    _ = col2.text_area("_", key=f"reasoning_{key}_unnecessary", label_visibility="collapsed")
+                    _ = col2.text_area("_", label_visibility="collapsed",
+                                       key=get_survey_state(SURVEY_TWO).bind("reasoning_unnecessary", key,
+                                                                             f"reasoning_{key}_unnecessary"))
 
         validate_reasoning(prefix="reasoning", suffix="unnecessary", var_name="disable_unnecessary_reasons")
         st.button("Next", on_click=set_user_unnec_reasoning,
@@ -553,19 +1211,18 @@ def validate_reasoning(prefix: str = "reasoning", suffix: str = "necessary",
     sets the var_name to True or False.
     """
     regex = re.compile(r"[\s]{2,}")
-    for key, value in st.session_state.items():
-        if key.startswith(f"{prefix}_") and key.endswith(f"_{suffix}"):
-            value = regex.sub(" ", value).strip()
-            if not value or len(value.split(" ")) < min_words:
-                st.session_state[var_name] = True
-                return None
+    for value in get_survey_state(SURVEY_TWO).values(f"{prefix}_{suffix}").values():
+        value = regex.sub(" ", value).strip()
+        if not value or len(value.split(" ")) < min_words:
+            st.session_state[var_name] = True
+            return None
     st.session_state[var_name] = False
     return None
 
 
 def store_feedback():
     """
-    Store the user's feedback in a structured way locally and in Firebase Firestore.
+    Store the user's feedback in a structured way locally and in the storage backend.
     Enables the post-survey options after the feedback is submitted.
     """
 
@@ -575,17 +1232,22 @@ def store_feedback():
     feedback["user_conversation"] = st.session_state.get('user_conversation', [])
     feedback['messages'] = st.session_state.get('messages', [])
     feedback['complete_detections'] = st.session_state.get('complete_detections', {})
-    feedback['user_selections'] = st.session_state.get('user_selections', [])
+    feedback['detection_failed_shards'] = st.session_state.get('detection_failed_shards', [])
+    feedback['detection_failed_turns'] = st.session_state.get('detection_failed_turns', [])
+    feedback['user_selections'] = sorted(st.session_state.get('user_selections', []))
     feedback['survey_info'] = st.session_state.get('survey_info', {})
+    # Token, cost and latency totals of the whole session, chat and survey detection
+    if st.session_state.get("ledger") is not None:
+        feedback['budget'] = st.session_state.ledger.totals()
     
     # Prolific ID
     prolific_id = st.session_state.get('prolific_id', 'unknown')
     feedback["prolific_id"] = prolific_id
 
     # Log the user feedback
-    logging.info("=" * 50)
-    logging.info("User feedback: %s", feedback)
-    logging.info("=" * 50)
+    logger.info("=" * 50)
+    logger.info("User feedback: %s", feedback)
+    logger.info("=" * 50)
 
     # Dump user feedback to a text file with timestamp reference
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -594,18 +1256,14 @@ def store_feedback():
     # with open(feedback_file, "w", encoding='utf-8') as f:
     #     json.dump(feedback, f, indent=4)
 
-    if "firestore_db" in st.session_state:
-        # Store the feedback in Firebase Firestore if configured
+    if "storage" in st.session_state:
+        # Store the feedback in the storage backend if configured
         try:
-            db = st.session_state.firestore_db
-            # Reference to the collection
-            collection_ref = db.collection('group_two_survey_two_responses')
-
             # Create a unique document name using Prolific ID and timestamp
             document_name = f"survey_two_{prolific_id}_{int(time.time())}" 
 
             # Add the feedback document
-            collection_ref.document(document_name).set(feedback)
+            st.session_state.storage.put_document(SURVEY_TWO_RESPONSES, document_name, dict(feedback))
 
             st.success("Feedback submitted successfully.")
         except Exception as e:
@@ -621,9 +1279,22 @@ def log_info(message, mode:str="info"):
     This function logs the information message to the console.
     """
     if mode == "error":
-        logging.error(message)
+        logger.error(message)
     else:
-        logging.info(message)
+        logger.info(message)
+
+
+@st.cache_resource
+def load_posthoc_survey_catalog(filename):
+    """
+    Posthoc survey structures shared read-only by all sessions, built once per process.
+    Returns a dict with the survey table and the list of phrases checked by the detection.
+    """
+    data = read_posthoc_survey_info_csv(filename)
+    return {
+        "data": data,
+        "phrases": data['user_mentioned'].tolist(),
+    }
 
 
 def read_posthoc_survey_info_csv(filename):
@@ -0,0 +1,320 @@
+# jobs.py
+import time
+import uuid
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional, Tuple
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from therapy_system.cancellation import CancellationToken
+from therapy_system.log import get_logger, with_log_context
+from therapy_system.metrics import ERRORS, counter, gauge, histogram
+
+logger = get_logger(__name__)
+
+JOBS_FINISHED = counter("therapy_jobs_finished_total", "Background jobs collected by name and status", ["name", "status"])
+JOBS_REJECTED = counter("therapy_jobs_rejected_total", "Background jobs rejected on a full queue", ["name"])
+JOB_DURATION = histogram("therapy_job_seconds", "Run time of the background jobs by name", ["name"])
+
+JOB_WORKERS = 8 # jobs running at once for all the sessions of the process
+JOB_MAX_PENDING = 64 # jobs queued or running before new ones are rejected
+JOB_RETENTION = 30 * 60 # seconds a finished job waits for its session to collect it
+SESSION_WATCH_INTERVAL = 5 # seconds between the checks for closed browser sessions
+
+# Cancellation reasons of the session
+END_THERAPY, NAVIGATION, TAB_CLOSED = "end_therapy", "navigation", "tab_closed"
+
+# Job status
+PENDING, RUNNING, DONE, FAILED, CANCELLED, TIMED_OUT = "pending", "running", "done", "failed", "cancelled", "timed_out"
+
+
+class JobRejected(RuntimeError):
+    """The job queue is full, the caller should run the work itself or retry later."""
+
+
+@dataclass
+class Job:
+    session_id: str
+    name: str
+    future: Future = None
+    submitted_at: float = field(default_factory=time.time)
+    timeout: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Cancelled on cancellation or timeout, long jobs can check it to stop early
+    cancellation: CancellationToken = field(default_factory=CancellationToken)
+
+    @property
+    def deadline(self) -> Optional[float]:
+        return None if self.timeout is None else self.submitted_at + self.timeout
+
+    def status(self) -> str:
+        if self.future.cancelled() or (self.cancellation.cancelled and not self.timed_out()):
+            return CANCELLED
+        if self.timed_out():
+            return TIMED_OUT
+        if self.future.done():
+            return FAILED if self.future.exception() is not None else DONE
+        return RUNNING if self.future.running() else PENDING
+
+    def timed_out(self) -> bool:
+        # A job finished in time keeps its result even when it is collected late
+        end = self.finished_at if self.finished_at is not None else time.time()
+        return self.deadline is not None and end > self.deadline
+
+
+class JobManager:
+    """
+    Runs the background work of all the sessions on one bounded thread pool.
+
+    A job is keyed by the session id and a job name, so each session has at most one
+    job of a name at a time while the sessions never see each other's jobs. The UI polls
+    the status on its reruns and collects the result, which the session script then
+    puts into its session state. Jobs return their results instead of writing to the
+    session state from the worker thread.
+    """
+    def __init__(self, max_workers: int = JOB_WORKERS, max_pending: int = JOB_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="session_job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[Tuple[str, str], Job] = {}
+        gauge("therapy_jobs", "Background jobs kept for their sessions by status", ["status"]).set_function(
+            self._count_by_status)
+
+    def _count_by_status(self) -> Dict[tuple, int]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {(status,): 0 for status in (PENDING, RUNNING)}
+        for job in jobs:
+            status = job.status()
+            counts[(status,)] = counts.get((status,), 0) + 1
+        return counts
+
+    def submit(self, session_id: str, name: str, fn: Callable, *args, timeout: float = None,
+               cancellation: CancellationToken = None, **kwargs) -> Job:
+        """
+        Run fn(*args, **kwargs) in the background as the job name of the session.
+        With the cancellation token of the session, the job token is its child and is passed to fn
+        as its cancellation argument, so the job stops when the session is cancelled.
+        The job of that name is returned instead when it is still pending or running.
+        Raises JobRejected when too many jobs are queued.
+        """
+        with self._lock:
+            self._prune()
+            job = self._jobs.get((session_id, name))
+            if job is not None and job.status() in (PENDING, RUNNING):
+                return job
+            if sum(not job.future.done() for job in self._jobs.values()) >= self.max_pending:
+                JOBS_REJECTED.inc(name=name)
+                raise JobRejected(f"Job queue is full, cannot run {name}")
+
+            job = Job(session_id, name, timeout=timeout)
+            if cancellation is not None:
+                job.cancellation = cancellation.child()
+                kwargs["cancellation"] = job.cancellation
+            # The records of the job carry the context of the session that submitted it
+            job.future = self._executor.submit(with_log_context(self._run), job, fn, args, kwargs)
+            self._jobs[(session_id, name)] = job
+        logger.info("Submitted job %s of session %s", name, session_id)
+        return job
+
+    def _run(self, job: Job, fn: Callable, args, kwargs):
+        job.started_at = time.time()
+        try:
+            if job.cancellation.cancelled:
+                return None
+            return fn(*args, **kwargs)
+        except Exception:
+            ERRORS.inc(call_site=f"job:{job.name}")
+            logger.exception("Job %s of session %s failed", job.name, job.session_id)
+            raise
+        finally:
+            job.finished_at = time.time()
+            JOB_DURATION.observe(job.finished_at - job.started_at, name=job.name)
+            logger.info("Job %s of session %s finished in %.1fs",
+                         job.name, job.session_id, job.finished_at - job.started_at)
+
+    def get(self, session_id: str, name: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get((session_id, name))
+
+    def status(self, session_id: str, name: str) -> Optional[str]:
+        """Status of the job, None when the session has no job of that name."""
+        job = self.get(session_id, name)
+        return None if job is None else job.status()
+
+    def wait(self, session_id: str, name: str, timeout: float = None) -> Optional[str]:
+        """Wait at most timeout seconds, bounded by the job deadline, for the job to finish and return its status."""
+        job = self.get(session_id, name)
+        if job is None:
+            return None
+        if job.deadline is not None:
+            remaining = max(0.0, job.deadline - time.time())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        try:
+            job.future.exception(timeout=timeout)
+        except (FutureTimeoutError, Exception):
+            pass
+        return job.status()
+
+    def collect(self, session_id: str, name: str):
+        """
+        Remove the finished job and return (status, result). The result is None unless the job is done.
+        A job still pending or running is left in place and (status, None) is returned,
+        a job past its deadline is cancelled.
+        """
+        with self._lock:
+            job = self._jobs.get((session_id, name))
+            if job is None:
+                return None, None
+            status = job.status()
+            if status in (PENDING, RUNNING):
+                return status, None
+            del self._jobs[(session_id, name)]
+        JOBS_FINISHED.inc(name=name, status=status)
+        if status == TIMED_OUT:
+            self._cancel(job, "timed_out")
+            logger.warning("Job %s of session %s timed out after %ss", name, session_id, job.timeout)
+        return status, job.future.result() if status == DONE else None
+
+    def cancel(self, session_id: str, name: str = None):
+        """Cancel the job name of the session, or all its jobs. A running job stops only if it checks its cancellation."""
+        with self._lock:
+            keys = [key for key in self._jobs if key[0] == session_id and (name is None or key[1] == name)]
+            jobs = [self._jobs.pop(key) for key in keys]
+        for job in jobs:
+            self._cancel(job)
+
+    @staticmethod
+    def _cancel(job: Job, reason: str = "cancelled"):
+        job.cancellation.cancel(reason)
+        job.future.cancel()
+
+    def _prune(self):
+        """Forget the finished jobs no session collected, e.g. of participants who left."""
+        now = time.time()
+        for key, job in list(self._jobs.items()):
+            if job.future.done() and now - (job.finished_at or job.submitted_at) > JOB_RETENTION:
+                del self._jobs[key]
+
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    """Job manager shared by all the sessions of the process."""
+    return JobManager()
+
+
+class SessionWatcher:
+    """
+    Cancels the tokens of the browser sessions whose tab was closed. Streamlit lets the script
+    run of a closed session go on, the token stops its model calls and jobs.
+    """
+    def __init__(self, interval: float = SESSION_WATCH_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, CancellationToken] = {}
+        self._thread = None
+
+    def watch(self, streamlit_session_id: str, token: CancellationToken):
+        with self._lock:
+            self._tokens[streamlit_session_id] = token
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="session_watcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            # No runtime when the app runs in tests
+            if not Runtime.exists():
+                continue
+            runtime = Runtime.instance()
+            with self._lock:
+                closed = [(session_id, token) for session_id, token in self._tokens.items()
+                          if not runtime.is_active_session(session_id)]
+                for session_id, _ in closed:
+                    del self._tokens[session_id]
+            for session_id, token in closed:
+                token.cancel(TAB_CLOSED)
+
+
+@st.cache_resource
+def get_session_watcher() -> SessionWatcher:
+    """Watcher of the browser sessions of the process."""
+    return SessionWatcher()
+
+
+def get_session_cancellation() -> CancellationToken:
+    """
+    Cancellation token of the browser session, cancelled when its tab is closed.
+    Its child tokens are those of the conversation and of the jobs, see therapy_system.cancellation.
+    """
+    if "session_cancellation" not in st.session_state:
+        token = CancellationToken()
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            get_session_watcher().watch(ctx.session_id, token)
+        st.session_state.session_cancellation = token
+    return st.session_state.session_cancellation
+
+
+def new_conversation_cancellation() -> CancellationToken:
+    """Token of a new conversation, cancelled when it ends, the participant leaves it or the session is closed."""
+    st.session_state.cancellation = get_session_cancellation().child()
+    return st.session_state.cancellation
+
+
+def cancel_conversation(reason: str):
+    """Stop the model calls of the conversation of the session, if it is still running."""
+    token = st.session_state.get("cancellation")
+    if token is not None:
+        token.cancel(reason)
+
+
+def resume_conversation(env):
+    """A conversation left for another page goes on with a new token when the participant comes back."""
+    token = st.session_state.get("cancellation")
+    if token is not None and token.cancelled and token.reason == NAVIGATION:
+        env.set_cancellation(new_conversation_cancellation())
+
+
+def get_session_id() -> str:
+    """Id of the browser session, the key of its jobs."""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+
+def submit_job(name: str, fn: Callable, *args, timeout: float = None, cancellable: bool = False, **kwargs) -> Job:
+    """
+    Run fn in the background as the job name of the current session, see JobManager.submit.
+    A cancellable job gets a cancellation argument, cancelled with the session.
+    """
+    cancellation = get_session_cancellation() if cancellable else None
+    return get_job_manager().submit(get_session_id(), name, fn, *args, timeout=timeout, cancellation=cancellation,
+                                    **kwargs)
+
+
+def job_status(name: str) -> Optional[str]:
+    return get_job_manager().status(get_session_id(), name)
+
+
+def wait_job(name: str, timeout: float = None) -> Optional[str]:
+    return get_job_manager().wait(get_session_id(), name, timeout)
+
+
+def cancel_jobs(name: str = None):
+    get_job_manager().cancel(get_session_id(), name)
+
+
+def handoff_job(name: str) -> Optional[str]:
+    """
+    Collect the job of the current session and put its result, a dict of session state
+    values, into the session state when it is done. Returns the job status.
+    """
+    status, result = get_job_manager().collect(get_session_id(), name)
+    if status == DONE and result:
+        st.session_state.update(result)
+    return status
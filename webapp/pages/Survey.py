@@ -1,7 +1,9 @@
 import streamlit as st
-from webapp.post_survey_1 import post_survey_one
-from webapp.post_survey_2 import post_survey_two, prep_survey_two
-from webapp.post_survey_3 import close_and_redirect, post_survey_three
+from post_survey_1 import post_survey_one
+from post_survey_2 import post_survey_two, prep_survey_two
+from post_survey_3 import close_and_redirect, post_survey_three
+import perf
+from jobs import NAVIGATION, cancel_conversation
 
 def style_code():
     """ CSS style for the survey page. """
@@ -26,6 +28,9 @@ def main():
     """ Main function for the survey page. """
     st.title("Survey")
 
+    # A conversation still running is paused, its side agents and calls in flight are stopped
+    cancel_conversation(NAVIGATION)
+
     # Ensure Prolific ID is available
     if 'prolific_id' not in st.session_state or st.session_state.prolific_id == '':
         st.warning("Please go back to the 'Chat with AI Therapist' page and enter your Prolific ID.")
@@ -37,19 +42,27 @@ def main():
 
     # Preload the survey for the second part of the survey
     if not st.session_state.get("prep_done", False):
-        prep_survey_two()
+        with perf.phase("prep_survey_two"):
+            prep_survey_two()
 
     # Check if the first survey is completed
     if 'survey_1_completed' not in st.session_state:
-        post_survey_one()
+        with perf.phase("post_survey_one"):
+            post_survey_one()
     elif 'survey_2_completed' not in st.session_state:
-        post_survey_two()
+        with perf.phase("post_survey_two"):
+            post_survey_two()
     elif 'survey_3_completed' not in st.session_state:
-        post_survey_three()
+        with perf.phase("post_survey_three"):
+            post_survey_three()
     else:
         st.write("You have already completed the survey.")
         style_code()
         close_and_redirect()
 
 if __name__ == "__main__":
-    main()
+    perf.start_rerun("Survey")
+    try:
+        main()
+    finally:
+        perf.finish_rerun()
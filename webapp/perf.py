@@ -0,0 +1,232 @@
+# perf.py
+"""
+Timing of the script reruns of the pages.
+
+Every rerun is timed by named phase and logged as one line. A session can opt in to
+profiling with the query param ?profile=<token> matching the [profiling] token of the
+secrets, profiling stays off without a token. [profiling] all_sessions = true profiles
+all the sessions. A profiled
+session appends each rerun report, with the length of the conversation, to
+profiles/<session id>/reruns.jsonl and shows in the sidebar how each phase grows with
+the conversation. ?cprofile=1 also runs cProfile over the next rerun only.
+"""
+import io
+import os
+import hmac
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from therapy_system.log import configure_logging, bind_log_context, get_logger
+from therapy_system.metrics import SESSION_PHASES, counter, histogram, start_metrics_server
+from jobs import get_session_id
+
+logger = get_logger(__name__)
+
+# Number of rerun reports kept per session
+MAX_REPORTS = 50
+PROFILE_DIR = os.environ.get("THERAPY_PROFILE_DIR", "profiles")
+PROFILE_TOP = 30 # functions kept in the cProfile summary of a rerun
+
+# Timer of the rerun running on the script thread of the session
+_rerun = threading.local()
+
+RERUNS = counter("therapy_reruns_total", "Script reruns by page", ["page"])
+RERUN_DURATION = histogram("therapy_rerun_seconds", "Duration of the script reruns by page", ["page"])
+
+
+def session_is_open(streamlit_session_id: str) -> bool:
+    # No runtime when the app runs in tests, the sessions are then never closed
+    return not Runtime.exists() or Runtime.instance().is_active_session(streamlit_session_id)
+
+
+SESSION_PHASES.is_open = session_is_open
+
+
+def track_session_phase():
+    """Count the session under its current phase in the active sessions metric."""
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        SESSION_PHASES.set(ctx.session_id, st.session_state.get("phase", "initial"))
+
+
+def profiling_secrets() -> dict:
+    try:
+        return dict(st.secrets.get("profiling", {}))
+    except FileNotFoundError:
+        return {}
+
+
+def profiling_enabled() -> bool:
+    """Whether the reruns of the session are profiled, once opted in it stays on for the session."""
+    if "profiling" not in st.session_state:
+        secrets = profiling_secrets()
+        param = st.query_params.get("profile")
+        token = secrets.get("token")
+        opted_in = bool(token) and param is not None and hmac.compare_digest(str(param), str(token))
+        st.session_state.profiling = bool(secrets.get("all_sessions", False) or opted_in)
+    return st.session_state.profiling
+
+
+def start_cprofile():
+    """cProfile of the rerun when the session asked for it with ?cprofile=1, None otherwise."""
+    if st.query_params.get("cprofile") is None:
+        return None
+    # One rerun only, the next reruns run without the profiler
+    del st.query_params["cprofile"]
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another session of the process is being profiled
+        logger.warning("cProfile is already running, the rerun is not profiled")
+        return None
+    return profiler
+
+
+def cprofile_summary(profiler: cProfile.Profile, path: str) -> str:
+    """Dump the profile to the path and return its top functions by cumulative time."""
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    return summary.getvalue()
+
+
+def phase_growth(reports: list) -> dict:
+    """
+    Milliseconds each phase adds per message of the conversation, the least squares slope over the reruns.
+    A phase whose cost grows with the conversation has a clearly positive slope.
+    """
+    growth = {}
+    names = {name for report in reports for name in report["phases"]}
+    for name in sorted(names | {"total_ms"}):
+        points = [(report["messages"], report["total_ms"] if name == "total_ms" else report["phases"][name])
+                  for report in reports if name == "total_ms" or name in report["phases"]]
+        if len({x for x, _ in points}) < 2:
+            continue
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        slope = (sum((x - mean_x) * (y - mean_y) for x, y in points)
+                 / sum((x - mean_x) ** 2 for x, _ in points))
+        growth[name] = {"ms_per_message": slope, "mean_ms": mean_y, "reruns": len(points)}
+    return growth
+
+
+def show_profile_report():
+    """Sidebar summary of the profiled reruns of the session, up to the previous one."""
+    reports = st.session_state.get("rerun_reports", [])
+    if not reports:
+        return
+    with st.sidebar.expander("Profiling"):
+        st.caption(f"{len(reports)} reruns, reports in {os.path.join(PROFILE_DIR, get_session_id())}")
+        st.dataframe([{"phase": name, **values} for name, values in phase_growth(reports).items()],
+                     use_container_width=True, hide_index=True)
+        if reports[-1].get("cprofile"):
+            st.code(reports[-1]["cprofile"])
+
+
+def start_rerun(page: str, show_report: bool = True):
+    """
+    Start timing a script rerun of the page, whose records carry the session context.
+    show_report draws the profiling report of a profiled session in the sidebar.
+    """
+    configure_logging()
+    start_metrics_server()
+    bind_log_context(session_id=get_session_id(), prolific_id=st.session_state.get("prolific_id"), page=page)
+    RERUNS.inc(page=page)
+    track_session_phase()
+    # Once the script called st.stop() every access to the session state raises again, so the timer
+    # holds what finish_rerun needs and lives on the script thread rather than in the session state
+    _rerun.timer = {
+        "page": page,
+        "start": time.perf_counter(),
+        "phases": {},
+        "session_id": get_session_id(),
+        "reports": st.session_state.setdefault("rerun_reports", []),
+        "messages": st.session_state.get("messages"),
+        "profiling": profiling_enabled(),
+        "profiler": None,
+    }
+    if _rerun.timer["profiling"]:
+        if show_report:
+            show_profile_report()
+        _rerun.timer["profiler"] = start_cprofile()
+
+
+@contextmanager
+def phase(name: str):
+    """Time a named phase of the current rerun. Repeated phases are summed."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = getattr(_rerun, "timer", None)
+        if timer is not None:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            timer["phases"][name] = timer["phases"].get(name, 0.0) + elapsed_ms
+
+
+@contextmanager
+def fragment_rerun(page: str, name: str):
+    """
+    Time a fragment of the page. Run by a full rerun it is one of its phases, rerun
+    on its own it is reported as a rerun of page/name.
+    """
+    if getattr(_rerun, "timer", None) is not None:
+        with phase(name):
+            yield
+        return
+    start_rerun(f"{page}/{name}", show_report=False)
+    try:
+        yield
+    finally:
+        finish_rerun()
+
+
+def finish_rerun() -> dict:
+    """
+    Log the timings of the rerun as one line and keep them in the session,
+    so the cost of a cold start can be compared with the following reruns.
+    """
+    timer, _rerun.timer = getattr(_rerun, "timer", None), None
+    if timer is None:
+        return None
+    if timer["profiler"] is not None:
+        timer["profiler"].disable()
+
+    report = {
+        "page": timer["page"],
+        "total_ms": (time.perf_counter() - timer["start"]) * 1000,
+        "phases": timer["phases"],
+        # The render phases that grow with the conversation are found against its length
+        "messages": len(timer["messages"] or []),
+    }
+    RERUN_DURATION.observe(report["total_ms"] / 1000, page=report["page"])
+    reports = timer["reports"]
+    reports.append(report)
+    del reports[:-MAX_REPORTS]
+
+    phases = " ".join(f"{name}={elapsed:.1f}ms" for name, elapsed in report["phases"].items())
+    logger.info("Rerun %d of %s took %.1fms: %s", len(reports), report["page"], report["total_ms"], phases)
+    if timer["profiling"]:
+        write_profile_report(timer["session_id"], report, timer["profiler"])
+    return report
+
+
+def write_profile_report(session_id: str, report: dict, profiler: cProfile.Profile = None):
+    """Append the report to the reruns of the session, with the cProfile of the rerun when it was profiled."""
+    directory = os.path.join(PROFILE_DIR, session_id)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        if profiler is not None:
+            name = f"rerun_{time.strftime('%Y%m%d_%H%M%S')}_{int(time.time() * 1000) % 1000:03d}.prof"
+            report["cprofile"] = cprofile_summary(profiler, os.path.join(directory, name))
+        with open(os.path.join(directory, "reruns.jsonl"), "a") as f:
+            f.write(json.dumps({"recorded_at": time.time(), **report}) + "\n")
+    except OSError:
+        logger.exception("Writing the profile report to %s failed", directory)
@@ -3,38 +3,38 @@ import pandas as pd
 import os
 import json
 import streamlit_survey as ss
-from firebase_admin import firestore
 import time
-import logging
+from therapy_system.storage import SURVEY_ONE_RESPONSES
+from therapy_system.log import get_logger
+
+logger = get_logger(__name__)
 
 HEADER_SIZE = 24
 LABEL_SIZE = 20
 OPTION_SIZE = 14
 
-# Assuming Firebase setup has already been initialized
+# Assuming the storage backend has already been initialized
 
-def save_survey_response_to_firebase(prolific_id, survey_data):
-    """Save the survey responses to Firebase Firestore."""
-    if "firestore_db" not in st.session_state:
-        logging.error("Firestore DB not set up. Please initialize Firebase first.")
+def save_survey_response(prolific_id, survey_data):
+    """Save the survey responses to the storage backend."""
+    if "storage" not in st.session_state:
+        logger.error("Storage not set up. Please initialize the storage backend first.")
         return
 
-    db = st.session_state.firestore_db
     document_name = f"survey_one_{prolific_id}_{int(time.time())}"  # Create a unique document name using prolific_id and timestamp
 
     # Prepare the data to be saved
     survey_document = {
         "prolific_id": prolific_id,
         "survey_data": survey_data,
-        "timestamp": firestore.SERVER_TIMESTAMP,  # Automatically set the timestamp in Firestore
     }
 
     try:
-        # Save the survey document to the Firestore collection named "survey_one_responses"
-        db.collection("group_two_survey_one_responses").document(document_name).set(survey_document)
-        logging.info("Survey Part 1 response successfully saved to Firebase Firestore.")
-    except Exception as e:
-        logging.error(f"Failed to save survey response to Firebase Firestore: {e}")
+        # Save the survey document to the survey one responses collection
+        st.session_state.storage.put_document(SURVEY_ONE_RESPONSES, document_name, survey_document)
+        logger.info("Survey Part 1 response successfully saved.")
+    except Exception:
+        logger.exception("Failed to save survey response")
 
 
 def streamlit_cnfg():
@@ -176,8 +176,8 @@ def post_survey_one():
                 "response": response
             })
 
-        # Store the responses in Firebase
-        save_survey_response_to_firebase(prolific_id, survey_data)
+        # Store the responses
+        save_survey_response(prolific_id, survey_data)
         # Mark responses as submitted and disable further edits
         st.session_state.responses_submitted = True
         st.session_state.survey_1_completed = True
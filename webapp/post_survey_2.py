@@ -1,20 +1,27 @@
-import asyncio
 import streamlit as st
 import os
 import csv
-from webapp.feedback_utils import (read_posthoc_survey_info_csv, get_user_selections, get_survey_info, set_user_conversation)
-import threading
-from streamlit.runtime.scriptrunner import add_script_run_ctx
+from feedback_utils import (POSTHOC_SURVEY_FILENAME, load_posthoc_survey_catalog, get_user_selections,
+                                   prepare_detections, set_user_conversation)
+from jobs import (PENDING, RUNNING, DONE, JobRejected, submit_job, job_status, wait_job, handoff_job,
+                         cancel_jobs)
+from therapy_system.log import get_logger
 
-# Constants
-POSTHOC_SURVEY_INFO_FNAME = "posthoc_survey.csv"
+logger = get_logger(__name__)
+
+DETECTION_JOB = "complete_detections"
+DETECTION_JOB_TIMEOUT = 180 # seconds the background detection may take
+DETECTION_JOB_WAIT = 15 # seconds the survey waits for it before detecting in the foreground
 
 def load_survey_info():
     """
     Load the survey info from the CSV file into session state.
+    The file is read once per process, later calls only look it up.
     """
     # Load the survey info
-    st.session_state.posthoc_survey_info = read_posthoc_survey_info_csv(POSTHOC_SURVEY_INFO_FNAME)
+    catalog = load_posthoc_survey_catalog(POSTHOC_SURVEY_FILENAME)
+    st.session_state.posthoc_survey_info = catalog["data"]
+    st.session_state.posthoc_survey_phrases = catalog["phrases"]
 
 
 def prep_survey_two():
@@ -28,22 +35,15 @@ def prep_survey_two():
     if "posthoc_survey_info" not in st.session_state:
         load_survey_info()
 
-    THREAD_NAME = "complete_detections_thread"
-
     if "complete_detections" not in st.session_state:
-        async def wrapper():
-            st.session_state.complete_detections = await get_survey_info()
-        
-        existing_threads = [t for t in threading.enumerate() if t.name == THREAD_NAME]
-        # Only if there is not already a thread running for this, start a new one
-        if not existing_threads:
-            # Create and configure new thread only if no existing thread is found
-            thread = threading.Thread(
-                target=lambda: asyncio.run(wrapper()),
-                name=THREAD_NAME
-            )
-            add_script_run_ctx(thread)
-            thread.start()
+        # The patient messages were already checked during the chat, otherwise the whole conversation is analyzed
+        try:
+            submit_job(DETECTION_JOB, prepare_detections, st.session_state.get("turn_detector"),
+                       st.session_state.posthoc_survey_info, st.session_state.user_conversation,
+                       st.session_state.get("ledger"), timeout=DETECTION_JOB_TIMEOUT, cancellable=True)
+        except JobRejected as e:
+            # The survey detects in the foreground instead
+            logger.warning("Background detection not started: %s", e)
     st.session_state.prep_done = True
 
 
@@ -60,4 +60,22 @@ def post_survey_two():
         st.stop()
 
     load_survey_info()
+    if "complete_detections" not in st.session_state:
+        collect_detections()
     get_user_selections()
+
+
+def collect_detections():
+    """
+    Put the detections of the background job into the session state, waiting a bit for it when it is running.
+    Otherwise, the job is cancelled and the detections are made in the foreground by get_user_selections,
+    which keeps those the turn detector made and analyzes only the turns it did not check.
+    """
+    if job_status(DETECTION_JOB) in (PENDING, RUNNING):
+        with st.spinner("Analyzing conversation..."):
+            wait_job(DETECTION_JOB, DETECTION_JOB_WAIT)
+    status = handoff_job(DETECTION_JOB)
+    if status in (PENDING, RUNNING):
+        cancel_jobs(DETECTION_JOB)
+    if status not in (None, DONE):
+        logger.warning("Background detection %s, detecting in the foreground", status)
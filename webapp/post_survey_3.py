@@ -1,45 +1,45 @@
 import streamlit as st
-import firebase_admin
-from firebase_admin import firestore
 import time
-import logging
 import webbrowser
+from therapy_system.storage import SURVEY_THREE_RESPONSES
+from survey_state import get_survey_state
+from therapy_system.log import get_logger
+
+logger = get_logger(__name__)
 
 PROLIFIC_URL = "https://app.prolific.co/submissions/complete?cc=CWU9VX3E"
+SURVEY_THREE = "post_survey_three" # name of the survey state of the demographic survey
 
-# Assuming Firebase setup has already been initialized
+# Assuming the storage backend has already been initialized
 
-def save_survey_two_response_to_firebase(prolific_id, responses):
-    """Save the survey responses for Survey Part 2 to Firebase Firestore."""
-    if "firestore_db" not in st.session_state:
-        logging.error("Firestore DB not set up. Please initialize Firebase first.")
+def save_survey_three_response(prolific_id, responses):
+    """Save the survey responses for Survey Part 3 to the storage backend."""
+    if "storage" not in st.session_state:
+        logger.error("Storage not set up. Please initialize the storage backend first.")
         return
 
-    db = st.session_state.firestore_db
     document_name = f"survey_three_{prolific_id}_{int(time.time())}"  # Create a unique document name using prolific_id and timestamp
 
     # Prepare the data to be saved
     survey_document = {
         "prolific_id": prolific_id,
         "survey_data": responses,
-        "timestamp": firestore.SERVER_TIMESTAMP,  # Automatically set the timestamp in Firestore
     }
 
     try:
-        # Save the survey document to the Firestore collection named "survey_two_responses"
-        db.collection("group_two_survey_three_responses").document(document_name).set(survey_document)
-        logging.info("Survey Part 3 response successfully saved to Firebase Firestore.")
-    except Exception as e:
-        logging.error(f"Failed to save Survey Part 2 response to Firebase Firestore: {e}")
+        # Save the survey document to the survey three responses collection
+        st.session_state.storage.put_document(SURVEY_THREE_RESPONSES, document_name, survey_document)
+        logger.info("Survey Part 3 response successfully saved.")
+    except Exception:
+        logger.exception("Failed to save Survey Part 3 response")
 
 
 def update_selected_options():
     """Update the selected options based on the checkbox values."""
-    # st.session_state.selected_options = [st.session_state.prior_exp_options[int(option.split("_")[1])] for option, value in st.session_state.items() if value and option.startswith('cbox_')]
     st.session_state.selected_options = [
-            st.session_state.prior_exp_options[int(option.split("_")[1])] 
-            for option, value in st.session_state.items() 
-            if isinstance(value, bool) and value and option.startswith('cbox_')
+            st.session_state.prior_exp_options[int(index)]
+            for index, value in get_survey_state(SURVEY_THREE).values("prior_experience").items()
+            if value
         ]
 
 def close_and_redirect(url=PROLIFIC_URL):
@@ -134,7 +134,8 @@ def post_survey_three():
     st.write("Select your prior experience with AI chatbot or therapy:")
     st.session_state.prior_exp_options = prior_experience_options
     for indx, option in enumerate(prior_experience_options):
-        st.checkbox(option, key=f'cbox_{indx}',on_change=update_selected_options,
+        st.checkbox(option, key=get_survey_state(SURVEY_THREE).bind("prior_experience", str(indx), f'cbox_{indx}'),
+                    on_change=update_selected_options,
                     disabled=st.session_state.get("survey_submitted", False))
 
     # Submit button
@@ -157,8 +158,8 @@ def post_survey_three():
                 'prior_experience': st.session_state.selected_options,
             }
 
-            # Store the responses in Firebase
-            save_survey_two_response_to_firebase(st.session_state.prolific_id, responses)
+            # Store the responses
+            save_survey_three_response(st.session_state.prolific_id, responses)
 
             st.success("Thank you for completing the survey!")
             st.balloons()
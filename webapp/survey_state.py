@@ -0,0 +1,38 @@
+# survey_state.py
+from dataclasses import dataclass, field
+from typing import Any, Dict
+import streamlit as st
+
+
+@dataclass
+class SurveyState:
+    """
+    Answers of one survey, bound to the keys of the widgets that collect them.
+
+    Each answer field, e.g. the selected checkboxes or the reasons given, maps the
+    answer key, e.g. the detection key, to the key of its widget in st.session_state.
+    Reading a field looks up its own widgets only, whatever else the session holds.
+    """
+    name: str
+    bindings: Dict[str, Dict[str, str]] = field(default_factory=dict)
+
+    def bind(self, answer_field: str, answer_key: str, widget_key: str) -> str:
+        """Binds the widget to the answer and returns the widget key."""
+        self.bindings.setdefault(answer_field, {})[answer_key] = widget_key
+        return widget_key
+
+    def values(self, answer_field: str) -> Dict[str, Any]:
+        """Answer key to widget value of the field, for the widgets with a value in the session."""
+        return {
+            answer_key: st.session_state[widget_key]
+            for answer_key, widget_key in self.bindings.get(answer_field, {}).items()
+            if widget_key in st.session_state
+        }
+
+
+def get_survey_state(name: str) -> SurveyState:
+    """State of the survey in the session, created on first use."""
+    key = f"survey_state_{name}"
+    if key not in st.session_state:
+        st.session_state[key] = SurveyState(name)
+    return st.session_state[key]
@@ -1,10 +1,16 @@
 import os
 import time
-import logging
 import pandas as pd
 import streamlit as st
 from typing import Generator, List
-import openai
+from therapy_system.agents.llm.structured import complete_structured, response_format
+from therapy_system.budget import estimate_completion_tokens
+from therapy_system.cancellation import Cancelled, CANCELLATION_STATS
+from therapy_system.log import get_logger
+from therapy_system.metrics import ERRORS
+from therapy_system.tracing import span, start_span, traced
+
+logger = get_logger(__name__)
 
 
 def secure_log_api_key(api_key: str):
@@ -13,9 +19,9 @@ def secure_log_api_key(api_key: str):
     """
     if api_key:
         masked_key = f"{api_key[:3]}{'*' * (len(api_key) - 6)}{api_key[-3:]}"
-        # logging.info("Using API key: %s", masked_key)
+        # logger.info("Using API key: %s", masked_key)
     else:
-        logging.error("No API key provided.")
+        logger.error("No API key provided.")
 
 
 def clean_chat():
@@ -31,65 +37,172 @@ def stream_data(msg):
         time.sleep(0.02)
 
 
-def generate_response(system_prompt, user_prompt, model="gpt-4o-mini", max_tokens=100, temperature=0.7):
+@st.cache_resource
+def get_openai_client():
     """
-    Generates a response using the GPT-4 model with system and user prompts.
+    OpenAI client shared by all sessions, so its connection pool is reused across calls.
     """
-    client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    if not client.api_key:
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
         raise ValueError("OpenAI API key not found in environment variables. Please set the OPENAI_API_KEY environment variable.")
+    # The SDK is imported on first use, not when the login screen is rendered
+    import openai
+    return openai.OpenAI(api_key=api_key)
 
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=max_tokens,
-            temperature=temperature,
-        )
+
+def check_cancelled(cancellation, call_site: str, max_tokens: int):
+    """Raises Cancelled, and counts the call as skipped, when the token is cancelled."""
+    if cancellation is not None and cancellation.cancelled:
+        CANCELLATION_STATS.record(call_site, cancellation.reason, max_tokens)
+        raise Cancelled(cancellation.reason)
+
+
+def generate_response(system_prompt, user_prompt, model="gpt-4o-mini", max_tokens=100, temperature=0.7, timeout=None,
+                      response_schema=None, schema_name="response", ledger=None, call_site="generate_response",
+                      cancellation=None):
+    """
+    Generates a response using the GPT-4 model with system and user prompts.
+    timeout is in seconds, the client default is used when it is not given.
+    With response_schema, the reply is enforced to follow the JSON schema and the parsed value is returned,
+    see therapy_system.agents.llm.structured.
+    With the budget ledger of the session, the call is recorded under call_site and downgraded when over budget.
+    With a cancellation token, the call is skipped and None returned once it is cancelled.
+    """
+    client = get_openai_client()
+    if timeout is not None:
+        client = client.with_options(timeout=timeout, max_retries=0)
+    if ledger is not None:
+        model = ledger.choose_model(model)
+
+    def call(messages):
+        kwargs = {"response_format": response_format(response_schema, schema_name)} if response_schema else {}
+        # Checked before the repair call of a structured reply too
+        check_cancelled(cancellation, call_site, max_tokens)
+        start = time.perf_counter()
+        with span(f"llm.{call_site}", model=model):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **kwargs,
+            )
+        if ledger is not None and response.usage is not None:
+            ledger.record(call_site, model, response.usage.prompt_tokens, response.usage.completion_tokens,
+                          (time.perf_counter() - start) * 1000)
         return response.choices[0].message.content.strip()
 
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    try:
+        if response_schema is not None:
+            return complete_structured(call, messages, response_schema, schema_name)
+        return call(messages)
+
+    except Cancelled:
+        return None
     except Exception as e:
-        print(f"Error in chat message: {str(e)}")
+        ERRORS.inc(call_site=call_site)
+        logger.warning("Error in chat message: %s", e)
         return None
 
 
-def gpt4_search_persona(query, persona_data):
+def stream_response(system_prompt, user_prompt, model="gpt-4o-mini", max_tokens=100, temperature=0.7, timeout=None,
+                    response_schema=None, schema_name="response", ledger=None, call_site="stream_response",
+                    cancellation=None):
+    """
+    Streams a response of the GPT-4 model with system and user prompts, yielding the text as it is generated.
+    With response_schema, the reply is enforced to follow the JSON schema.
+    With the budget ledger of the session, the call is recorded under call_site and downgraded when over budget.
+    With a cancellation token, the stream is closed and Cancelled raised at the next chunk once it is cancelled.
+    Unlike generate_response, errors are raised to the caller.
+    """
+    check_cancelled(cancellation, call_site, max_tokens)
+    client = get_openai_client()
+    if timeout is not None:
+        client = client.with_options(timeout=timeout, max_retries=0)
+    kwargs = {"response_format": response_format(response_schema, schema_name)} if response_schema else {}
+    if ledger is not None:
+        model = ledger.choose_model(model)
+        kwargs["stream_options"] = {"include_usage": True}
+    start = time.perf_counter()
+    # The span ends once the caller has drained or closed the stream
+    call_span = start_span(f"llm.{call_site}", model=model, stream=True)
+
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True,
+        **kwargs,
+    )
+    text = ""
+    try:
+        for chunk in stream:
+            if cancellation is not None and cancellation.cancelled:
+                CANCELLATION_STATS.record(call_site, cancellation.reason,
+                                          max_tokens - estimate_completion_tokens(len(text.split())))
+                raise Cancelled(cancellation.reason)
+            # The final chunk carries the usage and has no choices
+            if ledger is not None and chunk.usage is not None:
+                ledger.record(call_site, model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens,
+                              (time.perf_counter() - start) * 1000)
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+    finally:
+        # Release the connection when the caller stops early
+        stream.close()
+        call_span.end()
+
+
+@traced("gpt4_search_persona")
+def gpt4_search_persona(query, persona_catalog):
     """
     Use GPT-4 to determine which groups or information from the persona
-    relate to the query. Return multiple relevant groups if detected.
+    relate to the query. Return the list of relevant groups, at most two, which is empty when none is.
     """
-    # Convert persona data to string format
-    persona_data_string = persona_data.to_string(index=False)
-    
     # GPT-4 prompt to determine relevant groups
     prompt = f"""
     Here is a persona dataset with various categories and details:
 
-    {persona_data_string.lower()}
+    {persona_catalog["search_string"]}
 
     Based on this data, which groups or details relate most to the following query:
     "{query}"
 
-    Please return your response in this exact format:
-    - If there are relevant groups: Return a list, contain only the group names separated by commas (e.g. "Your basic info, Recent Relocation")
-    - If no groups are relevant: Return exactly "None"
-    
+    Return the names of the relevant groups, or an empty list if no groups are relevant.
     If there are more than two relevant groups, only include the two most relevant groups that have a direct and explicit connection to the query content.
-    Do not include explanations or other text.
     """
-    
-    detected_groups = generate_response(
+    groups_schema = {
+        "type": "object",
+        "properties": {
+            "groups": {"type": "array", "items": {"type": "string", "enum": persona_catalog["main_categories"]}},
+        },
+        "required": ["groups"],
+        "additionalProperties": False,
+    }
+
+    detected = generate_response(
         system_prompt="You are a smart assistant that can match user queries to relevant persona details.",
         user_prompt=prompt,
         model="gpt-4o-mini",
         max_tokens=150,
-        temperature=0
+        temperature=0,
+        response_schema=groups_schema,
+        schema_name="persona_groups",
+        ledger=st.session_state.get("ledger"),
+        call_site="persona_search",
+        cancellation=st.session_state.get("cancellation"),
     )
     
-    return detected_groups
+    return detected["groups"][:2] if detected else []
 
 
 def read_persona_csv(filename):
@@ -100,6 +213,23 @@ def read_persona_csv(filename):
     return main_categories, category_info, data
 
 
+@st.cache_resource
+def load_persona_catalog(filename):
+    """
+    Persona structures shared read-only by all sessions, built once per process.
+    Returns a dict with the main categories, the information per category, the raw table,
+    the lowercase to display category map and the lowercased table used in the search prompt.
+    """
+    main_categories, category_info, data = read_persona_csv(filename)
+    return {
+        "main_categories": main_categories,
+        "category_info": category_info,
+        "data": data,
+        "category_map": {category.lower(): category for category in category_info},
+        "search_string": data.to_string(index=False).lower(),
+    }
+
+
 def read_unnecessary_info_csv(filename):
     data = pd.read_csv(filename, encoding='utf-8')
     return data['unnecessary_info'].tolist(), data.set_index('unnecessary_info').T.to_dict()